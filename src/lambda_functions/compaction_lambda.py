@@ -0,0 +1,398 @@
+import boto3
+import logging
+import io
+import json
+from botocore.exceptions import ClientError
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+ingestion_bucket = "ingestion-bucket-1158020804995033"
+processed_bucket = "processed-bucket-1158020804995033"
+
+CHECKPOINT_PREFIX = 'checkpoints'
+CHECKPOINT_ATTEMPTS = 5
+CHECKPOINT_CONFLICTS = ('PreconditionFailed', 'ConditionalRequestConflict', '409', '412')
+CONDITIONAL_HEADERS = {'IfMatch': 'If-Match', 'IfNoneMatch': 'If-None-Match'}
+_checkpoint_client = None
+
+# The tables compacted in each bucket and their primary keys. Ingested rows
+# are deduplicated on last_updated; the processed tables have no such
+# column, so the row from the newest file wins.
+INGESTION_TABLES = {
+    'address': 'address_id',
+    'counterparty': 'counterparty_id',
+    'currency': 'currency_id',
+    'department': 'department_id',
+    'design': 'design_id',
+    'payment': 'payment_id',
+    'payment_type': 'payment_type_id',
+    'purchase_order': 'purchase_order_id',
+    'sales_order': 'sales_order_id',
+    'staff': 'staff_id',
+    'transaction': 'transaction_id',
+}
+PROCESSED_TABLES = {
+    'dim_counterparty': 'counterparty_id',
+    'dim_currency': 'currency_id',
+    'dim_design': 'design_id',
+    'dim_location': 'location_id',
+    'dim_payment_type': 'payment_type_id',
+    'dim_staff': 'staff_id',
+    'dim_transaction': 'transaction_id',
+    'fact_sales_order': 'sales_order_id',
+    'fact_purchase_order': 'purchase_order_id',
+    'fact_payment': 'payment_id',
+}
+ORDER_COLUMN = 'last_updated'
+
+# A bucket's files are only compacted once the next stage has read them:
+# the processed lambda records what it has read of the ingestion bucket in
+# processed_update.json, the warehouse lambda what it has loaded in
+# warehouse_update.json.
+STATE_KEYS = {'ingestion': 'processed_update.json',
+              'processed': 'warehouse_update.json'}
+
+# Superseded partition files are left in place for readers of the previous
+# manifest and removed by compaction once their day is closed.
+PARTITION_COLUMN = 'created_date'
+MANIFEST_PREFIX = 'table_manifests'
+
+
+def lambda_handler(event, context):
+    """Merges the small files of every closed day into one file per day.
+
+    The ingestion and processed lambdas write one small file per table per
+    run. For each table, every day that is closed - earlier than today, than
+    the day of the table's checkpoint and than the day of the newest file
+    the next stage has read - is rewritten as a single file with one row per
+    primary key. The merged file replaces the day's newest file under the
+    same key and the day's other files are deleted, so checkpoints, the
+    state files and the pending file listings all stay valid and the job
+    can run alongside the pipeline.
+
+    Args:
+        event (dict): Optionally 'buckets' (a list of 'ingestion' and
+            'processed') and 'tables' to limit the run to.
+        context: The lambda context, unused.
+
+    Returns:
+        dict: The number of files merged and deleted per table.
+    """
+    buckets = event.get('buckets', ['ingestion', 'processed']) if event else [
+        'ingestion', 'processed']
+    tables = event.get('tables') if event else None
+    today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    summary = {}
+    for bucket in buckets:
+        if bucket == 'ingestion':
+            bucket_name, registry, order_column = ingestion_bucket, INGESTION_TABLES, ORDER_COLUMN
+        else:
+            bucket_name, registry, order_column = processed_bucket, PROCESSED_TABLES, None
+        state = read_state(STATE_KEYS[bucket])
+        for table_name, primary_key in registry.items():
+            if tables and table_name not in tables:
+                continue
+            cutoff = closed_before(bucket_name, table_name, state.get(table_name), today)
+            if cutoff is None:
+                continue
+            merged, deleted = compact_table(
+                bucket_name, table_name, primary_key, cutoff, order_column)
+            if bucket == 'processed':
+                deleted += remove_superseded_partitions(bucket_name, table_name, cutoff)
+            if merged or deleted:
+                summary[f'{bucket}/{table_name}'] = {'merged': merged, 'deleted': deleted}
+                logger.info(f'Compacted {bucket_name}/{table_name}: '
+                            f'{merged} days merged, {deleted} files deleted.')
+    return summary
+
+
+def _stash_conditional_headers(params, context, **kwargs):
+    for name, header in CONDITIONAL_HEADERS.items():
+        if name in params:
+            context.setdefault('conditional_headers', {})[header] = params.pop(name)
+
+
+def _add_conditional_headers(request, **kwargs):
+    for header, value in request.context.get('conditional_headers', {}).items():
+        request.headers[header] = value
+
+
+def get_checkpoint_client():
+    """Returns the S3 client shared by the lambda, creating it once.
+
+    The client's put_object accepts IfMatch and IfNoneMatch, which are sent
+    as the If-Match and If-None-Match headers S3 uses for conditional writes.
+
+    Returns:
+        boto3.client: An S3 client.
+    """
+    global _checkpoint_client
+    if _checkpoint_client is None:
+        client = boto3.client('s3')
+        client.meta.events.register(
+            'before-parameter-build.s3.PutObject', _stash_conditional_headers)
+        client.meta.events.register(
+            'before-sign.s3.PutObject', _add_conditional_headers)
+        _checkpoint_client = client
+    return _checkpoint_client
+
+
+def read_state(state_key):
+    """Reads the file names the next stage has already read.
+
+    Args:
+        state_key (str): processed_update.json or warehouse_update.json.
+
+    Returns:
+        dict: The newest file name read per table, empty if there is no
+        state file yet.
+    """
+    s3 = get_checkpoint_client()
+    try:
+        res = s3.get_object(Bucket=processed_bucket, Key=state_key)
+        return json.loads(res['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return {}
+        logger.error(f"An error occurred while retrieving {state_key} from S3: {e}")
+        raise e
+
+
+def read_checkpoint(bucket_name, table_name):
+    """Reads the checkpoint of a table.
+
+    Args:
+        bucket_name (str): The bucket holding the table's files.
+        table_name (str): The table name.
+
+    Returns:
+        dict: The checkpoint, or None if the table has no checkpoint yet.
+    """
+    s3 = get_checkpoint_client()
+    try:
+        res = s3.get_object(
+            Bucket=bucket_name, Key=f'{CHECKPOINT_PREFIX}/{table_name}.json')
+        return json.loads(res['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        logger.error(f'An error occurred while reading the {table_name} checkpoint: {e}')
+        raise e
+
+
+def closed_before(bucket_name, table_name, stored, today):
+    """Returns the first day of a table that must not be compacted.
+
+    Args:
+        bucket_name (str): The bucket holding the table's files.
+        table_name (str): The table name.
+        stored (str): The newest file name the next stage has read.
+        today (str): Today's date, 'YYYY-MM-DD'.
+
+    Returns:
+        str: A date; every earlier day is closed. None if the table has no
+        checkpoint or the next stage has not read any of it.
+    """
+    checkpoint = read_checkpoint(bucket_name, table_name)
+    if checkpoint is None or stored is None or stored == "null":
+        return None
+    return min(today, checkpoint['latest'][:10], stored[:10])
+
+
+def list_table_days(bucket_name, table_name):
+    """Lists the unpartitioned files of a table, grouped by day.
+
+    Args:
+        bucket_name (str): The bucket holding the table's files.
+        table_name (str): The table name, used as the key prefix.
+
+    Returns:
+        OrderedDict: Each day, 'YYYY-MM-DD', mapped to its keys and ETags,
+        oldest first.
+    """
+    s3 = get_checkpoint_client()
+    paginator = s3.get_paginator('list_objects_v2')
+    days = OrderedDict()
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=f'{table_name}/'):
+        for obj in page.get('Contents', []):
+            if '=' in obj['Key']:
+                continue
+            stem = obj['Key'].split('/')[-1].split('.')[0]
+            days.setdefault(stem[:10], []).append((stem, obj['Key'], obj['ETag']))
+    for files in days.values():
+        files.sort()
+    return days
+
+
+def merge_json_files(bodies, primary_key, order_column):
+    """Merges ingested JSON files, keeping the newest version of each row.
+
+    Rows are kept as they were written, so the merged file holds exactly
+    the values of the files it replaces. The timestamps are fixed width
+    strings, so comparing them as strings compares them in time.
+
+    Args:
+        bodies (list): The files' contents, oldest first.
+        primary_key (str): The table's primary key.
+        order_column (str): The column holding each row's version.
+
+    Returns:
+        str: The merged file, {"data": [...]}.
+    """
+    rows = OrderedDict()
+    for body in bodies:
+        for row in json.loads(body)['data']:
+            current = rows.get(row[primary_key])
+            if current is None or row[order_column] >= current[order_column]:
+                rows[row[primary_key]] = row
+    return json.dumps({'data': list(rows.values())})
+
+
+def merge_parquet_files(bodies, primary_key, order_column=None):
+    """Merges Parquet files, keeping the newest version of each row.
+
+    Without an order_column the row from the latest file wins.
+
+    Args:
+        bodies (list): The files' contents, oldest first.
+        primary_key (str): The table's primary key.
+        order_column (str): The column holding each row's version, if any.
+
+    Returns:
+        bytes: The merged Parquet file.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table = pa.concat_tables(
+        [pq.read_table(io.BytesIO(body)) for body in bodies], promote=True)
+    columns = [primary_key] + ([order_column] if order_column else [])
+    versions = table.select(columns).to_pandas()
+    if order_column:
+        versions = versions.sort_values(order_column, kind='stable')
+    keep = versions.drop_duplicates(primary_key, keep='last').index.sort_values()
+    out_buffer = io.BytesIO()
+    pq.write_table(table.take(pa.array(keep)), out_buffer, compression='zstd')
+    return out_buffer.getvalue()
+
+
+def compact_day(bucket_name, files, primary_key, order_column=None):
+    """Replaces the files of one day by a single merged file.
+
+    The merged file is written over the day's newest file, conditional on
+    the ETag it was listed with, and the other files are only deleted once
+    that write has succeeded. A reader listing the day in between sees the
+    merged rows twice, which every reader already deduplicates.
+
+    Args:
+        bucket_name (str): The bucket holding the table's files.
+        files (list): The day's (file name, key, ETag) tuples, oldest first.
+        primary_key (str): The table's primary key.
+        order_column (str): The column holding each row's version, if any.
+
+    Returns:
+        int: The number of files deleted, 0 if the day changed meanwhile.
+    """
+    s3 = get_checkpoint_client()
+    keys = [key for _, key, _ in files]
+    if len({key.split('.')[-1] for key in keys}) > 1:
+        logger.info(f'Skipping {keys[-1]}: the day mixes file formats.')
+        return 0
+    bodies = [s3.get_object(Bucket=bucket_name, Key=key)['Body'].read() for key in keys]
+    if keys[-1].endswith('.json'):
+        merged = merge_json_files(bodies, primary_key, order_column)
+    else:
+        merged = merge_parquet_files(bodies, primary_key, order_column)
+    try:
+        s3.put_object(Bucket=bucket_name, Key=keys[-1], Body=merged,
+                      IfMatch=files[-1][2])
+    except ClientError as e:
+        if e.response['Error']['Code'] in CHECKPOINT_CONFLICTS:
+            logger.info(f'{keys[-1]} changed while compacting, skipping.')
+            return 0
+        logger.error(f'An error occurred while writing {keys[-1]}: {e}')
+        raise e
+    return delete_keys(bucket_name, keys[:-1])
+
+
+def delete_keys(bucket_name, keys):
+    """Deletes keys in batches of 1000, the most one request accepts.
+
+    Args:
+        bucket_name (str): The bucket.
+        keys (list): The keys to delete.
+
+    Returns:
+        int: The number of keys deleted.
+    """
+    s3 = get_checkpoint_client()
+    for i in range(0, len(keys), 1000):
+        try:
+            s3.delete_objects(Bucket=bucket_name, Delete={
+                'Objects': [{'Key': key} for key in keys[i:i + 1000]], 'Quiet': True})
+        except ClientError as e:
+            logger.error(f'An error occurred while deleting from {bucket_name}: {e}')
+            raise e
+    return len(keys)
+
+
+def compact_table(bucket_name, table_name, primary_key, cutoff, order_column=None):
+    """Compacts every day of a table before cutoff that has several files.
+
+    Args:
+        bucket_name (str): The bucket holding the table's files.
+        table_name (str): The table name.
+        primary_key (str): The table's primary key.
+        cutoff (str): The first day that is not closed, 'YYYY-MM-DD'.
+        order_column (str): The column holding each row's version, if any.
+
+    Returns:
+        tuple: The number of days merged and of files deleted.
+    """
+    merged = deleted = 0
+    for day, files in list_table_days(bucket_name, table_name).items():
+        if day >= cutoff or len(files) < 2:
+            continue
+        removed = compact_day(bucket_name, files, primary_key, order_column)
+        if removed:
+            merged += 1
+            deleted += removed
+    return merged, deleted
+
+
+def remove_superseded_partitions(bucket_name, table_name, cutoff):
+    """Deletes partition files no longer listed in a fact table's manifest.
+
+    Only files written before cutoff are removed, so a reader that loaded
+    the previous manifest during the current day can still open its files.
+
+    Args:
+        bucket_name (str): The processed bucket.
+        table_name (str): A fact table.
+        cutoff (str): The first day that is not closed, 'YYYY-MM-DD'.
+
+    Returns:
+        int: The number of files deleted.
+    """
+    s3 = get_checkpoint_client()
+    try:
+        res = s3.get_object(Bucket=bucket_name, Key=f'{MANIFEST_PREFIX}/{table_name}.json')
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return 0
+        logger.error(f'An error occurred while reading the {table_name} manifest: {e}')
+        raise e
+    current = set(json.loads(res['Body'].read())['partitions'].values())
+    checkpoint = read_checkpoint(bucket_name, table_name) or {}
+    current.update(checkpoint.get('partitions', []))
+    superseded = []
+    paginator = s3.get_paginator('list_objects_v2')
+    prefix = f'{table_name}/{PARTITION_COLUMN}='
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            stem = obj['Key'].split('/')[-1].split('.')[0]
+            if obj['Key'] not in current and stem[:10] < cutoff:
+                superseded.append(obj['Key'])
+    return delete_keys(bucket_name, superseded)
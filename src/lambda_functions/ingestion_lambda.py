@@ -1,64 +1,266 @@
 import logging
 import boto3
 import pg8000.native
+from pg8000.native import identifier, literal
 from botocore.exceptions import ClientError
+import io
 import json
+import os
+import threading
 import time
+import uuid
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from decimal import Decimal
+from json.encoder import encode_basestring_ascii
 
 ingestion_bucket = "ingestion-bucket-1158020804995033"
 
+# The totesys tables to ingest, in the order they are extracted. Adding a
+# table only needs an entry here: its primary key, the column used as the
+# incremental watermark, the columns to select and, in minutes, how often
+# it is polled and the longest an adaptive schedule may leave it.
+TABLES = {
+    'counterparty': {
+        'primary_key': 'counterparty_id',
+        'watermark': 'last_updated',
+        'interval': 10,
+        'max_interval': 60,
+        'columns': ['counterparty_id', 'counterparty_legal_name',
+                    'legal_address_id', 'commercial_contact',
+                    'delivery_contact', 'created_at', 'last_updated']},
+    'address': {
+        'primary_key': 'address_id',
+        'watermark': 'last_updated',
+        'interval': 10,
+        'max_interval': 60,
+        'columns': ['address_id', 'address_line_1', 'address_line_2',
+                    'district', 'city', 'postal_code', 'country', 'phone',
+                    'created_at', 'last_updated']},
+    'currency': {
+        'primary_key': 'currency_id',
+        'watermark': 'last_updated',
+        'interval': 60,
+        'max_interval': 240,
+        'columns': ['currency_id', 'currency_code', 'created_at',
+                    'last_updated']},
+    'department': {
+        'primary_key': 'department_id',
+        'watermark': 'last_updated',
+        'interval': 60,
+        'max_interval': 240,
+        'columns': ['department_id', 'department_name', 'location', 'manager',
+                    'created_at', 'last_updated']},
+    'design': {
+        'primary_key': 'design_id',
+        'watermark': 'last_updated',
+        'interval': 10,
+        'max_interval': 60,
+        'columns': ['design_id', 'created_at', 'design_name', 'file_location',
+                    'file_name', 'last_updated']},
+    'payment': {
+        'primary_key': 'payment_id',
+        'watermark': 'last_updated',
+        'interval': 1,
+        'max_interval': 15,
+        'columns': ['payment_id', 'created_at', 'last_updated',
+                    'transaction_id', 'counterparty_id', 'payment_amount',
+                    'currency_id', 'payment_type_id', 'paid', 'payment_date',
+                    'company_ac_number', 'counterparty_ac_number']},
+    'payment_type': {
+        'primary_key': 'payment_type_id',
+        'watermark': 'last_updated',
+        'interval': 60,
+        'max_interval': 240,
+        'columns': ['payment_type_id', 'payment_type_name', 'created_at',
+                    'last_updated']},
+    'purchase_order': {
+        'primary_key': 'purchase_order_id',
+        'watermark': 'last_updated',
+        'interval': 1,
+        'max_interval': 15,
+        'columns': ['purchase_order_id', 'created_at', 'last_updated',
+                    'staff_id', 'counterparty_id', 'item_code',
+                    'item_quantity', 'item_unit_price', 'currency_id',
+                    'agreed_delivery_date', 'agreed_payment_date',
+                    'agreed_delivery_location_id']},
+    'sales_order': {
+        'primary_key': 'sales_order_id',
+        'watermark': 'last_updated',
+        'interval': 1,
+        'max_interval': 15,
+        'columns': ['sales_order_id', 'created_at', 'last_updated',
+                    'design_id', 'staff_id', 'counterparty_id', 'units_sold',
+                    'unit_price', 'currency_id', 'agreed_delivery_date',
+                    'agreed_payment_date', 'agreed_delivery_location_id']},
+    'staff': {
+        'primary_key': 'staff_id',
+        'watermark': 'last_updated',
+        'interval': 10,
+        'max_interval': 60,
+        'columns': ['staff_id', 'first_name', 'last_name', 'department_id',
+                    'email_address', 'created_at', 'last_updated']},
+    'transaction': {
+        'primary_key': 'transaction_id',
+        'watermark': 'last_updated',
+        'interval': 1,
+        'max_interval': 15,
+        'columns': ['transaction_id', 'transaction_type', 'sales_order_id',
+                    'purchase_order_id', 'created_at', 'last_updated']},
+}
+
+# Prepared statements per open connection, dropped with the connection.
+_prepared_statements = weakref.WeakKeyDictionary()
+_prepared_lock = threading.Lock()
+
+# With INGESTION_SNAPSHOT=true every connection of a run reads from one
+# exported snapshot, so all tables are extracted as of the same moment.
+# Connections inside such a transaction are mapped to the snapshot id.
+_snapshot_connections = weakref.WeakKeyDictionary()
+
+# Rows fetched per round trip when streaming, and the smallest part S3
+# accepts in a multipart upload (other than the last one).
+FETCH_SIZE = 10000
+MULTIPART_MIN_SIZE = 5 * 1024 * 1024
+
+# Each table's newest file is recorded in checkpoints/<table>.json, so the
+# watermark is one GET instead of a listing of the table's history. The
+# checkpoints are replaced with conditional writes.
+CHECKPOINT_PREFIX = 'checkpoints'
+CHECKPOINT_ATTEMPTS = 5
+CHECKPOINT_CONFLICTS = ('PreconditionFailed', 'ConditionalRequestConflict', '409', '412')
+CONDITIONAL_HEADERS = {'IfMatch': 'If-Match', 'IfNoneMatch': 'If-None-Match'}
+_checkpoint_client = None
+
+# Data files are created with IfNoneMatch. The listener, a scheduled run or
+# the CDC source can name a file after the same second, and the one that
+# loses moves on to the next second rather than replacing the other's rows.
+FILE_ATTEMPTS = 5
+
+# Every run that saves new rows ends by writing run_manifests/ingestion/
+# <run>.json, listing the newest key, row count and watermark of each
+# table. The processed lambda is started by that object and reads the keys
+# from it instead of listing the bucket.
+RUN_MANIFEST_PREFIX = 'run_manifests'
+
+# With INGESTION_SCHEDULE set, a table is only ingested once its next poll
+# is due, as recorded in SCHEDULE_KEY. 'fixed' polls each table at its
+# TABLES interval; 'adaptive' halves the interval after a poll that found
+# changes and doubles it after one that did not, between
+# SCHEDULE_MIN_INTERVAL and the table's max_interval. A poll due within
+# SCHEDULE_SLACK_SECONDS counts as due, so it is not put off a whole tick.
+SCHEDULE_KEY = 'schedules/ingestion.json'
+SCHEDULE_MIN_INTERVAL = 1
+SCHEDULE_SLACK_SECONDS = 30
+
+# With INGESTION_SOURCE=cdc, changes are read from the logical replication
+# slot CDC_SLOT through wal2json instead of by querying the tables, at most
+# CDC_MAX_CHANGES at a time. The commit LSN of the last transaction saved
+# is kept in CDC_CHECKPOINT before the slot is advanced to it. Only inserts
+# and updates are read (CDC_ACTIONS): as with polling, deleted rows keep
+# their last version in the data lake, since no later stage removes rows.
+CDC_SLOT = 'totesys_ingestion'
+CDC_PLUGIN = 'wal2json'
+CDC_MAX_CHANGES = 100000
+CDC_CHECKPOINT = f'{CHECKPOINT_PREFIX}/cdc.json'
+CDC_ACTIONS = 'insert,update'
+
+# A backfill extracts a whole table as primary key ranges of about
+# BACKFILL_RANGE_ROWS rows, one file per range. Its progress is kept in
+# backfills/<table>.json until every range is saved, so an invocation that
+# runs out of time is resumed by the next one. No new range is started
+# within BACKFILL_RESERVE_SECONDS of the Lambda timeout.
+BACKFILL_PREFIX = 'backfills'
+BACKFILL_RANGE_ROWS = 100000
+BACKFILL_RESERVE_SECONDS = 60
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
 def lambda_handler(event, context):
+    # {"rebuild_checkpoints": true} rebuilds every checkpoint from the keys
+    # already in the bucket without extracting anything.
+    if event and event.get('rebuild_checkpoints'):
+        for file_name in TABLES:
+            rebuild_checkpoint(ingestion_bucket, file_name)
+        return
+
     # Get secret
     secret_string = get_secret()
     tote = json.loads(secret_string)
-    user = tote["PGUSER"]
-    host = tote["PGURL"]
-    db = tote["PGDATABASE"]
-    port = tote["PGPORT"]
-    password = tote["PGPASSWORD"]
 
     s3 = boto3.client("s3")
+    workers = int(os.environ.get('INGESTION_WORKERS', 1))
+    snapshot = os.environ.get('INGESTION_SNAPSHOT', 'false').lower() == 'true'
+    probe = os.environ.get('INGESTION_PROBE', 'false').lower() == 'true'
+    scheduling = os.environ.get('INGESTION_SCHEDULE', '').lower()
+    source = os.environ.get('INGESTION_SOURCE', 'poll').lower()
+
+    # {"backfill": ["sales_order", ...]} starts a backfill of those tables,
+    # or resumes the ones already started, instead of an incremental run.
+    if event and event.get('backfill'):
+        if source == 'cdc':
+            raise ValueError('Backfills read the tables directly and cannot '
+                             'be combined with the cdc source')
+        deadline = None
+        if context is not None:
+            deadline = time.time() + context.get_remaining_time_in_millis() / 1000 \
+                - BACKFILL_RESERVE_SECONDS
+        try:
+            progress, timings = run_backfills(
+                tote, s3, event['backfill'], workers, deadline)
+            trigger_lambda_processed(timings)
+            return progress
+        except Exception as e:
+            logger.error(f'An Error occurred: {e}')
+            raise e
 
-    try:
-        file_func = {'counterparty': get_counterparty_data,
-                     'address': get_address_data,
-                     'currency': get_currency_util,
-                     'department': get_department_data,
-                     'design': get_design_data,
-                     'payment': get_payment_data,
-                     'payment_type': get_payment_type_data,
-                     'purchase_order': get_purchase_order_data,
-                     'sales_order': get_sales_order_util,
-                     'staff': get_staff_data,
-                     'transaction': get_transaction_data}
-
-        for file_name, data_func in file_func.items():
+    if source == 'cdc':
+        try:
             start_time = time.time()
-            last_updated = get_latest_file_date(ingestion_bucket, file_name)
-            data, max_last_updated = data_func(
-                user, host, db, port, password, last_updated)
-            if data['data']:
-                date_string = max_last_updated.strftime('%Y-%m-%d-%H-%M-%S')
-                filename = f"{file_name}/{date_string}.json"
-
-                json_data = json.dumps(data)
-                s3.put_object(Body=json_data,
-                              Bucket=ingestion_bucket, Key=filename)
-
-                end_time = time.time()
-                logger.info(f'{file_name} data saved to S3:\
-                        {end_time - start_time} seconds to execute.')
-            else:
-                end_time = time.time()
-                logger.info(f'{file_name} no new data in database:\
-                      {end_time - start_time} seconds to execute.')
-            if file_name == 'transaction':
-                trigger_lambda_processed()
+            conn = connect_to_totesys(tote)
+            try:
+                timings = ingest_changes(conn, s3)
+            finally:
+                conn.close()
+            log_timings(timings, time.time() - start_time)
+            trigger_lambda_processed(timings)
+            return
+        except Exception as e:
+            logger.error(f'An Error occurred: {e}')
+            raise e
+
+    try:
+        start_time = time.time()
+        # Tables being backfilled are left to the backfill until it ends.
+        backfilling = backfills_in_progress()
+        tables = [file_name for file_name in TABLES if file_name not in backfilling]
+        if scheduling:
+            now = datetime.utcnow()
+            schedule, schedule_etag = read_schedule()
+            tables = due_tables(schedule, tables, now)
+        if workers > 1:
+            timings = ingest_tables_parallel(tote, s3, workers, snapshot, tables, probe)
+        else:
+            conn = connect_to_totesys(tote)
+            try:
+                if snapshot:
+                    begin_snapshot(conn)
+                idle = {}
+                if probe:
+                    _, idle = probe_changed_tables(conn, tables)
+                timings = [idle[file_name] if file_name in idle
+                           else ingest_table(conn, s3, file_name)
+                           for file_name in tables]
+            finally:
+                conn.close()
+        log_timings(timings, time.time() - start_time)
+        trigger_lambda_processed(timings)
+        if scheduling:
+            save_schedule(schedule, schedule_etag, timings, now,
+                          scheduling == 'adaptive')
     except ClientError as e:
         logger.error(f'An S3 Error occurred: {e}')
         raise e
@@ -67,6 +269,789 @@ def lambda_handler(event, context):
         raise e
 
 
+def ingest_table(conn, s3, file_name):
+    """Extracts one totesys table and saves any new rows to S3.
+
+    Args:
+        conn (pg8000.native.Connection): An open connection to totesys.
+        s3 (boto3.client): An S3 client.
+        file_name (str): A key of TABLES, also used as the S3 prefix.
+
+    Returns:
+        dict: The table name, the number of rows saved and the seconds
+        spent fetching, uploading and in total, with the table's newest key
+        and its ETag, the watermark of the last row saved and the key the
+        table had before the run ('previous').
+    """
+    start_time = time.time()
+    checkpoint = get_checkpoint(ingestion_bucket, file_name)
+    previous = checkpoint['key'] if checkpoint else None
+    latest = checkpoint['latest'] if checkpoint else None
+    last_updated, last_id = checkpoint_position(checkpoint)
+    file_format = os.environ.get('INGESTION_FORMAT', 'json').lower()
+    streaming = os.environ.get('INGESTION_STREAMING', 'false').lower() == 'true'
+    if file_format == 'json' and streaming:
+        row_count, upload_time, written = stream_table_to_s3(
+            conn, s3, file_name, last_updated, last_id, latest)
+        end_time = time.time()
+        logger.info(f'{file_name} streamed {row_count} rows to S3:\
+                {end_time - start_time} seconds to execute.')
+        return {'table': file_name,
+                'rows': row_count,
+                'fetch': end_time - start_time - upload_time,
+                'upload': upload_time,
+                'total': end_time - start_time,
+                'previous': previous,
+                **(written or {'key': previous, 'etag': None, 'watermark': None})}
+
+    if file_format == 'parquet':
+        rows, max_last_updated = fetch_table_rows(
+            conn, file_name, last_updated, last_id)
+        row_count = len(rows)
+    else:
+        data, max_last_updated = get_table_data(
+            conn, file_name, last_updated, last_id)
+        rows = data['data']
+        row_count = len(rows)
+    fetched_time = time.time()
+    written = {'key': previous, 'etag': None, 'watermark': None}
+    if row_count:
+        keyset = row_keyset(rows[-1], file_name)
+        if file_format == 'parquet':
+            body = rows_to_parquet(rows, file_name)
+        else:
+            body = json.dumps(data)
+        filename, response = put_table_file(
+            file_name, next_file_date(max_last_updated, latest), file_format, body)
+        save_checkpoint(ingestion_bucket, file_name, filename, keyset)
+        written = {'key': filename, 'etag': response.get('ETag'),
+                   'watermark': keyset['watermark']}
+
+        end_time = time.time()
+        logger.info(f'{file_name} data saved to S3:\
+                {end_time - start_time} seconds to execute.')
+    else:
+        end_time = time.time()
+        logger.info(f'{file_name} no new data in database:\
+              {end_time - start_time} seconds to execute.')
+    return {'table': file_name,
+            'rows': row_count,
+            'fetch': fetched_time - start_time,
+            'upload': end_time - fetched_time,
+            'total': end_time - start_time,
+            'previous': previous,
+            **written}
+
+
+def ingest_tables_parallel(credentials, s3, workers, snapshot=False, tables=None,
+                           probe=False):
+    """Ingests every table in TABLES using a pool of worker threads.
+
+    Each worker opens its own connection the first time it picks up a
+    table and keeps it for the rest of the run. All connections are
+    closed once every table has finished, and the first error raised by
+    any table is re-raised.
+
+    With snapshot, a coordinating connection exports the snapshot of a
+    REPEATABLE READ transaction and every worker imports it before its
+    first query, so the tables are read as of one moment. The coordinator
+    keeps its transaction open until the workers are done.
+
+    With probe, the coordinator first checks every table for changes in
+    one query and only the tables that changed are handed to the workers.
+
+    Args:
+        credentials (dict): The decoded totesql secret.
+        s3 (boto3.client): An S3 client, shared by the workers.
+        workers (int): The maximum number of tables ingested at once.
+        snapshot (bool): Read every table from one exported snapshot.
+        tables (list): The tables to ingest, in order. None ingests all
+            of TABLES.
+        probe (bool): Skip the tables with no rows after their checkpoint.
+
+    Returns:
+        list: The timings returned by ingest_table, in TABLES order.
+    """
+    local = threading.local()
+    connections = []
+    lock = threading.Lock()
+    snapshot_id = None
+    tables = list(TABLES) if tables is None else tables
+    idle = {}
+
+    def worker(file_name):
+        if not hasattr(local, 'conn'):
+            local.conn = connect_to_totesys(credentials)
+            with lock:
+                connections.append(local.conn)
+            if snapshot_id is not None:
+                begin_snapshot(local.conn, snapshot_id)
+        return ingest_table(local.conn, s3, file_name)
+
+    try:
+        if snapshot or probe:
+            coordinator = connect_to_totesys(credentials)
+            connections.append(coordinator)
+            if snapshot:
+                snapshot_id = begin_snapshot(coordinator)
+            if probe:
+                _, idle = probe_changed_tables(coordinator, tables)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {file_name: executor.submit(worker, file_name)
+                       for file_name in tables if file_name not in idle}
+            return [idle[file_name] if file_name in idle
+                    else futures[file_name].result() for file_name in tables]
+    finally:
+        for conn in connections:
+            conn.close()
+
+
+def ingest_changes(conn, s3):
+    """Saves the changes decoded from the replication slot since the last run.
+
+    The first run creates the slot and then extracts every table
+    incrementally, so changes made before the slot existed are not missed.
+    Later runs peek at the slot, save the new and updated rows of each
+    table as one file, record the commit LSN of the last transaction saved
+    and only then advance the slot to it. A run that fails in between sees
+    the same changes again and skips the transactions up to the recorded LSN.
+
+    Args:
+        conn (pg8000.native.Connection): An open connection to totesys,
+            allowed to use replication slots.
+        s3 (boto3.client): An S3 client.
+
+    Returns:
+        list: The timings of each table with changes, as ingest_table
+        returns them.
+    """
+    try:
+        if not conn.run('SELECT 1 FROM pg_replication_slots WHERE slot_name = :slot;',
+                        slot=CDC_SLOT):
+            conn.run('SELECT pg_create_logical_replication_slot(:slot, :plugin);',
+                     slot=CDC_SLOT, plugin=CDC_PLUGIN)
+            logger.info(f'Created the {CDC_SLOT} replication slot.')
+            return [ingest_table(conn, s3, file_name) for file_name in TABLES]
+        start_time = time.time()
+        changes = conn.run(
+            "SELECT lsn::text, data FROM pg_logical_slot_peek_changes("
+            ":slot, NULL, :limit, 'format-version', '2', "
+            "'numeric-data-types-as-string', 'true', 'actions', :actions, "
+            "'add-tables', :tables);",
+            slot=CDC_SLOT, limit=int(os.environ.get('CDC_MAX_CHANGES', CDC_MAX_CHANGES)),
+            actions=CDC_ACTIONS,
+            tables=','.join(f'*.{file_name}' for file_name in TABLES))
+    except Exception as e:
+        logger.error(f'An error occurred while reading the {CDC_SLOT} slot: {e}')
+        raise e
+    if not changes:
+        return []
+
+    checkpoint, etag = read_cdc_checkpoint()
+    stored = checkpoint and checkpoint['lsn']
+    tables, last_lsn = decode_changes(changes, stored)
+    fetched_time = time.time()
+    timings = [save_changes(s3, file_name, upserts, fetched_time - start_time)
+               for file_name, upserts in tables.items()]
+
+    if last_lsn is None:
+        return timings
+    try:
+        if stored is None or lsn_value(last_lsn) > lsn_value(stored):
+            condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+            get_checkpoint_client().put_object(
+                Bucket=ingestion_bucket, Key=CDC_CHECKPOINT,
+                Body=json.dumps({'slot': CDC_SLOT, 'lsn': last_lsn}), **condition)
+        conn.run('SELECT pg_replication_slot_advance(:slot, CAST(:lsn AS pg_lsn));',
+                 slot=CDC_SLOT, lsn=last_lsn)
+    except Exception as e:
+        logger.error(f'An error occurred while confirming {CDC_SLOT} at {last_lsn}: {e}')
+        raise e
+    logger.info(f'Confirmed {CDC_SLOT} up to {last_lsn}.')
+    return timings
+
+
+def read_cdc_checkpoint():
+    """Reads the commit LSN the changes have been saved up to.
+
+    Returns:
+        tuple: The checkpoint dictionary and its ETag, or (None, None) if
+        no changes have been saved yet.
+    """
+    s3 = get_checkpoint_client()
+    try:
+        res = s3.get_object(Bucket=ingestion_bucket, Key=CDC_CHECKPOINT)
+        return json.loads(res['Body'].read()), res['ETag']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None, None
+        logger.error(f'An error occurred while reading {CDC_CHECKPOINT}: {e}')
+        raise e
+
+
+def lsn_value(lsn):
+    """Returns an LSN such as '16/B374D848' as an integer, for comparing."""
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def decode_changes(changes, stored=None):
+    """Groups wal2json changes by table, keeping each row's last change.
+
+    Transactions are decoded in commit order and only those committed
+    after stored are used, so changes saved before a failed run are not
+    saved twice. Deletes are not propagated, so any that are read are
+    ignored.
+
+    Args:
+        changes (list): The (lsn, data) rows peeked from the slot, with
+            data in wal2json format version 2.
+        stored (str): The commit LSN changes have been saved up to, or None.
+
+    Returns:
+        tuple: For each table, its new and updated rows in TABLES column
+        order, and the commit LSN of the last transaction read.
+    """
+    tables = {}
+    pending = []
+    last_lsn = None
+    for lsn, data in changes:
+        change = json.loads(data)
+        action = change['action']
+        if action == 'B':
+            pending = []
+        elif action == 'C':
+            last_lsn = lsn
+            if stored is None or lsn_value(lsn) > lsn_value(stored):
+                for table_name, primary_key, row in pending:
+                    tables.setdefault(table_name, {})[primary_key] = row
+        elif action in ('I', 'U') and change['table'] in TABLES:
+            table = TABLES[change['table']]
+            values = {c['name']: cdc_value(c) for c in change['columns']}
+            row = [values[name] for name in table['columns']]
+            pending.append((change['table'], values[table['primary_key']], row))
+    decoded = {}
+    for table_name, rows in tables.items():
+        table = TABLES[table_name]
+        watermark = table['columns'].index(table['watermark'])
+        primary_key = table['columns'].index(table['primary_key'])
+        decoded[table_name] = sorted(
+            rows.values(), key=lambda row: (row[watermark], row[primary_key]))
+    return decoded, last_lsn
+
+
+def cdc_value(column):
+    """Returns a wal2json column value as pg8000 would have returned it.
+
+    Timestamps become datetimes. Numeric values, which wal2json writes as
+    strings so no precision is lost, become Decimals, so rows_to_parquet
+    stores them as decimal128 just as it does polled rows.
+
+    Args:
+        column (dict): A wal2json column, with its name, type and value.
+
+    Returns:
+        The column's value.
+    """
+    value = column['value']
+    if value is None:
+        return value
+    if column['type'].startswith('numeric'):
+        return Decimal(value)
+    if not column['type'].startswith('timestamp'):
+        return value
+    seconds, _, fraction = value.partition('.')
+    return datetime.strptime(seconds, '%Y-%m-%d %H:%M:%S').replace(
+        microsecond=int(fraction.ljust(6, '0')) if fraction else 0)
+
+
+def save_changes(s3, file_name, upserts, fetch_time=0):
+    """Saves one table's decoded changes to S3.
+
+    New and updated rows are written in the same layout as an incremental
+    read, and move the table's checkpoint on to the new file without
+    changing the position a polling read would resume after.
+
+    Args:
+        s3 (boto3.client): An S3 client.
+        file_name (str): A key of TABLES.
+        upserts (list): The new and updated rows, in TABLES column order.
+        fetch_time (float): The seconds spent reading the changes.
+
+    Returns:
+        dict: The table's timings, as ingest_table returns them.
+    """
+    start_time = time.time()
+    checkpoint = get_checkpoint(ingestion_bucket, file_name)
+    previous = checkpoint['key'] if checkpoint else None
+    latest = checkpoint['latest'] if checkpoint else None
+    written = {'key': previous, 'etag': None, 'watermark': None}
+    file_format = os.environ.get('INGESTION_FORMAT', 'json').lower()
+    if upserts:
+        if file_format == 'parquet':
+            body = rows_to_parquet(upserts, file_name)
+        else:
+            body = encode_table_data(upserts, TABLES[file_name]['columns'])
+        key, response = put_table_file(
+            file_name, next_file_date(max_fetched_watermark(upserts, file_name), latest),
+            file_format, body)
+        save_checkpoint(ingestion_bucket, file_name, key)
+        written = {'key': key, 'etag': response.get('ETag'),
+                   'watermark': row_keyset(upserts[-1], file_name)['watermark']}
+    end_time = time.time()
+    logger.info(f'{file_name} saved {len(upserts)} changed rows.')
+    return {'table': file_name,
+            'rows': len(upserts),
+            'fetch': fetch_time,
+            'upload': end_time - start_time,
+            'total': fetch_time + end_time - start_time,
+            'previous': previous,
+            **written}
+
+
+def read_schedule():
+    """Reads when each table was last polled and how often it is polled.
+
+    Returns:
+        tuple: The schedule, mapping each table to its interval in minutes
+        and the time its next poll is due, and its ETag. An empty schedule
+        and None if none has been saved yet.
+    """
+    s3 = get_checkpoint_client()
+    try:
+        res = s3.get_object(Bucket=ingestion_bucket, Key=SCHEDULE_KEY)
+        return json.loads(res['Body'].read()), res['ETag']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return {}, None
+        logger.error(f'An error occurred while reading {SCHEDULE_KEY}: {e}')
+        raise e
+
+
+def due_tables(schedule, tables, now):
+    """Returns the tables whose next poll is due.
+
+    Args:
+        schedule (dict): The schedule read by read_schedule.
+        tables (list): Keys of TABLES, in order.
+        now (datetime): The time of the run.
+
+    Returns:
+        list: The tables never polled or due by now, in order.
+    """
+    cutoff = now + timedelta(seconds=SCHEDULE_SLACK_SECONDS)
+    due = [file_name for file_name in tables
+           if file_name not in schedule or datetime.strptime(
+               schedule[file_name]['next'], '%Y-%m-%d-%H-%M-%S') <= cutoff]
+    logger.info(f'{len(due)} of {len(tables)} tables are due to be polled.')
+    return due
+
+
+def save_schedule(schedule, etag, timings, now, adaptive=False):
+    """Sets the next poll of every table polled in this run and saves it.
+
+    The schedule is replaced with a conditional write against the ETag
+    that was read. If a concurrent run saved it first, this run's update
+    is dropped: its tables are then polled again at the next tick.
+
+    Args:
+        schedule (dict): The schedule read by read_schedule.
+        etag (str): Its ETag, or None if there was no schedule.
+        timings (list): The dictionaries returned by ingest_table.
+        now (datetime): The time of the run.
+        adaptive (bool): Adapt each interval to whether changes were found.
+
+    Returns:
+        dict: The schedule saved, or None if it changed while running.
+    """
+    for timing in timings:
+        table = TABLES[timing['table']]
+        interval = table['interval']
+        if adaptive and timing['table'] in schedule:
+            interval = schedule[timing['table']]['interval']
+            if timing['rows']:
+                interval = max(SCHEDULE_MIN_INTERVAL, interval // 2)
+            else:
+                interval = min(table['max_interval'], interval * 2)
+        schedule[timing['table']] = {
+            'interval': interval,
+            'next': (now + timedelta(minutes=interval)).strftime('%Y-%m-%d-%H-%M-%S')}
+    condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+    try:
+        get_checkpoint_client().put_object(
+            Bucket=ingestion_bucket, Key=SCHEDULE_KEY,
+            Body=json.dumps(schedule, sort_keys=True), **condition)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in CHECKPOINT_CONFLICTS:
+            logger.error(f'An error occurred while saving {SCHEDULE_KEY}: {e}')
+            raise e
+        logger.info(f'{SCHEDULE_KEY} changed while running, not updating it.')
+        return None
+    return schedule
+
+
+def probe_changed_tables(conn, tables):
+    """Finds the tables with rows after their checkpoint in one round trip.
+
+    Every table's count of rows after its checkpoint position, and their
+    newest watermark, are read by a single UNION ALL query, so a run where
+    most tables are idle does not query them one by one.
+
+    Args:
+        conn (pg8000.native.Connection): An open connection to totesys.
+        tables (list): Keys of TABLES to probe.
+
+    Returns:
+        tuple: The tables that changed, in order, and the timings of the
+        others, as ingest_table returns them for a table with no new rows.
+    """
+    checkpoints = {file_name: get_checkpoint(ingestion_bucket, file_name)
+                   for file_name in tables}
+    selects = []
+    params = {}
+    for index, file_name in enumerate(tables):
+        table = TABLES[file_name]
+        watermark = identifier(table['watermark'])
+        primary_key = identifier(table['primary_key'])
+        last_updated, last_id = checkpoint_position(checkpoints[file_name])
+        if last_updated is None:
+            where = ''
+        elif last_id is None:
+            where = f' WHERE {watermark} > :last_updated_{index}'
+            params[f'last_updated_{index}'] = last_updated
+        else:
+            where = (f' WHERE ({watermark}, {primary_key}) > '
+                     f'(:last_updated_{index}, :last_id_{index})')
+            params[f'last_updated_{index}'] = last_updated
+            params[f'last_id_{index}'] = last_id
+        selects.append(f'SELECT {literal(file_name)}, MAX({watermark}), COUNT(*) '
+                       f'FROM {identifier(file_name)}{where}')
+    try:
+        probed = conn.run(' UNION ALL '.join(selects) + ';', **params)
+    except Exception as e:
+        logger.error(f'An error occurred while probing the tables for changes: {e}')
+        raise e
+
+    changes = {file_name: (max_watermark, count)
+               for file_name, max_watermark, count in probed}
+    changed = []
+    idle = {}
+    for file_name in tables:
+        max_watermark, count = changes[file_name]
+        if count:
+            logger.info(f'{file_name} has {count} changed rows up to {max_watermark}.')
+            changed.append(file_name)
+            continue
+        previous = checkpoints[file_name] and checkpoints[file_name]['key']
+        idle[file_name] = {'table': file_name, 'rows': 0,
+                           'fetch': 0, 'upload': 0, 'total': 0,
+                           'previous': previous, 'key': previous,
+                           'etag': None, 'watermark': None}
+    logger.info(f'{len(idle)} of {len(tables)} tables have no changes.')
+    return changed, idle
+
+
+def run_backfills(credentials, s3, tables, workers, deadline=None):
+    """Extracts whole tables as primary key ranges, resuming earlier runs.
+
+    A table without a backfill in progress is planned first. The pending
+    ranges of every table are then extracted by a pool of worker threads,
+    each with its own connection, and every range saved is recorded in the
+    table's backfill state at once. Ranges not started by the deadline are
+    left for the next invocation. A table whose ranges are all saved gets
+    its checkpoint and its backfill state is removed.
+
+    Args:
+        credentials (dict): The decoded totesql secret.
+        s3 (boto3.client): An S3 client, shared by the workers.
+        tables (list): Keys of TABLES to backfill.
+        workers (int): The maximum number of ranges extracted at once.
+        deadline (float): The time.time() after which no range is started,
+            or None for no limit.
+
+    Returns:
+        tuple: The progress of each table, as the number of ranges saved
+        and planned, and the manifest entries of the tables completed.
+    """
+    local = threading.local()
+    connections = []
+    lock = threading.Lock()
+    states = {}
+
+    def worker(table_name, index):
+        if deadline is not None and time.time() > deadline:
+            return
+        if not hasattr(local, 'conn'):
+            local.conn = connect_to_totesys(credentials)
+            with lock:
+                connections.append(local.conn)
+        chunk = extract_backfill_range(local.conn, s3, states[table_name], index)
+        with lock:
+            record_backfill_chunk(states[table_name], index, chunk)
+
+    try:
+        conn = connect_to_totesys(credentials)
+        connections.append(conn)
+        for table_name in tables:
+            state, etag = read_backfill(table_name)
+            if state is None:
+                state, etag = start_backfill(conn, table_name)
+            states[table_name] = dict(state, etag=etag)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(worker, table_name, index)
+                       for table_name, state in states.items()
+                       for index in range(len(state['ranges']))
+                       if str(index) not in state['chunks']]
+            for future in futures:
+                future.result()
+    finally:
+        for conn in connections:
+            conn.close()
+
+    progress = {}
+    timings = []
+    for table_name, state in states.items():
+        progress[table_name] = {'done': len(state['chunks']),
+                                'ranges': len(state['ranges'])}
+        if len(state['chunks']) == len(state['ranges']):
+            timing = finish_backfill(state)
+            if timing is not None:
+                timings.append(timing)
+        else:
+            logger.info(f"{table_name} backfill stopped after "
+                        f"{len(state['chunks'])} of {len(state['ranges'])} "
+                        'ranges, invoke it again to resume.')
+    return progress, timings
+
+
+def backfills_in_progress():
+    """Returns the tables with a backfill that has not finished."""
+    s3 = get_checkpoint_client()
+    tables = set()
+    for page in s3.get_paginator('list_objects_v2').paginate(
+            Bucket=ingestion_bucket, Prefix=f'{BACKFILL_PREFIX}/'):
+        for obj in page.get('Contents', []):
+            tables.add(obj['Key'].split('/')[-1].rsplit('.', 1)[0])
+    return tables
+
+
+def read_backfill(table_name):
+    """Reads the backfill state of a table.
+
+    Args:
+        table_name (str): A key of TABLES.
+
+    Returns:
+        tuple: The state dictionary and its ETag, or (None, None) if the
+        table has no backfill in progress.
+    """
+    s3 = get_checkpoint_client()
+    try:
+        res = s3.get_object(Bucket=ingestion_bucket,
+                            Key=f'{BACKFILL_PREFIX}/{table_name}.json')
+        return json.loads(res['Body'].read()), res['ETag']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None, None
+        logger.error(f'An error occurred while reading the {table_name} backfill: {e}')
+        raise e
+
+
+def plan_backfill_ranges(conn, table_name):
+    """Splits a table into primary key ranges of about BACKFILL_RANGE_ROWS rows.
+
+    The row count is the planner's estimate from pg_class, so no table is
+    scanned to count it. A table that has never been analysed is planned
+    from the width of its primary key range instead.
+
+    Args:
+        conn (pg8000.native.Connection): An open connection to totesys.
+        table_name (str): A key of TABLES.
+
+    Returns:
+        tuple: The [low, high] ranges, inclusive, and the table's newest
+        watermark. Both are empty for an empty table.
+    """
+    table = TABLES[table_name]
+    primary_key = identifier(table['primary_key'])
+    bounds_query = prepare_statement(
+        conn, f'SELECT MIN({primary_key}), MAX({primary_key}), '
+              f'MAX({identifier(table["watermark"])}) FROM {identifier(table_name)};')
+    low, high, max_watermark = bounds_query.run()[0]
+    if low is None:
+        return [], None
+    estimate_query = prepare_statement(
+        conn, 'SELECT reltuples FROM pg_class WHERE oid = CAST(:table_name AS regclass);')
+    estimate = estimate_query.run(table_name=identifier(table_name))[0][0]
+    width = high - low + 1
+    if estimate is None or estimate <= 0:
+        estimate = width
+    range_rows = int(os.environ.get('INGESTION_BACKFILL_ROWS', BACKFILL_RANGE_ROWS))
+    count = max(1, min(width, -(-int(estimate) // range_rows)))
+    step = -(-width // count)
+    ranges = [[start, min(start + step - 1, high)]
+              for start in range(low, high + 1, step)]
+    return ranges, max_watermark
+
+
+def start_backfill(conn, table_name):
+    """Plans the backfill of a table and saves its state.
+
+    The files are named a second apart, after the table's newest file, so
+    they sort after it and in range order. The watermark recorded is the
+    newest when the backfill started: rows changed while it runs are read
+    again by the first incremental run after it.
+
+    Args:
+        conn (pg8000.native.Connection): An open connection to totesys.
+        table_name (str): A key of TABLES.
+
+    Returns:
+        tuple: The state saved and its ETag.
+    """
+    checkpoint = get_checkpoint(ingestion_bucket, table_name)
+    ranges, max_watermark = plan_backfill_ranges(conn, table_name)
+    first = datetime.utcnow().replace(microsecond=0)
+    if max_watermark is not None:
+        first = max_watermark.replace(microsecond=0) + timedelta(seconds=1)
+    state = {'table': table_name,
+             'format': os.environ.get('INGESTION_FORMAT', 'json').lower(),
+             'first': next_file_date(
+                 first, checkpoint and checkpoint['latest']).strftime('%Y-%m-%d-%H-%M-%S'),
+             'watermark': max_watermark and max_watermark.isoformat(timespec='microseconds'),
+             'previous': checkpoint['key'] if checkpoint else None,
+             'ranges': ranges,
+             'chunks': {}}
+    key = f'{BACKFILL_PREFIX}/{table_name}.json'
+    try:
+        res = get_checkpoint_client().put_object(
+            Bucket=ingestion_bucket, Key=key, Body=json.dumps(state), IfNoneMatch='*')
+    except ClientError as e:
+        logger.error(f'An error occurred while starting the {table_name} backfill: {e}')
+        raise e
+    logger.info(f'{table_name} backfill planned as {len(ranges)} ranges.')
+    return state, res['ETag']
+
+
+def extract_backfill_range(conn, s3, state, index):
+    """Extracts one primary key range of a backfill to its own file.
+
+    Args:
+        conn (pg8000.native.Connection): An open connection to totesys.
+        s3 (boto3.client): An S3 client.
+        state (dict): The table's backfill state.
+        index (int): The position of the range in state['ranges'].
+
+    Returns:
+        dict: The key and ETag of the file and the rows saved. The key is
+        None if the range has no rows.
+    """
+    table_name = state['table']
+    table = TABLES[table_name]
+    columns = ', '.join(identifier(c) for c in table['columns'])
+    primary_key = identifier(table['primary_key'])
+    low, high = state['ranges'][index]
+    try:
+        range_query = prepare_statement(
+            conn, f'SELECT {columns} FROM {identifier(table_name)} '
+                  f'WHERE {primary_key} BETWEEN :low AND :high ORDER BY {primary_key};')
+        rows = range_query.run(low=low, high=high)
+    except Exception as e:
+        logger.error(
+            f'An error occurred while executing the SQL query for {table_name}: {e}')
+        raise e
+    if not rows:
+        return {'key': None, 'etag': None, 'rows': 0}
+    file_date = datetime.strptime(state['first'], '%Y-%m-%d-%H-%M-%S') + \
+        timedelta(seconds=index)
+    key = f"{table_name}/{file_date.strftime('%Y-%m-%d-%H-%M-%S')}.{state['format']}"
+    if state['format'] == 'parquet':
+        body = rows_to_parquet(rows, table_name)
+    else:
+        body = encode_table_data(rows, table['columns'])
+    response = s3.put_object(Body=body, Bucket=ingestion_bucket, Key=key)
+    return {'key': key, 'etag': response.get('ETag'), 'rows': len(rows)}
+
+
+def record_backfill_chunk(state, index, chunk):
+    """Records a saved range in the table's backfill state.
+
+    The state is replaced with a conditional write against the ETag this
+    run last wrote, so a second backfill of the same table fails rather
+    than losing ranges.
+
+    Args:
+        state (dict): The table's backfill state, with its ETag.
+        index (int): The position of the range in state['ranges'].
+        chunk (dict): The file saved for the range.
+    """
+    state['chunks'][str(index)] = chunk
+    body = {name: value for name, value in state.items() if name != 'etag'}
+    try:
+        res = get_checkpoint_client().put_object(
+            Bucket=ingestion_bucket, Key=f"{BACKFILL_PREFIX}/{state['table']}.json",
+            Body=json.dumps(body), IfMatch=state['etag'])
+    except ClientError as e:
+        logger.error(f"An error occurred while saving the {state['table']} backfill: {e}")
+        raise e
+    state['etag'] = res['ETag']
+
+
+def finish_backfill(state):
+    """Checkpoints a table whose ranges are all saved and ends its backfill.
+
+    The checkpoint resumes incremental reads after the watermark the
+    backfill started at. The run manifest entry names the last file, and
+    as previous the file before it, so the processed lambda lists the
+    table's other new files.
+
+    Args:
+        state (dict): The table's backfill state.
+
+    Returns:
+        dict: The table's run manifest entry, or None if the table was
+        empty.
+    """
+    table_name = state['table']
+    chunks = [state['chunks'][str(index)] for index in range(len(state['ranges']))]
+    keys = [chunk for chunk in chunks if chunk['key']]
+    timing = None
+    if keys:
+        save_checkpoint(ingestion_bucket, table_name, keys[-1]['key'],
+                        {'watermark': state['watermark'], 'id': None})
+        timing = {'table': table_name,
+                  'rows': sum(chunk['rows'] for chunk in keys),
+                  'key': keys[-1]['key'],
+                  'etag': keys[-1]['etag'],
+                  'watermark': state['watermark'],
+                  'previous': keys[-2]['key'] if len(keys) > 1 else state['previous']}
+    try:
+        get_checkpoint_client().delete_object(
+            Bucket=ingestion_bucket, Key=f'{BACKFILL_PREFIX}/{table_name}.json')
+    except ClientError as e:
+        logger.error(f'An error occurred while ending the {table_name} backfill: {e}')
+        raise e
+    logger.info(f'{table_name} backfill finished in {len(keys)} files.')
+    return timing
+
+
+def log_timings(timings, elapsed):
+    """Logs the per-table timing breakdown of an ingestion run.
+
+    Args:
+        timings (list): The dictionaries returned by ingest_table.
+        elapsed (float): The wall time of the whole run in seconds.
+    """
+    for timing in sorted(timings, key=lambda t: t['total'], reverse=True):
+        logger.info(f"{timing['table']}: {timing['rows']} rows, "
+                    f"fetch {timing['fetch']:.3f}s, "
+                    f"upload {timing['upload']:.3f}s, "
+                    f"total {timing['total']:.3f}s")
+    busy = sum(timing['total'] for timing in timings)
+    logger.info(f'Ingested {len(timings)} tables in {elapsed:.3f}s '
+                f'({busy:.3f}s of table work).')
+
+
 def get_secret():
 
     secret_name = "totesql"
@@ -89,619 +1074,835 @@ def get_secret():
     return secret
 
 
-def trigger_lambda_processed():
-    s3 = boto3.client('s3')
+def new_run_id():
+    """Returns a unique id for a run manifest, sortable by time.
+
+    The time is given to the microsecond and followed by a random suffix,
+    so runs finishing in the same second still write different manifests.
+
+    Returns:
+        str: The id, e.g. '2022-11-03-14-20-49-123456-1f2e3d4c'.
+    """
+    return f"{datetime.utcnow().strftime('%Y-%m-%d-%H-%M-%S-%f')}-{uuid.uuid4().hex[:8]}"
+
+
+def trigger_lambda_processed(timings):
+    """Starts the processed lambda by writing the run's manifest.
+
+    The manifest lists every table that has been saved at least once: its
+    newest key and ETag, the rows and watermark saved by this run and the
+    key it had before the run, so the processed lambda can tell whether
+    the manifests it reads cover every file it has not processed yet. It
+    is written once all files and checkpoints are in place and never
+    overwritten. Runs that saved nothing write no manifest.
+
+    Args:
+        timings (list): The dictionaries returned by ingest_table.
+
+    Returns:
+        str: The manifest's key, or None if no rows were saved.
+    """
+    if not any(timing['rows'] for timing in timings):
+        logger.info('No new rows, the processed lambda is not triggered.')
+        return None
+    run_id = new_run_id()
+    manifest = {'stage': 'ingestion', 'run_id': run_id, 'bucket': ingestion_bucket,
+                'tables': {timing['table']: {'key': timing['key'],
+                                             'etag': timing['etag'],
+                                             'rows': timing['rows'],
+                                             'watermark': timing['watermark'],
+                                             'previous': timing['previous']}
+                           for timing in timings if timing['key']}}
+    key = f'{RUN_MANIFEST_PREFIX}/ingestion/{run_id}.json'
     try:
-        res = s3.get_object(
-            Bucket="ingestion-bucket-1158020804995033", Key='processed_trigger.txt')
-        data = res['Body'].read().decode('utf-8')
-        s3.put_object(Bucket="ingestion-bucket-1158020804995033",
-                      Key='processed_trigger.txt', Body=data)
-        print('\nlambda 2 trigger........\n')
+        get_checkpoint_client().put_object(
+            Bucket=ingestion_bucket, Key=key,
+            Body=json.dumps(manifest, sort_keys=True), IfNoneMatch='*')
     except ClientError as e:
-        logger.error(
-            f"An error occurred while retrieving processed_trigger.txt from S3: {e}")
-        raise e
-    except Exception as e:
-        logger.error(f"An error occurred: {e}")
+        logger.error(f"An error occurred while writing {key}: {e}")
         raise e
+    logger.info(f'Wrote {key}.')
+    return key
 
 
 def get_latest_file_date(bucket_name, prefix):
+    """Returns the date of the newest file saved for a table.
 
-    s3 = boto3.client('s3')
-    response = s3.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
-    dates = []
-    for obj in response.get('Contents', []):
-        key = obj['Key']
-        date_string = key.split('/')[-1].split('.')[0]
-        date = datetime.strptime(date_string, '%Y-%m-%d-%H-%M-%S')
-        dates.append(date)
-
-    if dates:
-        latest_date = max(dates)
-        return latest_date
-    else:
+    Args:
+        bucket_name (str): The ingestion bucket.
+        prefix (str): The table name.
+
+    Returns:
+        datetime: The date in the newest file name, or None if the table
+        has never been saved.
+    """
+    checkpoint = get_checkpoint(bucket_name, prefix)
+    if checkpoint is None:
         return None
+    return datetime.strptime(checkpoint['latest'], '%Y-%m-%d-%H-%M-%S')
 
 
-def format_to_dict(rows, column_titles):
-    """Formats rows of data into a dictionary.
+def _stash_conditional_headers(params, context, **kwargs):
+    for name, header in CONDITIONAL_HEADERS.items():
+        if name in params:
+            context.setdefault('conditional_headers', {})[header] = params.pop(name)
+
+
+def _add_conditional_headers(request, **kwargs):
+    for header, value in request.context.get('conditional_headers', {}).items():
+        request.headers[header] = value
+
+
+def get_checkpoint_client():
+    """Returns the S3 client used for checkpoints, creating it once.
+
+    The client's put_object and complete_multipart_upload accept IfMatch
+    and IfNoneMatch, which are sent as the If-Match and If-None-Match
+    headers S3 uses for conditional writes.
+
+    Returns:
+        boto3.client: An S3 client.
+    """
+    global _checkpoint_client
+    if _checkpoint_client is None:
+        client = boto3.client('s3')
+        for operation in ('PutObject', 'CompleteMultipartUpload'):
+            client.meta.events.register(
+                f'before-parameter-build.s3.{operation}', _stash_conditional_headers)
+            client.meta.events.register(
+                f'before-sign.s3.{operation}', _add_conditional_headers)
+        _checkpoint_client = client
+    return _checkpoint_client
 
-    This function takes in rows of data and their corresponding
-    column titles and formats them into a dictionary.
-    The resulting dictionary has keys that correspond to the column
-    titles and values that correspond to the data in the rows.
-    The function also converts certain values to strings and
-    formats datetime objects.
+
+def read_checkpoint(bucket_name, table_name):
+    """Reads the checkpoint of a table.
 
     Args:
-        rows (list): A list of rows of data.
-        column_titles (list): A list of column titles.
+        bucket_name (str): The bucket holding the table's files.
+        table_name (str): The table name.
 
     Returns:
-        dict: A dictionary containing the formatted data.
+        tuple: The checkpoint dictionary and its ETag, or (None, None) if
+        the table has no checkpoint yet.
     """
+    s3 = get_checkpoint_client()
     try:
-        data = []
-
-        for element in rows:
-            row = {}
-            i = 0
-            for name in column_titles:
-                row[name] = element[i]
-                i += 1
-
-            data.append(row)
-
-        for element in data:
-            if 'unit_price' in element:
-                element['unit_price'] = str(element['unit_price'])
-            elif 'payment_amount' in element:
-                element['payment_amount'] = str(element['payment_amount'])
-            elif 'item_unit_price' in element:
-                element['item_unit_price'] = str(element['item_unit_price'])
-            time1 = element['created_at']
-            element['created_at'] = time1.strftime("%Y-%m-%d, %X:%f")
-            time2 = element['last_updated']
-            element['last_updated'] = time2.strftime("%Y-%m-%d, %X:%f")
-
-        return {'data': data}
-    except Exception as e:
-        logger.error(f"format_to_dict: An error occurred: {e}")
+        res = s3.get_object(
+            Bucket=bucket_name, Key=f'{CHECKPOINT_PREFIX}/{table_name}.json')
+        return json.loads(res['Body'].read()), res['ETag']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None, None
+        logger.error(f'An error occurred while reading the {table_name} checkpoint: {e}')
+        raise e
 
 
-def get_counterparty_data(user, host, db, port, password, last_updated=None):
-    """Retrieves counterparty data from a database.
+def find_latest_file(bucket_name, table_name):
+    """Finds the newest file of a table by listing all of its keys.
 
-    This function connects to a database using the provided
-    parameters and retrieves counterparty data from the
-    'counterparty' table. The data is then formatted into
-    a dictionary and returned.
+    Args:
+        bucket_name (str): The bucket holding the table's files.
+        table_name (str): The table name, used as the key prefix.
 
+    Returns:
+        dict: A checkpoint for the newest file, or None if there are none.
+    """
+    s3 = get_checkpoint_client()
+    paginator = s3.get_paginator('list_objects_v2')
+    newest = None
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=f'{table_name}/'):
+        for obj in page.get('Contents', []):
+            latest = obj['Key'].split('/')[-1].split('.')[0]
+            date = datetime.strptime(latest, '%Y-%m-%d-%H-%M-%S')
+            if newest is None or date > newest[0]:
+                newest = (date, obj['Key'], latest)
+    if newest is None:
+        return None
+    return {'table': table_name, 'key': newest[1], 'latest': newest[2]}
+
+
+def put_table_file(table_name, file_date, file_format, body):
+    """Writes a new data file for a table without replacing an existing one.
+
+    The file is named after file_date. If another writer has already
+    created that key, the file is named after the next second instead.
 
     Args:
-        user (str): The username for the database connection.
-        host (str): The hostname for the database connection.
-        db (str): The name of the database to connect to.
-        port (int): The port number for the database connection.
-        password (str): The password for the database connection.
-        last_updated (str): The minimum value for the last_updated column.
+        table_name (str): A key of TABLES, also used as the S3 prefix.
+        file_date (datetime): The date to name the file after.
+        file_format (str): The file extension, 'json' or 'parquet'.
+        body (bytes): The file contents.
 
     Returns:
-
-        tuple: A tuple containing a dictionary with the counterparty data and a string with the maximum value of the last_updated column.
+        tuple: The key written and the put_object response.
     """
-    # conn = None
-    try:
-        conn = pg8000.native.Connection(
-            user, host=host, database=db, port=port, password=password)
+    s3 = get_checkpoint_client()
+    for attempt in range(FILE_ATTEMPTS):
+        date_string = (file_date + timedelta(seconds=attempt)).strftime('%Y-%m-%d-%H-%M-%S')
+        key = f'{table_name}/{date_string}.{file_format}'
+        try:
+            return key, s3.put_object(Body=body, Bucket=ingestion_bucket, Key=key,
+                                      IfNoneMatch='*')
+        except ClientError as e:
+            if e.response['Error']['Code'] not in CHECKPOINT_CONFLICTS:
+                logger.error(f'An error occurred while writing {key}: {e}')
+                raise e
+            logger.info(f'{key} was written by another run, trying the next second.')
+    raise RuntimeError(
+        f'Could not write a new {table_name} file after {FILE_ATTEMPTS} attempts')
+
+
+def save_checkpoint(bucket_name, table_name, key, keyset=None):
+    """Records key as the newest file of a table.
+
+    The checkpoint is replaced with a conditional write against the ETag
+    that was read, so concurrent writers cannot overwrite each other. On a
+    conflict the checkpoint is read again and the write retried. A
+    checkpoint never moves back to an older file.
+
+    Args:
+        bucket_name (str): The bucket holding the table's files.
+        table_name (str): The table name.
+        key (str): The key of the file just written.
+        keyset (dict): The keyset of the last row in the file, as
+            row_keyset returns it. The next run reads the rows after it.
+            None keeps the position the current checkpoint reads after,
+            for files that are not a contiguous read of the table.
 
+    Returns:
+        dict: The checkpoint as stored.
+    """
+    s3 = get_checkpoint_client()
+    latest = key.split('/')[-1].split('.')[0]
+    checkpoint = {'table': table_name, 'key': key, 'latest': latest}
+    if keyset is not None:
+        checkpoint['keyset'] = keyset
+    for attempt in range(CHECKPOINT_ATTEMPTS):
+        current, etag = read_checkpoint(bucket_name, table_name)
+        if current is not None and datetime.strptime(
+                current['latest'], '%Y-%m-%d-%H-%M-%S') >= datetime.strptime(
+                latest, '%Y-%m-%d-%H-%M-%S'):
+            return current
+        if keyset is None and current is not None:
+            last_updated, last_id = checkpoint_position(current)
+            checkpoint['keyset'] = {
+                'watermark': last_updated.isoformat(timespec='microseconds'),
+                'id': last_id}
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
         try:
-            if last_updated is None:
-                data_query = '''SELECT * FROM counterparty ORDER BY last_updated;'''
-            else:
-                data_query = f'''SELECT * FROM counterparty WHERE last_updated > '{last_updated}' ORDER BY last_updated;'''
+            s3.put_object(Bucket=bucket_name,
+                          Key=f'{CHECKPOINT_PREFIX}/{table_name}.json',
+                          Body=json.dumps(checkpoint), **condition)
+            return checkpoint
+        except ClientError as e:
+            if e.response['Error']['Code'] not in CHECKPOINT_CONFLICTS:
+                logger.error(
+                    f'An error occurred while saving the {table_name} checkpoint: {e}')
+                raise e
+            logger.info(f'{table_name} checkpoint changed while saving, retrying.')
+    raise RuntimeError(
+        f'Could not save the {table_name} checkpoint after {CHECKPOINT_ATTEMPTS} attempts')
+
+
+def rebuild_checkpoint(bucket_name, table_name):
+    """Rebuilds the checkpoint of a table from the keys already in S3.
 
-            rows = conn.run(data_query)
-            columns = conn.columns
-            column_titles = [c['name'] for c in columns]
-            counterparty_data = format_to_dict(rows, column_titles)
+    Args:
+        bucket_name (str): The bucket holding the table's files.
+        table_name (str): The table name.
 
-            max_query = '''SELECT MAX(last_updated) FROM counterparty;'''
-            max_last_updated = conn.run(max_query)[0][0]
-            max_last_updated += timedelta(seconds=1)
-            max_last_updated = max_last_updated.replace(microsecond=0)
+    Returns:
+        dict: The rebuilt checkpoint, or None if the table has no files.
+    """
+    newest = find_latest_file(bucket_name, table_name)
+    if newest is None:
+        return None
+    logger.info(f'Rebuilding the {table_name} checkpoint from {newest["key"]}.')
+    return save_checkpoint(bucket_name, table_name, newest['key'])
 
-            return counterparty_data, max_last_updated
-        except Exception as e:
-            logger.error(
-                f'An error occurred while executing the SQL query: {e}')
-    except Exception as e:
-        logger.error(
-            f'An error occurred while connecting to the database: {e}')
-    finally:
-        conn.close()
 
+def get_checkpoint(bucket_name, table_name):
+    """Returns the checkpoint of a table, rebuilding it if it is missing.
 
-def get_address_data(user, host, db, port, password, last_updated=None):
-    """Retrieves address data from a database.
+    Args:
+        bucket_name (str): The bucket holding the table's files.
+        table_name (str): The table name.
+
+    Returns:
+        dict: The checkpoint, or None if the table has no files.
+    """
+    checkpoint, _ = read_checkpoint(bucket_name, table_name)
+    if checkpoint is None:
+        checkpoint = rebuild_checkpoint(bucket_name, table_name)
+    return checkpoint
 
-    This function connects to a database using the provided parameters
-    and retrieves address data from the 'address' table. The data is
-    then formatted into a dictionary and returned.
+
+def checkpoint_position(checkpoint):
+    """Returns where the next incremental read of a table starts.
+
+    A checkpoint with a keyset resumes after the exact (watermark, primary
+    key) of the last row saved. Checkpoints written before keysets were
+    recorded, or rebuilt from the file names, only have the whole second
+    the newest file is named after, and resume after that.
 
     Args:
-        user (str): The username for the database connection.
-        host (str): The hostname for the database connection.
-        db (str): The name of the database to connect to.
-        port (int): The port number for the database connection.
-        password (str): The password for the database connection.
-        last_updated (str): The minimum value for the last_updated column.
+        checkpoint (dict): The table's checkpoint, or None.
 
     Returns:
-        tuple: A tuple containing a dictionary with the address data and a string with the maximum value of the last_updated column.
+        tuple: The watermark and the primary key to read after. Both are
+        None for a table with no checkpoint, and the primary key is None
+        for a checkpoint without a keyset or left by a backfill, which
+        resumes after the watermark alone.
     """
-    try:
-        conn = pg8000.native.Connection(
-            user, host=host, database=db, port=port, password=password)
+    if checkpoint is None:
+        return None, None
+    keyset = checkpoint.get('keyset')
+    if keyset is None:
+        return datetime.strptime(checkpoint['latest'], '%Y-%m-%d-%H-%M-%S'), None
+    return datetime.fromisoformat(keyset['watermark']), keyset['id']
 
-        try:
-            if last_updated is None:
-                data_query = '''SELECT * FROM address ORDER BY last_updated;'''
-            else:
-                data_query = f'''SELECT * FROM address WHERE last_updated > '{last_updated}' ORDER BY last_updated;'''
 
-            rows = conn.run(data_query)
-            columns = conn.columns
-            column_titles = [c['name'] for c in columns]
-            address_data = format_to_dict(rows, column_titles)
+def row_keyset(row, table_name):
+    """Returns the keyset of a row: its exact watermark and its primary key.
 
-            max_query = '''SELECT MAX(last_updated) FROM address;'''
-            max_last_updated = conn.run(max_query)[0][0]
-            max_last_updated += timedelta(seconds=1)
-            max_last_updated = max_last_updated.replace(microsecond=0)
+    Args:
+        row (list or dict): A row with values in TABLES column order, or a
+            row as format_to_dict returns it.
+        table_name (str): A key of TABLES.
 
-            return address_data, max_last_updated
-        except Exception as e:
-            logger.error(
-                f'An error occurred while executing the SQL query: {e}')
-    except Exception as e:
-        logger.error(
-            f'An error occurred while connecting to the database: {e}')
-    finally:
-        conn.close()
+    Returns:
+        dict: The watermark as an ISO 8601 string with microseconds and the
+        primary key value.
+    """
+    table = TABLES[table_name]
+    if isinstance(row, dict):
+        last_updated = datetime.strptime(
+            row[table['watermark']], '%Y-%m-%d, %H:%M:%S:%f')
+        primary_key = row[table['primary_key']]
+    else:
+        last_updated = row[table['columns'].index(table['watermark'])]
+        primary_key = row[table['columns'].index(table['primary_key'])]
+    return {'watermark': last_updated.isoformat(timespec='microseconds'),
+            'id': primary_key}
 
 
-def get_currency_util(user, host, db, port, password, last_updated=None):
-    """Retrieves currency data from a database.
+def next_file_date(max_last_updated, latest=None):
+    """Returns the date to name a table's next file after.
 
-    This function connects to a database using the provided
-    parameters and retrieves currency data from the 'currency' table.
-    The data is then formatted into a dictionary and returned.
+    Files are named after the rounded-up watermark, moved on to a second
+    after the newest file if needed: a keyset read can return rows from
+    the same second as the previous run, and the name must still be new.
 
     Args:
-        user (str): The username for the database connection.
-        host (str): The hostname for the database connection.
-        db (str): The name of the database to connect to.
-        port (int): The port number for the database connection.
-        password (str): The password for the database connection.
-        last_updated (str): The minimum value for the last_updated column.
+        max_last_updated (datetime): The rounded-up maximum watermark.
+        latest (str): The date the table's newest file is named after, or
+            None if it has no files.
 
     Returns:
-        tuple: A tuple containing a dictionary with the currency data and a string with the maximum value of the last_updated column.
+        datetime: The date for the next file, later than latest.
     """
-    try:
-        conn = pg8000.native.Connection(
-            user, host=host, database=db, port=port, password=password
-        )
+    if latest is None:
+        return max_last_updated
+    after = datetime.strptime(latest, '%Y-%m-%d-%H-%M-%S') + timedelta(seconds=1)
+    return max(max_last_updated, after)
 
-        try:
-            if last_updated is None:
-                data_query = '''SELECT * FROM currency ORDER BY last_updated;'''
-            else:
-                data_query = f'''SELECT * FROM currency WHERE last_updated > '{last_updated}' ORDER BY last_updated;'''
-
-            rows = conn.run(data_query)
-            columns = conn.columns
-            column_titles = [c["name"] for c in columns]
-            currency_data = format_to_dict(rows, column_titles)
-            max_query = '''SELECT MAX(last_updated) FROM currency;'''
-            max_last_updated = conn.run(max_query)[0][0]
-            max_last_updated += timedelta(seconds=1)
-            max_last_updated = max_last_updated.replace(microsecond=0)
-            return currency_data, max_last_updated
-        except Exception as e:
-            logger.error(
-                f'An error occurred while executing the SQL query: {e}')
-    except Exception as e:
-        logger.error(
-            f'An error occurred while connecting to the database: {e}')
-    finally:
-        conn.close()
 
+# format_to_dict writes prices as strings and timestamps as
+# "%Y-%m-%d, %H:%M:%S:%f". Only the first price column a table has is
+# converted, which is all any of TABLES has.
+PRICE_COLUMNS = ('unit_price', 'payment_amount', 'item_unit_price')
+TIMESTAMP_COLUMNS = ('created_at', 'last_updated')
+
+# How encode_rows writes each type of value, exactly as json.dumps does.
+# Values of any other type fall back to json.dumps itself.
+_encode_json = json.JSONEncoder().encode
+JSON_ENCODERS = {
+    str: encode_basestring_ascii,
+    int: int.__repr__,
+    bool: lambda value: 'true' if value else 'false',
+    type(None): lambda value: 'null',
+}
 
-def get_department_data(user, host, db, port, password, last_updated=None):
-    """Retrieves department data from a database.
 
-    This function connects to a database using the provided
-    parameters and retrieves department data from the 'department' table.
-    The data is then formatted into a dictionary and returned.
+def format_timestamp(value):
+    """Formats a datetime as format_to_dict writes it.
+
+    The same as value.strftime("%Y-%m-%d, %X:%f") in the C locale the
+    lambda runs in, without going through strftime for every value.
 
     Args:
-        user (str): The username for the database connection.
-        host (str): The hostname for the database connection.
-        db (str): The name of the database to connect to.
-        port (int): The port number for the database connection.
-        password (str): The password for the database connection.
-        last_updated (str): The minimum value for the last_updated column.
+        value (datetime): The timestamp to format.
 
     Returns:
-        tuple: A tuple containing a dictionary with the department data and a string with the maximum value of the last_updated column.
+        str: The formatted timestamp.
     """
-    try:
-        conn = pg8000.native.Connection(
-            user, host=host, database=db, port=port, password=password)
+    return '%d-%02d-%02d, %02d:%02d:%02d:%06d' % (
+        value.year, value.month, value.day,
+        value.hour, value.minute, value.second, value.microsecond)
 
-        try:
-            if last_updated is None:
-                data_query = '''SELECT * FROM department ORDER BY last_updated;'''
-            else:
-                data_query = f'''SELECT * FROM department WHERE last_updated > '{last_updated}' ORDER BY last_updated;'''
 
-            rows = conn.run(data_query)
-            columns = conn.columns
-            column_titles = [c['name'] for c in columns]
-            department_data = format_to_dict(rows, column_titles)
+def format_columns(rows, column_titles):
+    """Converts fetched rows into columns of JSON ready values.
 
-            max_query = '''SELECT MAX(last_updated) FROM department;'''
-            max_last_updated = conn.run(max_query)[0][0]
-            max_last_updated += timedelta(seconds=1)
-            max_last_updated = max_last_updated.replace(microsecond=0)
+    The rows are transposed once, and each column that needs converting
+    is converted in one pass.
 
-            return department_data, max_last_updated
-        except Exception as e:
-            logger.error(
-                f'An error occurred while executing the SQL query: {e}')
-    except Exception as e:
-        logger.error(
-            f'An error occurred while connecting to the database: {e}')
-    finally:
-        conn.close()
+    Args:
+        rows (list): A list of rows of data.
+        column_titles (list): A list of column titles.
+
+    Returns:
+        dict: The values of each column, in column_titles order.
+    """
+    columns = dict(zip(column_titles, map(list, zip(*rows))))
+    if not columns:
+        return {name: [] for name in column_titles}
+    for name in PRICE_COLUMNS:
+        if name in columns:
+            columns[name] = list(map(str, columns[name]))
+            break
+    for name in TIMESTAMP_COLUMNS:
+        columns[name] = list(map(format_timestamp, columns[name]))
+    return columns
 
 
-def get_design_data(user, host, db, port, password, last_updated=None):
-    """Retrieves design data from a database.
+def format_to_dict(rows, column_titles):
+    """Formats rows of data into a dictionary.
 
-    This function connects to a database using the provided
-    parameters and retrieves design data from the 'design' table.
-    The data is then formatted into a dictionary and returned.
+    This function takes in rows of data and their corresponding
+    column titles and formats them into a dictionary.
+    The resulting dictionary has keys that correspond to the column
+    titles and values that correspond to the data in the rows.
+    The function also converts certain values to strings and
+    formats datetime objects.
 
     Args:
-        user (str): The username for the database connection.
-        host (str): The hostname for the database connection.
-        db (str): The name of the database to connect to.
-        port (int): The port number for the database connection.
-        password (str): The password for the database connection.
-        last_updated (str): The minimum value for the last_updated column.
+        rows (list): A list of rows of data.
+        column_titles (list): A list of column titles.
 
     Returns:
-        tuple: A tuple containing a dictionary with the design data and a string with the maximum value of the last_updated column.
+        dict: A dictionary containing the formatted data.
     """
     try:
-        conn = pg8000.native.Connection(
-            user, host=host, database=db, port=port, password=password)
-        try:
-            if last_updated is None:
-                data_query = '''SELECT * FROM design ORDER BY last_updated;'''
-            else:
-                data_query = f'''SELECT * FROM design WHERE last_updated > '{last_updated}' ORDER BY last_updated;'''
+        columns = format_columns(rows, column_titles)
+        names = list(columns)
+        return {'data': [dict(zip(names, values)) for values in zip(*columns.values())]}
+    except Exception as e:
+        logger.error(f"format_to_dict: An error occurred: {e}")
 
-            rows = conn.run(data_query)
-            columns = conn.columns
-            column_titles = [c['name'] for c in columns]
-            design_data = format_to_dict(rows, column_titles)
 
-            max_query = '''SELECT MAX(last_updated) FROM design;'''
-            max_last_updated = conn.run(max_query)[0][0]
-            max_last_updated += timedelta(seconds=1)
-            max_last_updated = max_last_updated.replace(microsecond=0)
+def encode_column(values):
+    """Serializes a column of values to JSON, as json.dumps would.
 
-            return design_data, max_last_updated
-        except Exception as e:
-            logger.error(
-                f'An error occurred while executing the SQL query: {e}')
-    except Exception as e:
-        logger.error(
-            f'An error occurred while connecting to the database: {e}')
-    finally:
-        conn.close()
+    Args:
+        values (list): The values of one column, as format_columns
+            returns them.
+
+    Returns:
+        list: The JSON of each value.
+    """
+    types = set(map(type, values))
+    if len(types) == 1:
+        return list(map(JSON_ENCODERS.get(types.pop(), _encode_json), values))
+    return [JSON_ENCODERS.get(type(value), _encode_json)(value) for value in values]
 
 
-def get_payment_data(user, host, db, port, password, last_updated=None):
-    """Retrieves payment data from a database.
+def encode_rows(rows, column_titles):
+    """Serializes rows of data to JSON, one string per row.
 
-    This function connects to a database using the provided
-    parameters and retrieves payment data from the 'payment'
-    table. The data is then formatted into a dictionary and returned.
+    Each string is byte for byte what json.dumps writes for the row's
+    format_to_dict dictionary, but the values are encoded a column at a
+    time and no dictionaries are built.
 
     Args:
-        user (str): The username for the database connection.
-        host (str): The hostname for the database connection.
-        db (str): The name of the database to connect to.
-        port (int): The port number for the database connection.
-        password (str): The password for the database connection.
-        last_updated (str): The minimum value for the last_updated column.
+        rows (list): A list of rows of data.
+        column_titles (list): A list of column titles.
 
     Returns:
-        tuple: A tuple containing a dictionary with the payment data and a string with the maximum value of the last_updated column.
+        list: The JSON object of each row.
     """
-    try:
-        conn = pg8000.native.Connection(
-            user, host=host, database=db, port=port, password=password)
-        try:
-            if last_updated is None:
-                data_query = '''SELECT * FROM payment ORDER BY last_updated;'''
-            else:
-                data_query = f'''SELECT * FROM payment WHERE last_updated > '{last_updated}' ORDER BY last_updated;'''
+    columns = format_columns(rows, column_titles)
+    template = '{' + ', '.join(encode_basestring_ascii(name).replace('%', '%%') + ': %s'
+                               for name in columns) + '}'
+    return [template % values for values in zip(*map(encode_column, columns.values()))]
 
-            rows = conn.run(data_query)
-            columns = conn.columns
-            column_titles = [c['name'] for c in columns]
-            payment_data = format_to_dict(rows, column_titles)
 
-            max_query = '''SELECT MAX(last_updated) FROM payment;'''
-            max_last_updated = conn.run(max_query)[0][0]
-            max_last_updated += timedelta(seconds=1)
-            max_last_updated = max_last_updated.replace(microsecond=0)
+def encode_table_data(rows, column_titles):
+    """Serializes rows of data to the JSON written to the ingestion bucket.
 
-            return payment_data, max_last_updated
-        except Exception as e:
-            logger.error(
-                f'An error occurred while executing the SQL query: {e}')
-    except Exception as e:
-        logger.error(
-            f'An error occurred while connecting to the database: {e}')
-    finally:
-        conn.close()
+    Args:
+        rows (list): A list of rows of data.
+        column_titles (list): A list of column titles.
 
+    Returns:
+        str: The same as json.dumps(format_to_dict(rows, column_titles)).
+    """
+    return '{"data": [' + ', '.join(encode_rows(rows, column_titles)) + ']}'
 
-def get_payment_type_data(user, host, db, port, password, last_updated=None):
-    """Retrieves payment type data from a database.
 
-    This function connects to a database using the provided parameters
-    and retrieves payment type data from the 'payment_type' table.
-    The data is then formatted into a dictionary and returned.
+def connect_to_totesys(credentials):
+    """Opens a connection to the totesys database.
 
     Args:
-        user (str): The username for the database connection.
-        host (str): The hostname for the database connection.
-        db (str): The name of the database to connect to.
-        port (int): The port number for the database connection.
-        password (str): The password for the database connection.
-        last_updated (str): The minimum value for the last_updated column.
+        credentials (dict): The decoded totesql secret.
 
     Returns:
-        tuple: A tuple containing a dictionary with the payment type data and a string with the maximum value of the last_updated column.
+        pg8000.native.Connection: An open connection.
     """
     try:
-        conn = pg8000.native.Connection(
-            user, host=host, database=db, port=port, password=password)
-        try:
-            if last_updated is None:
-                data_query = '''SELECT * FROM payment_type ORDER BY last_updated;'''
-            else:
-                data_query = f'''SELECT * FROM payment_type WHERE last_updated > '{last_updated}' ORDER BY last_updated;'''
-
-            rows = conn.run(data_query)
-            columns = conn.columns
-            column_titles = [c['name'] for c in columns]
-            payment_type_data = format_to_dict(rows, column_titles)
-
-            max_query = '''SELECT MAX(last_updated) FROM payment_type;'''
-            max_last_updated = conn.run(max_query)[0][0]
-            max_last_updated += timedelta(seconds=1)
-            max_last_updated = max_last_updated.replace(microsecond=0)
-
-            return payment_type_data, max_last_updated
-        except Exception as e:
-            logger.error(
-                f'An error occurred while executing the SQL query: {e}')
+        return pg8000.native.Connection(
+            credentials["PGUSER"], host=credentials["PGURL"],
+            database=credentials["PGDATABASE"], port=credentials["PGPORT"],
+            password=credentials["PGPASSWORD"])
     except Exception as e:
         logger.error(
             f'An error occurred while connecting to the database: {e}')
-    finally:
-        conn.close()
+        raise e
 
 
-def get_purchase_order_data(user, host, db, port, password, last_updated=None):
-    """Retrieves purchase order data from a database.
+def begin_snapshot(conn, snapshot_id=None):
+    """Starts a read only REPEATABLE READ transaction on a snapshot.
 
-    This function connects to a database using the provided
-    parameters and retrieves purchase order data from the
-    'purchase_order' table. The data is then formatted into
-    a dictionary and returned.
+    Without snapshot_id the transaction's own snapshot is exported with
+    pg_export_snapshot(); with it, that exported snapshot is imported. The
+    transaction ends when the connection is closed.
 
     Args:
-        user (str): The username for the database connection.
-        host (str): The hostname for the database connection.
-        db (str): The name of the database to connect to.
-        port (int): The port number for the database connection.
-        password (str): The password for the database connection.
-        last_updated (str): The minimum value for the last_updated column.
+        conn (pg8000.native.Connection): An open connection to totesys.
+        snapshot_id (str): A snapshot exported by another connection.
 
     Returns:
-        tuple: A tuple containing a dictionary with the purchase order data and a string with the maximum value of the last_updated column.
+        str: The id of the snapshot the transaction reads from.
     """
     try:
-        conn = pg8000.native.Connection(
-            user, host=host, database=db, port=port, password=password)
-        try:
-            if last_updated is None:
-                data_query = '''SELECT * FROM purchase_order ORDER BY last_updated;'''
-            else:
-                data_query = f'''SELECT * FROM purchase_order WHERE last_updated > '{last_updated}' ORDER BY last_updated;'''
+        conn.run('START TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;')
+        if snapshot_id is None:
+            snapshot_id = conn.run('SELECT pg_export_snapshot();')[0][0]
+            logger.info(f'Exported snapshot {snapshot_id}.')
+        else:
+            conn.run(f'SET TRANSACTION SNAPSHOT {literal(snapshot_id)};')
+    except Exception as e:
+        logger.error(f'An error occurred while starting the snapshot transaction: {e}')
+        raise e
+    _snapshot_connections[conn] = snapshot_id
+    return snapshot_id
 
-            rows = conn.run(data_query)
-            columns = conn.columns
-            column_titles = [c['name'] for c in columns]
-            purchase_order_data = format_to_dict(rows, column_titles)
 
-            max_query = '''SELECT MAX(last_updated) FROM purchase_order;'''
-            max_last_updated = conn.run(max_query)[0][0]
-            max_last_updated += timedelta(seconds=1)
-            max_last_updated = max_last_updated.replace(microsecond=0)
+def prepare_statement(conn, sql):
+    """Returns a prepared statement for sql, prepared once per connection.
 
-            return purchase_order_data, max_last_updated
-        except Exception as e:
-            logger.error(
-                f'An error occurred while executing the SQL query: {e}')
-    except Exception as e:
-        logger.error(
-            f'An error occurred while connecting to the database: {e}')
-    finally:
-        conn.close()
+    Args:
+        conn (pg8000.native.Connection): An open connection.
+        sql (str): The query, using :name placeholders.
+
+    Returns:
+        pg8000.native.PreparedStatement: The cached prepared statement.
+    """
+    with _prepared_lock:
+        statements = _prepared_statements.setdefault(conn, {})
+    if sql not in statements:
+        statements[sql] = conn.prepare(sql)
+    return statements[sql]
 
 
-def get_sales_order_util(user, host, db, port, password, last_updated=None):
-    """Retrieves sales order data from a database.
+def get_table_data(conn, table_name, last_updated=None, last_id=None):
+    """Retrieves new and updated rows of a totesys table.
 
-    This function connects to a database using the provided
-    parameters and retrieves sales order data from the 'sales_order'
-    table. The data is then formatted into a dictionary and returned.
+    The table is looked up in TABLES, which names the columns to select and
+    the watermark column used for incremental reads. Both queries are
+    parameterized and prepared once per connection, so one connection can
+    serve every table in a run.
 
     Args:
-        user (str): The username for the database connection.
-        host (str): The hostname for the database connection.
-        db (str): The name of the database to connect to.
-        port (int): The port number for the database connection.
-        password (str): The password for the database connection.
-        last_updated (str): The minimum value for the last_updated column.
+        conn (pg8000.native.Connection): An open connection to totesys.
+        table_name (str): A key of TABLES.
+        last_updated (datetime): Only rows whose watermark column is later
+            than this are returned. None returns the whole table.
+        last_id: With last_updated, the keyset of the last row already
+            read: rows with an equal watermark and a larger primary key are
+            returned too.
 
     Returns:
-        tuple: A tuple containing a dictionary with the sales order data and a string with the maximum value of the last_updated column.
+        tuple: A tuple containing a dictionary with the table data and a
+        datetime with the maximum watermark in the table, rounded up to the
+        next whole second.
     """
-    try:
-        conn = pg8000.native.Connection(
-            user, host=host, database=db, port=port, password=password)
-        try:
-            if last_updated is None:
-                data_query = '''SELECT * FROM sales_order ORDER BY last_updated;'''
-            else:
-                data_query = f'''SELECT * FROM sales_order WHERE last_updated > '{last_updated}' ORDER BY last_updated;'''
+    rows, max_last_updated = fetch_table_rows(
+        conn, table_name, last_updated, last_id)
+    return format_to_dict(rows, TABLES[table_name]['columns']), max_last_updated
 
-            rows = conn.run(data_query)
-            columns = conn.columns
-            column_titles = [c['name'] for c in columns]
-            sales_order_data = format_to_dict(rows, column_titles)
 
-            max_query = '''SELECT MAX(last_updated) FROM sales_order;'''
-            max_last_updated = conn.run(max_query)[0][0]
-            max_last_updated += timedelta(seconds=1)
-            max_last_updated = max_last_updated.replace(microsecond=0)
+def fetch_table_rows(conn, table_name, last_updated=None, last_id=None):
+    """Retrieves new and updated rows of a totesys table as pg8000 returns them.
 
-            return sales_order_data, max_last_updated
-        except Exception as e:
-            logger.error(
-                f'An error occurred while executing the SQL query: {e}')
+    Rows are ordered by watermark and then primary key, so the last row
+    holds the keyset the next run resumes after.
+
+    Args:
+        conn (pg8000.native.Connection): An open connection to totesys.
+        table_name (str): A key of TABLES.
+        last_updated (datetime): Only rows whose watermark column is later
+            than this are returned. None returns the whole table.
+        last_id: With last_updated, the keyset of the last row already
+            read: rows with an equal watermark and a larger primary key are
+            returned too.
+
+    Returns:
+        tuple: A list of rows, with values in TABLES column order, and the
+        maximum watermark rounded up to the next whole second. On a
+        snapshot connection the maximum is taken from the rows fetched.
+    """
+    try:
+        data_query = prepare_statement(
+            conn, select_rows_sql(table_name, last_updated, last_id))
+        if last_updated is None:
+            rows = data_query.run()
+        elif last_id is None:
+            rows = data_query.run(last_updated=last_updated)
+        else:
+            rows = data_query.run(last_updated=last_updated, last_id=last_id)
+        if conn in _snapshot_connections:
+            max_last_updated = max_fetched_watermark(rows, table_name)
+        else:
+            max_last_updated = get_max_last_updated(conn, table_name)
+
+        return rows, max_last_updated
     except Exception as e:
         logger.error(
-            f'An error occurred while connecting to the database: {e}')
-    finally:
-        conn.close()
+            f'An error occurred while executing the SQL query for {table_name}: {e}')
+        raise e
 
 
-def get_staff_data(user, host, db, port, password, last_updated=None):
-    """Retrieves staff data from a database.
+def select_rows_sql(table_name, last_updated=None, last_id=None):
+    """Returns the query for new and updated rows of a totesys table.
 
-    This function connects to a database using the provided
-    parameters and retrieves staff data from the 'staff' table.
-    The data is then formatted into a dictionary and returned.
+    The rows are ordered by (watermark, primary key). With last_id the
+    query is a keyset read, comparing that pair as a row value, so rows
+    sharing the last watermark are neither read twice nor skipped.
 
     Args:
-        user (str): The username for the database connection.
-        host (str): The hostname for the database connection.
-        db (str): The name of the database to connect to.
-        port (int): The port number for the database connection.
-        password (str): The password for the database connection.
-        last_updated (str): The minimum value for the last_updated column.
+        table_name (str): A key of TABLES.
+        last_updated (datetime): None selects the whole table.
+        last_id: The primary key of the last row read, or None to compare
+            the watermark alone.
 
     Returns:
-        tuple: A tuple containing a dictionary with the staff data and a string with the maximum value of the last_updated column.
+        str: The query, using :last_updated and :last_id placeholders.
     """
-    try:
-        conn = pg8000.native.Connection(
-            user, host=host, database=db, port=port, password=password)
-        try:
-            if last_updated is None:
-                query = '''SELECT * FROM staff ORDER BY last_updated;'''
-            else:
-                query = f'''SELECT * FROM staff WHERE last_updated > '{last_updated}' ORDER BY last_updated;'''
+    table = TABLES[table_name]
+    columns = ', '.join(identifier(c) for c in table['columns'])
+    watermark = identifier(table['watermark'])
+    primary_key = identifier(table['primary_key'])
+    source = identifier(table_name)
+    order = f'ORDER BY {watermark}, {primary_key}'
+    if last_updated is None:
+        return f'SELECT {columns} FROM {source} {order};'
+    if last_id is None:
+        return (f'SELECT {columns} FROM {source} '
+                f'WHERE {watermark} > :last_updated {order};')
+    return (f'SELECT {columns} FROM {source} '
+            f'WHERE ({watermark}, {primary_key}) > (:last_updated, :last_id) {order};')
+
+
+def rows_to_parquet(rows, table_name):
+    """Serializes rows of a totesys table to Parquet.
+
+    Column types are taken from the values pg8000 returns, so numeric
+    columns are stored as decimal128, timestamps as timestamp[us] and ids
+    as int64, rather than as the strings format_to_dict produces.
 
-            rows = conn.run(query)
-            columns = conn.columns
-            column_titles = [c['name'] for c in columns]
-            staff_data = format_to_dict(rows, column_titles)
+    Args:
+        rows (list): Rows with values in TABLES column order.
+        table_name (str): A key of TABLES.
 
-            max_query = '''SELECT MAX(last_updated) FROM staff;'''
-            max_last_updated = conn.run(max_query)[0][0]
-            max_last_updated += timedelta(seconds=1)
-            max_last_updated = max_last_updated.replace(microsecond=0)
+    Returns:
+        bytes: The Parquet file contents.
+    """
+    # pyarrow comes from the AWS SDK pandas layer and is only needed when
+    # INGESTION_FORMAT is parquet.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    column_names = TABLES[table_name]['columns']
+    arrays = [pa.array(list(values)) for values in zip(*rows)]
+    arrow_table = pa.Table.from_arrays(arrays, names=column_names)
+    out_buffer = pa.BufferOutputStream()
+    pq.write_table(arrow_table, out_buffer)
+    return out_buffer.getvalue().to_pybytes()
 
-            return staff_data, max_last_updated
-        except Exception as e:
-            logger.error(
-                f'An error occurred while executing the SQL query: {e}')
-    except Exception as e:
-        logger.error(
-            f'An error occurred while connecting to the database: {e}')
-    finally:
-        conn.close()
 
+def get_max_last_updated(conn, table_name):
+    """Returns the next whole second after a table's latest watermark.
+
+    Args:
+        conn (pg8000.native.Connection): An open connection to totesys.
+        table_name (str): A key of TABLES.
 
-def get_transaction_data(user, host, db, port, password, last_updated=None):
-    """Retrieves transaction data from a database.
+    Returns:
+        datetime: The rounded-up maximum watermark, or None if the table
+        is empty.
+    """
+    table = TABLES[table_name]
+    watermark = identifier(table['watermark'])
+    max_query = prepare_statement(
+        conn, f'SELECT MAX({watermark}) FROM {identifier(table_name)};')
+    max_last_updated = max_query.run()[0][0]
+    if max_last_updated is None:
+        return None
+    max_last_updated += timedelta(seconds=1)
+    return max_last_updated.replace(microsecond=0)
 
-    This function connects to a database using the provided
-    parameters and retrieves transaction data from the 'transaction'
-    table. The data is then formatted into a dictionary and returned.
+
+def max_fetched_watermark(rows, table_name):
+    """Returns the next whole second after the newest watermark in rows.
 
     Args:
-        user (str): The username for the database connection.
-        host (str): The hostname for the database connection.
-        db (str): The name of the database to connect to.
-        port (int): The port number for the database connection.
-        password (str): The password for the database connection.
-        last_updated (str): The minimum value for the last_updated column.
+        rows (list): Rows with values in TABLES column order.
+        table_name (str): A key of TABLES.
 
     Returns:
-        tuple: A tuple containing a dictionary with the transaction data and a string with the maximum value of the last_updated column.
+        datetime: The rounded-up maximum watermark, or None if there are
+        no rows.
     """
-    try:
-        conn = pg8000.native.Connection(
-            user, host=host, database=db, port=port, password=password)
-        try:
-            if last_updated is None:
-                query = '''SELECT * FROM transaction ORDER BY last_updated;'''
-            else:
-                query = f'''SELECT * FROM transaction WHERE last_updated > '{last_updated}' ORDER BY last_updated;'''
+    if not rows:
+        return None
+    table = TABLES[table_name]
+    index = table['columns'].index(table['watermark'])
+    max_last_updated = max(row[index] for row in rows) + timedelta(seconds=1)
+    return max_last_updated.replace(microsecond=0)
 
-            rows = conn.run(query)
-            columns = conn.columns
-            column_titles = [c['name'] for c in columns]
-            transaction_data = format_to_dict(rows, column_titles)
 
-            max_query = '''SELECT MAX(last_updated) FROM transaction;'''
-            max_last_updated = conn.run(max_query)[0][0]
-            max_last_updated += timedelta(seconds=1)
-            max_last_updated = max_last_updated.replace(microsecond=0)
+def stream_table_to_s3(conn, s3, table_name, last_updated=None, last_id=None,
+                       latest=None):
+    """Streams new and updated rows of a table to S3 in chunks.
 
-            return transaction_data, max_last_updated
-        except Exception as e:
-            logger.error(
-                f'An error occurred while executing the SQL query: {e}')
+    The rows are read through a server-side cursor, FETCH_SIZE at a time,
+    and each chunk is serialized and appended to an S3 multipart upload,
+    so memory use is bounded by the chunk and part sizes rather than the
+    table size. The object written is byte for byte what json.dumps of
+    the get_table_data dictionary would produce. It is completed with
+    IfNoneMatch, and if another writer has created the key in the meantime
+    the rows are streamed again under the next second.
+
+    Args:
+        conn (pg8000.native.Connection): An open connection to totesys.
+        s3 (boto3.client): An S3 client.
+        table_name (str): A key of TABLES.
+        last_updated (datetime): Only rows whose watermark column is later
+            than this are returned. None returns the whole table.
+        last_id: With last_updated, the keyset of the last row already
+            read: rows with an equal watermark and a larger primary key are
+            returned too.
+        latest (str): The date the table's newest file is named after, or
+            None if it has no files.
+
+    Returns:
+        tuple: The number of rows written, the seconds spent uploading and
+        the key, ETag and watermark of the object written (None if there
+        were no new rows).
+    """
+    table = TABLES[table_name]
+    cursor = identifier(f'{table_name}_cursor')
+    fetch_size = int(os.environ.get('INGESTION_FETCH_SIZE', FETCH_SIZE))
+
+    # The key is named after the watermark read before the rows, so rows
+    # changed while streaming are picked up again by the next run. On a
+    # snapshot connection the cursor is declared in the snapshot's own
+    # transaction, and both queries see exactly the same rows.
+    in_snapshot = conn in _snapshot_connections
+    max_last_updated = get_max_last_updated(conn, table_name)
+    if max_last_updated is None:
+        return 0, 0, None
+    date_string = next_file_date(max_last_updated, latest).strftime(
+        '%Y-%m-%d-%H-%M-%S')
+    key = f"{table_name}/{date_string}.json"
+
+    upload_id = None
+    etag = None
+    parts = []
+    buffer = io.BytesIO()
+    row_count = 0
+    last_row = None
+    upload_time = 0
+    taken = False
+
+    def upload_part():
+        nonlocal upload_id, upload_time
+        start_time = time.time()
+        if upload_id is None:
+            upload_id = s3.create_multipart_upload(
+                Bucket=ingestion_bucket, Key=key)['UploadId']
+        part_number = len(parts) + 1
+        response = s3.upload_part(
+            Body=buffer.getvalue(), Bucket=ingestion_bucket, Key=key,
+            PartNumber=part_number, UploadId=upload_id)
+        parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        buffer.seek(0)
+        buffer.truncate()
+        upload_time += time.time() - start_time
+
+    try:
+        if not in_snapshot:
+            conn.run('BEGIN;')
+        declare = (f'DECLARE {cursor} NO SCROLL CURSOR FOR '
+                   f'{select_rows_sql(table_name, last_updated, last_id)}')
+        if last_updated is None:
+            conn.run(declare)
+        elif last_id is None:
+            conn.run(declare, last_updated=last_updated)
+        else:
+            conn.run(declare, last_updated=last_updated, last_id=last_id)
+        while True:
+            rows = conn.run(f'FETCH FORWARD {fetch_size} FROM {cursor};')
+            if not rows:
+                break
+            last_row = rows[-1]
+            chunk = encode_rows(rows, table['columns'])
+            buffer.write(b'{"data": [' if row_count == 0 else b', ')
+            buffer.write(', '.join(chunk).encode('utf-8'))
+            row_count += len(chunk)
+            if buffer.tell() >= MULTIPART_MIN_SIZE:
+                upload_part()
+        conn.run(f'CLOSE {cursor};')
+        if not in_snapshot:
+            conn.run('COMMIT;')
+
+        if row_count:
+            buffer.write(b']}')
+            upload_part()
+            start_time = time.time()
+            try:
+                etag = get_checkpoint_client().complete_multipart_upload(
+                    Bucket=ingestion_bucket, Key=key, UploadId=upload_id,
+                    MultipartUpload={'Parts': parts}, IfNoneMatch='*').get('ETag')
+            except ClientError as e:
+                if e.response['Error']['Code'] not in CHECKPOINT_CONFLICTS:
+                    raise e
+                taken = True
+            upload_time += time.time() - start_time
     except Exception as e:
         logger.error(
-            f'An error occurred while connecting to the database: {e}')
-    finally:
-        conn.close()
+            f'An error occurred while streaming {table_name} to S3: {e}')
+        if not in_snapshot:
+            try:
+                conn.run('ROLLBACK;')
+            except Exception as rollback_error:
+                logger.error(f'Rollback failed: {rollback_error}')
+        if upload_id is not None:
+            s3.abort_multipart_upload(
+                Bucket=ingestion_bucket, Key=key, UploadId=upload_id)
+        raise e
+
+    if taken:
+        # Another writer created the key first. The rows are streamed
+        # again under the next second, as put_table_file would name them.
+        s3.abort_multipart_upload(Bucket=ingestion_bucket, Key=key, UploadId=upload_id)
+        logger.info(f'{key} was written by another run, streaming to the next second.')
+        return stream_table_to_s3(conn, s3, table_name, last_updated, last_id, date_string)
+    if not row_count:
+        return 0, upload_time, None
+    keyset = row_keyset(last_row, table_name)
+    save_checkpoint(ingestion_bucket, table_name, key, keyset)
+    return row_count, upload_time, {'key': key, 'etag': etag,
+                                    'watermark': keyset['watermark']}
@@ -0,0 +1,249 @@
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+import boto3
+from pg8000.native import identifier, literal
+from src.lambda_functions import ingestion_lambda
+from src.lambda_functions.ingestion_lambda import TABLES
+
+# Push-driven ingestion. Opt-in triggers make every insert or update on a
+# totesys table NOTIFY NOTIFY_CHANNEL with the table name and the row's
+# primary key. A long-lived consumer listens on the channel, batches the
+# keys notified within a short window and extracts only those rows, with
+# the ingestion lambda's extraction, checkpoint and run manifest code:
+#
+#     python -m src.lambda_functions.ingestion_listener install|listen|remove
+#
+# Notifications sent while nobody listens are lost, so the scheduled
+# ingestion lambda stays the backstop: files written here move a table's
+# checkpoint on to a new key but keep the position its incremental reads
+# resume after.
+NOTIFY_CHANNEL = 'totesys_changes'
+NOTIFY_FUNCTION = 'totesys_notify_change'
+NOTIFY_TRIGGER = 'totesys_notify_change'
+
+# Keys notified within NOTIFY_WINDOW_SECONDS of the first one are extracted
+# together. pg8000 only reads notifications while it handles a query, so
+# the listening connection is polled every NOTIFY_POLL_SECONDS.
+NOTIFY_WINDOW_SECONDS = 2
+NOTIFY_POLL_SECONDS = 0.2
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def install_notify_triggers(conn, tables=None):
+    """Installs the triggers that notify NOTIFY_CHANNEL of changed rows.
+
+    Installing again replaces the triggers, so it is safe to repeat.
+
+    Args:
+        conn (pg8000.native.Connection): A connection allowed to create
+            functions and triggers on the totesys tables.
+        tables (list): Keys of TABLES to install triggers on. None installs
+            them on every table.
+    """
+    conn.run(f"""
+        CREATE OR REPLACE FUNCTION {identifier(NOTIFY_FUNCTION)}() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify({literal(NOTIFY_CHANNEL)}, json_build_object(
+                'table', TG_TABLE_NAME,
+                'id', to_jsonb(NEW) -> TG_ARGV[0])::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;""")
+    for table_name in (TABLES if tables is None else tables):
+        source = identifier(table_name)
+        conn.run(f'DROP TRIGGER IF EXISTS {identifier(NOTIFY_TRIGGER)} ON {source};')
+        conn.run(f'CREATE TRIGGER {identifier(NOTIFY_TRIGGER)} '
+                 f'AFTER INSERT OR UPDATE ON {source} FOR EACH ROW '
+                 f'EXECUTE FUNCTION {identifier(NOTIFY_FUNCTION)}'
+                 f'({literal(TABLES[table_name]["primary_key"])});')
+    logger.info(f'Installed the {NOTIFY_CHANNEL} triggers.')
+
+
+def remove_notify_triggers(conn, tables=None):
+    """Removes the triggers installed by install_notify_triggers.
+
+    Args:
+        conn (pg8000.native.Connection): A connection allowed to drop the
+            triggers and their function.
+        tables (list): Keys of TABLES to remove triggers from. None removes
+            them from every table, and the function with them.
+    """
+    for table_name in (TABLES if tables is None else tables):
+        conn.run(f'DROP TRIGGER IF EXISTS {identifier(NOTIFY_TRIGGER)} '
+                 f'ON {identifier(table_name)};')
+    if tables is None:
+        conn.run(f'DROP FUNCTION IF EXISTS {identifier(NOTIFY_FUNCTION)}();')
+    logger.info(f'Removed the {NOTIFY_CHANNEL} triggers.')
+
+
+def collect_notifications(conn, window=NOTIFY_WINDOW_SECONDS,
+                          poll=NOTIFY_POLL_SECONDS, timeout=None):
+    """Waits for notified changes and collects them over one window.
+
+    Args:
+        conn (pg8000.native.Connection): A connection listening on
+            NOTIFY_CHANNEL.
+        window (float): Seconds to keep collecting after the first change.
+        poll (float): Seconds between polls of the connection.
+        timeout (float): Seconds to wait for a first change, or None to
+            wait for as long as it takes.
+
+    Returns:
+        dict: The primary keys notified for each table. Empty if the
+        timeout passed with no changes.
+    """
+    changed = {}
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        conn.run('SELECT 1;')
+        while conn.notifications:
+            _, _, payload = conn.notifications.popleft()
+            change = json.loads(payload)
+            if not changed:
+                deadline = time.time() + window
+            changed.setdefault(change['table'], set()).add(change['id'])
+        if deadline is not None and time.time() >= deadline:
+            return changed
+        time.sleep(poll)
+
+
+def fetch_notified_rows(conn, table_name, ids):
+    """Retrieves the rows of a table with the primary keys given.
+
+    Args:
+        conn (pg8000.native.Connection): An open connection to totesys.
+        table_name (str): A key of TABLES.
+        ids (list): The primary keys notified.
+
+    Returns:
+        list: The rows, with values in TABLES column order, ordered by
+        watermark and primary key.
+    """
+    table = TABLES[table_name]
+    columns = ', '.join(identifier(c) for c in table['columns'])
+    watermark = identifier(table['watermark'])
+    primary_key = identifier(table['primary_key'])
+    try:
+        query = ingestion_lambda.prepare_statement(
+            conn, f'SELECT {columns} FROM {identifier(table_name)} '
+                  f'WHERE {primary_key} = ANY(:ids) ORDER BY {watermark}, {primary_key};')
+        return query.run(ids=list(ids))
+    except Exception as e:
+        logger.error(
+            f'An error occurred while executing the SQL query for {table_name}: {e}')
+        raise e
+
+
+def ingest_notified_rows(conn, s3, table_name, ids):
+    """Extracts the notified rows of one table and saves them to S3.
+
+    Tables that have never been ingested are left to the ingestion lambda,
+    whose first run extracts the whole table.
+
+    Args:
+        conn (pg8000.native.Connection): An open connection to totesys.
+        s3 (boto3.client): An S3 client.
+        table_name (str): A key of TABLES.
+        ids (list): The primary keys notified.
+
+    Returns:
+        dict: The table's timings, as ingest_table returns them, or None
+        if nothing was saved.
+    """
+    start_time = time.time()
+    bucket = ingestion_lambda.ingestion_bucket
+    checkpoint = ingestion_lambda.get_checkpoint(bucket, table_name)
+    if checkpoint is None:
+        logger.info(f'{table_name} has not been ingested yet, skipping its changes.')
+        return None
+    rows = fetch_notified_rows(conn, table_name, ids)
+    fetched_time = time.time()
+    if not rows:
+        return None
+    file_format = os.environ.get('INGESTION_FORMAT', 'json').lower()
+    file_date = ingestion_lambda.next_file_date(
+        ingestion_lambda.max_fetched_watermark(rows, table_name), checkpoint['latest'])
+    if file_format == 'parquet':
+        body = ingestion_lambda.rows_to_parquet(rows, table_name)
+    else:
+        body = ingestion_lambda.encode_table_data(rows, TABLES[table_name]['columns'])
+    # The scheduled lambda may be saving the same table; put_table_file
+    # never replaces the file it names after the same second.
+    key, response = ingestion_lambda.put_table_file(table_name, file_date, file_format, body)
+    ingestion_lambda.save_checkpoint(bucket, table_name, key)
+    end_time = time.time()
+    logger.info(f'{table_name} saved {len(rows)} notified rows to {key}.')
+    return {'table': table_name,
+            'rows': len(rows),
+            'fetch': fetched_time - start_time,
+            'upload': end_time - fetched_time,
+            'total': end_time - start_time,
+            'previous': checkpoint['key'],
+            'key': key,
+            'etag': response.get('ETag'),
+            'watermark': ingestion_lambda.row_keyset(rows[-1], table_name)['watermark']}
+
+
+def listen_for_changes(credentials, s3, batches=None, window=NOTIFY_WINDOW_SECONDS):
+    """Extracts notified changes in batches until stopped.
+
+    One connection listens on NOTIFY_CHANNEL and a second one extracts the
+    rows, so notifications keep arriving while a batch is saved. Every
+    batch that saves rows ends with a run manifest, which starts the
+    processed lambda as a scheduled run would.
+
+    Args:
+        credentials (dict): The decoded totesql secret.
+        s3 (boto3.client): An S3 client.
+        batches (int): The number of batches to extract, or None to run
+            until interrupted.
+        window (float): Seconds to collect changes for after the first.
+    """
+    listener = ingestion_lambda.connect_to_totesys(credentials)
+    conn = ingestion_lambda.connect_to_totesys(credentials)
+    # pg8000 keeps only the last 100 notifications by default.
+    listener.notifications = deque()
+    try:
+        listener.run(f'LISTEN {identifier(NOTIFY_CHANNEL)};')
+        count = 0
+        while batches is None or count < batches:
+            changed = collect_notifications(listener, window)
+            timings = [ingest_notified_rows(conn, s3, table_name, sorted(ids))
+                       for table_name, ids in changed.items() if table_name in TABLES]
+            ingestion_lambda.trigger_lambda_processed(
+                [timing for timing in timings if timing is not None])
+            count += 1
+    except Exception as e:
+        logger.error(f'An Error occurred: {e}')
+        raise e
+    finally:
+        listener.close()
+        conn.close()
+
+
+def main(command):
+    logging.basicConfig()
+    credentials = json.loads(ingestion_lambda.get_secret())
+    if command == 'listen':
+        listen_for_changes(credentials, boto3.client('s3'))
+        return
+    conn = ingestion_lambda.connect_to_totesys(credentials)
+    try:
+        if command == 'install':
+            install_notify_triggers(conn)
+        elif command == 'remove':
+            remove_notify_triggers(conn)
+        else:
+            raise ValueError(f'Unknown command {command}, use install, listen or remove')
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else 'listen')
@@ -4,12 +4,119 @@ import logging
 import io
 import json
 from botocore.exceptions import ClientError
+import os
 import time
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# The newest file of each table is recorded in checkpoints/<table>.json, so
+# finding it is one GET instead of a listing of the table's history. The
+# checkpoints are replaced with conditional writes.
+CHECKPOINT_PREFIX = 'checkpoints'
+CHECKPOINT_ATTEMPTS = 5
+CHECKPOINT_CONFLICTS = ('PreconditionFailed', 'ConditionalRequestConflict', '409', '412')
+CONDITIONAL_HEADERS = {'IfMatch': 'If-Match', 'IfNoneMatch': 'If-None-Match'}
+_checkpoint_client = None
+
+# processed_update.json is read once per run into _state. processed_update
+# stages changes there and commit_state writes them back in one request.
+state_bucket = "processed-bucket-1158020804995033"
+STATE_KEY = 'processed_update.json'
+_state = None
+_state_lock = threading.Lock()
+
+# Several increments of a table can be waiting when a run starts. They are
+# read together and only the newest version of each primary key is kept.
+PRIMARY_KEYS = {
+    'address': 'address_id',
+    'counterparty': 'counterparty_id',
+    'currency': 'currency_id',
+    'department': 'department_id',
+    'design': 'design_id',
+    'payment': 'payment_id',
+    'payment_type': 'payment_type_id',
+    'purchase_order': 'purchase_order_id',
+    'sales_order': 'sales_order_id',
+    'staff': 'staff_id',
+    'transaction': 'transaction_id',
+}
+# A run reads at most PENDING_FILES_PER_RUN pending files of a table, so the
+# many range files of a backfill are not coalesced into one DataFrame. The
+# rest are carried over: the run ends by writing an ingestion run manifest
+# for them, which starts the next run.
+PENDING_FILES_PER_RUN = int(os.environ.get('PROCESSED_MAX_FILES', 10))
+_run_latest = {}
+_carried = {}
+
+# Ingested files are parsed at most once per run. The DataFrames are kept
+# in an LRU cache keyed by key and ETag and bounded by their memory use. By
+# default the cache gets a quarter of the memory the function is given
+# (AWS_LAMBDA_FUNCTION_MEMORY_SIZE, in MB), leaving the rest to pandas,
+# pyarrow and the snapshots. Outside Lambda that comes to 64 MB.
+INGESTION_CACHE_SHARE = 4
+INGESTION_CACHE_BYTES = int(os.environ.get(
+    'INGESTION_CACHE_BYTES',
+    int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 256)) * 1024 * 1024
+    // INGESTION_CACHE_SHARE))
+_ingestion_cache = OrderedDict()
+_ingestion_cache_stats = {'hits': 0, 'misses': 0, 'bytes': 0}
+_ingestion_cache_lock = threading.Lock()
+
+# The source tables each transform reads. Every source is loaded by a
+# load:<table> node, and a transform runs once all of its sources are in.
+TRANSFORM_SOURCES = {
+    'dim_currency': ['currency'],
+    'dim_counterparty': ['counterparty', 'address'],
+    'dim_design': ['design'],
+    'dim_location': ['address'],
+    'dim_staff': ['department', 'staff'],
+    'dim_transaction': ['transaction'],
+    'dim_payment_type': ['payment_type'],
+    'fact_sales_order': ['sales_order'],
+    'fact_purchase_order': ['purchase_order'],
+    'fact_payment': ['payment'],
+}
+
+# The name dim_currency gives each currency code. Codes missing here keep
+# the code itself as their name.
+CURRENCY_NAMES = {'GBP': 'pound', 'USD': 'dollar', 'EUR': 'euro'}
+
+# The current state of each entity table is kept in snapshots/<table>.parquet
+# in the processed bucket and merged with the new increments on every run,
+# so joins can look rows up without reading the ingestion history.
+SNAPSHOT_PREFIX = 'snapshots'
+SNAPSHOT_TABLES = ['address', 'counterparty', 'currency', 'department',
+                   'design', 'payment_type', 'staff']
+_snapshots = {}
+_snapshot_lock = threading.Lock()
+
+# With FACT_LAYOUT=partitioned the fact tables are written as Hive style
+# partitions, e.g. fact_sales_order/created_date=2022-11-03/<file>.parquet,
+# sorted by id, zstd compressed and with column statistics for pruning.
+PARTITIONED_TABLES = {'fact_sales_order': 'sales_order_id',
+                      'fact_purchase_order': 'purchase_order_id',
+                      'fact_payment': 'payment_id'}
+PARTITION_COLUMN = 'created_date'
+FACT_ROW_GROUP_SIZE = 100000
+# Each partition has one current file. table_manifests/<table>.json maps
+# every created_date to it and is replaced atomically after a merge.
+MANIFEST_PREFIX = 'table_manifests'
+
+# The ingestion lambda starts a run by writing run_manifests/ingestion/
+# <run>.json. The manifests not yet applied, recorded as 'run_manifest' in
+# processed_update.json, give the newest key of every table and the files
+# written since, so nothing has to be listed. A run ends by writing its own
+# manifest for the warehouse lambda.
+RUN_MANIFEST_PREFIX = 'run_manifests'
+RUN_MANIFEST_STATE = 'run_manifest'
+_run_manifest = None
+
 
 def lambda_handler(event, context):
     """This function, lambda_handler, is the entry point for an AWS Lambda
@@ -32,13 +139,25 @@ def lambda_handler(event, context):
     ClientError: If an error occurs while interacting with the AWS S3 service.
     Exception: If any other unexpected error occurs during the data processing.
     """
+    global _run_manifest
     s3_bucket_name, s3_object_name = get_object_path(event["Records"])
 
     ingestion_bucket = "ingestion-bucket-1158020804995033"
     processing_bucket = "processed-bucket-1158020804995033"
 
-    if s3_object_name == "processed_trigger.txt":
+    # processed_trigger.txt still starts a run that finds its files by
+    # listing the ingestion bucket.
+    manifest_run = s3_object_name.startswith(f'{RUN_MANIFEST_PREFIX}/ingestion/')
+    if s3_object_name == "processed_trigger.txt" or manifest_run:
         try:
+            load_state(refresh=True)
+            reset_ingestion_cache()
+            _snapshots.clear()
+            _run_latest.clear()
+            _carried.clear()
+            _run_manifest = None
+            if manifest_run:
+                _run_manifest = load_run_manifests(ingestion_bucket, 'ingestion')
             parquet_func = {'dim_currency': create_dim_currency,
                             'dim_counterparty': create_dim_counterparty,
                             'dim_design': create_dim_design,
@@ -50,22 +169,39 @@ def lambda_handler(event, context):
                             'fact_purchase_order': create_fact_purchase_order,
                             'fact_payment': create_fact_payment
                             }
+            workers = int(os.environ.get('PROCESSED_WORKERS', 1))
+            results = run_transforms(parquet_func, ingestion_bucket, workers)
+            save_snapshots()
 
-            for table_name, create_func in parquet_func.items():
+            written = {}
+            for table_name in parquet_func:
                 start_time = time.time()
-                data, file_name = create_func(ingestion_bucket)
-                if not data.empty:
+                data, file_name = results[table_name]
+                if not data.empty and table_name in PARTITIONED_TABLES and \
+                        os.environ.get('FACT_LAYOUT', 'flat') == 'partitioned':
+                    keys = upsert_fact_partitions(
+                        processing_bucket, file_name, data, PARTITIONED_TABLES[table_name])
+                    written[table_name] = save_checkpoint(
+                        processing_bucket, table_name, keys[0], keys)
+                    logger.info(f"{file_name} saved to S3 in {len(keys)} partitions:\
+                      {time.time() - start_time} seconds to execute.")
+                elif not data.empty:
                     upload_to_processing_s3(processing_bucket, file_name, data)
+                    written[table_name] = save_checkpoint(
+                        processing_bucket, table_name, file_name)
                     end_time = time.time()
                     logger.info(f"{file_name} saved to S3:\
                       {end_time - start_time} seconds to execute.")
                 else:
-                    end_time = time.time()
-                    logger.info(f"{file_name} no update necessary:\
-                      {end_time - start_time} seconds to execute.")
-                    pass
-            if table_name == 'fact_payment':
-                trigger_lambda_warehouse()
+                    logger.info(f"{file_name} no update necessary.")
+                if table_name in written:
+                    written[table_name] = dict(written[table_name], rows=len(data))
+            log_ingestion_cache()
+            # The manifest is written before the state is committed, so
+            # a failure in between repeats the run rather than losing it.
+            trigger_lambda_warehouse(processing_bucket, written)
+            commit_state()
+            trigger_carried_run(ingestion_bucket)
 
         except ClientError as e:
             logger.error(f"An S3 Error occurred: {e}")
@@ -74,6 +210,123 @@ def lambda_handler(event, context):
             raise e
 
 
+def load_source(bucket_name, table_name):
+    """Reads the pending increments of a source table into the cache.
+
+    Tables with nothing pending are left for the transforms to read.
+    Entity tables also have their snapshot brought up to date.
+
+    Args:
+        bucket_name (str): The ingestion bucket.
+        table_name (str): The totesys table.
+    """
+    latest = get_latest_file_name(bucket_name, table_name)
+    stored = load_state()['data'].get(table_name, "null")
+    if latest is not None and is_newer(latest, stored):
+        extract_pending_increments(bucket_name, table_name, latest)
+    if table_name in SNAPSHOT_TABLES:
+        _load_snapshot_entry(bucket_name, table_name)
+
+
+def run_graph(nodes, workers):
+    """Runs a graph of tasks on a thread pool, each once its dependencies are done.
+
+    Args:
+        nodes (dict): Maps each node name to a (function, dependencies) pair.
+            The function is called without arguments.
+        workers (int): The number of threads.
+
+    Returns:
+        tuple: The result of each node and the seconds each node took.
+
+    Raises:
+        ValueError: If some nodes can never run because of a cycle or a
+            missing dependency.
+    """
+    def timed(func):
+        start_time = time.time()
+        return func(), time.time() - start_time
+
+    pending = dict(nodes)
+    running = {}
+    results, timings = {}, {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            for name, (func, dependencies) in list(pending.items()):
+                if all(dependency in results for dependency in dependencies):
+                    del pending[name]
+                    running[executor.submit(timed, func)] = name
+            if not running:
+                raise ValueError(f'Nodes with unmet dependencies: {sorted(pending)}')
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name], timings[name] = future.result()
+    return results, timings
+
+
+def critical_path(nodes, timings):
+    """Finds the chain of dependent nodes that takes longest to run.
+
+    Args:
+        nodes (dict): Maps each node name to a (function, dependencies) pair.
+        timings (dict): The seconds each node took.
+
+    Returns:
+        tuple: The node names along the path, in order, and its total seconds.
+    """
+    longest = {}
+
+    def finish(name):
+        if name not in longest:
+            before = max(nodes[name][1], key=finish, default=None)
+            path, seconds = longest[before] if before else ([], 0)
+            longest[name] = (path + [name], seconds + timings[name])
+        return longest[name][1]
+
+    return longest[max(nodes, key=finish)]
+
+
+def run_transforms(transforms, bucket_name, workers):
+    """Runs the transforms, loading each source table once beforehand.
+
+    Each source table in TRANSFORM_SOURCES becomes a load:<table> node and
+    each transform depends on the loads of the tables it reads, so
+    independent transforms run side by side. The critical path is logged.
+
+    Args:
+        transforms (dict): Maps each processed table to its create function.
+        bucket_name (str): The ingestion bucket.
+        workers (int): The number of threads.
+
+    Returns:
+        dict: The (DataFrame, key) returned by each transform.
+
+    Raises:
+        RuntimeError: If a transform returned no result. Nothing has been
+            saved at that point, so the run can simply be repeated.
+    """
+    nodes = {}
+    for table_name, create_func in transforms.items():
+        sources = TRANSFORM_SOURCES[table_name]
+        for source in sources:
+            nodes[f'load:{source}'] = (
+                lambda source=source: load_source(bucket_name, source), [])
+        nodes[table_name] = (
+            lambda create_func=create_func: create_func(bucket_name),
+            [f'load:{source}' for source in sources])
+    start_time = time.time()
+    results, timings = run_graph(nodes, workers)
+    failed = sorted(name for name in transforms if results[name] is None)
+    if failed:
+        raise RuntimeError(f'Transforms returned no result: {failed}')
+    path, seconds = critical_path(nodes, timings)
+    logger.info(f"Transforms finished in {time.time() - start_time:.2f} seconds. "
+                f"Critical path ({seconds:.2f} seconds): "
+                + " -> ".join(f"{name} ({timings[name]:.2f}s)" for name in path))
+    return {table_name: results[table_name] for table_name in transforms}
+
+
 def get_object_path(records):
     """Extracts bucket and object references from Records field of event.
 
@@ -89,26 +342,212 @@ def get_object_path(records):
 
 
 def get_latest_file_name(bucket_name, prefix):
-    s3 = boto3.client('s3')
-    response = s3.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
-
-    dates = []
-    file_names = []
-    for obj in response.get('Contents', []):
-        key = obj['Key']
-        file_name = key.split('/')[-1].split('.')[0]
-        date_string = file_name.split('.')[0]
-        date = datetime.strptime(date_string, '%Y-%m-%d-%H-%M-%S')
-        dates.append(date)
-        file_names.append(file_name)
-
-    if dates:
-        latest_date_index = dates.index(max(dates))
-        latest_file_name = file_names[latest_date_index]
-        return latest_file_name
-    else:
+    if _run_manifest is not None and _run_manifest.get(prefix):
+        return limit_pending_files(
+            bucket_name, prefix, file_stem(_run_manifest[prefix][-1]['key']))
+    checkpoint = get_checkpoint(bucket_name, prefix)
+    if checkpoint is None:
         print('hey i should not happen')
         return None
+    return limit_pending_files(bucket_name, prefix, checkpoint['latest'])
+
+
+def limit_pending_files(bucket_name, table_name, newest):
+    """Returns the newest file of a table this run reads.
+
+    If more than PENDING_FILES_PER_RUN files are pending, the run stops at
+    the last one it may read and the table is recorded in _carried, so
+    trigger_carried_run can start another run for the rest. The answer is
+    kept for the run, so every transform reading the table gets the same.
+
+    Args:
+        bucket_name (str): The ingestion bucket.
+        table_name (str): The totesys table.
+        newest (str): The newest file ingested for the table.
+
+    Returns:
+        str: The newest file to read.
+    """
+    stored = load_state()['data'].get(table_name, "null")
+    if not is_newer(newest, stored):
+        return newest
+    run_key = (bucket_name, table_name, stored, newest)
+    if run_key not in _run_latest:
+        latest = newest
+        pending = list_pending_objects(bucket_name, table_name, stored, newest)
+        if len(pending) > PENDING_FILES_PER_RUN:
+            latest = file_stem(pending[PENDING_FILES_PER_RUN - 1]['Key'])
+            _carried[table_name] = {'key': pending[-1]['Key'],
+                                    'etag': pending[-1]['ETag'],
+                                    'rows': 0, 'watermark': None, 'previous': None}
+            logger.info(f'Reading {PENDING_FILES_PER_RUN} of {len(pending)} pending '
+                        f'{table_name} files, the rest are carried over.')
+        _run_latest[run_key] = latest
+    return _run_latest[run_key]
+
+
+def _stash_conditional_headers(params, context, **kwargs):
+    for name, header in CONDITIONAL_HEADERS.items():
+        if name in params:
+            context.setdefault('conditional_headers', {})[header] = params.pop(name)
+
+
+def _add_conditional_headers(request, **kwargs):
+    for header, value in request.context.get('conditional_headers', {}).items():
+        request.headers[header] = value
+
+
+def get_checkpoint_client():
+    """Returns the S3 client shared by the lambda, creating it once.
+
+    The client's put_object accepts IfMatch and IfNoneMatch, which are sent
+    as the If-Match and If-None-Match headers S3 uses for conditional writes.
+
+    Returns:
+        boto3.client: An S3 client.
+    """
+    global _checkpoint_client
+    if _checkpoint_client is None:
+        client = boto3.client('s3')
+        client.meta.events.register(
+            'before-parameter-build.s3.PutObject', _stash_conditional_headers)
+        client.meta.events.register(
+            'before-sign.s3.PutObject', _add_conditional_headers)
+        _checkpoint_client = client
+    return _checkpoint_client
+
+
+def read_checkpoint(bucket_name, table_name):
+    """Reads the checkpoint of a table.
+
+    Args:
+        bucket_name (str): The bucket holding the table's files.
+        table_name (str): The table name.
+
+    Returns:
+        tuple: The checkpoint dictionary and its ETag, or (None, None) if
+        the table has no checkpoint yet.
+    """
+    s3 = get_checkpoint_client()
+    try:
+        res = s3.get_object(
+            Bucket=bucket_name, Key=f'{CHECKPOINT_PREFIX}/{table_name}.json')
+        return json.loads(res['Body'].read()), res['ETag']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None, None
+        logger.error(f'An error occurred while reading the {table_name} checkpoint: {e}')
+        raise e
+
+
+def find_latest_file(bucket_name, table_name):
+    """Finds the newest file of a table by listing all of its keys.
+
+    Args:
+        bucket_name (str): The bucket holding the table's files.
+        table_name (str): The table name, used as the key prefix.
+
+    Returns:
+        dict: A checkpoint for the newest file, or None if there are none.
+        For partitioned tables it lists every partition of that file.
+    """
+    s3 = get_checkpoint_client()
+    paginator = s3.get_paginator('list_objects_v2')
+    newest = None
+    partitions = []
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=f'{table_name}/'):
+        for obj in page.get('Contents', []):
+            latest = obj['Key'].split('/')[-1].split('.')[0]
+            date = datetime.strptime(latest, '%Y-%m-%d-%H-%M-%S')
+            if newest is None or date > newest[0]:
+                newest = (date, obj['Key'], latest)
+                partitions = []
+            if date == newest[0] and '=' in obj['Key']:
+                partitions.append(obj['Key'])
+    if newest is None:
+        return None
+    checkpoint = {'table': table_name, 'key': newest[1], 'latest': newest[2]}
+    if partitions:
+        checkpoint['partitions'] = partitions
+    return checkpoint
+
+
+def save_checkpoint(bucket_name, table_name, key, partitions=None):
+    """Records key as the newest file of a table.
+
+    The checkpoint is replaced with a conditional write against the ETag
+    that was read, so concurrent writers cannot overwrite each other. On a
+    conflict the checkpoint is read again and the write retried. A
+    checkpoint never moves back to an older file.
+
+    Args:
+        bucket_name (str): The bucket holding the table's files.
+        table_name (str): The table name.
+        key (str): The key of the file just written.
+        partitions (list): Every key written for a partitioned table.
+
+    Returns:
+        dict: The checkpoint as stored.
+    """
+    s3 = get_checkpoint_client()
+    latest = key.split('/')[-1].split('.')[0]
+    checkpoint = {'table': table_name, 'key': key, 'latest': latest}
+    if partitions:
+        checkpoint['partitions'] = list(partitions)
+    for attempt in range(CHECKPOINT_ATTEMPTS):
+        current, etag = read_checkpoint(bucket_name, table_name)
+        if current is not None and datetime.strptime(
+                current['latest'], '%Y-%m-%d-%H-%M-%S') >= datetime.strptime(
+                latest, '%Y-%m-%d-%H-%M-%S'):
+            return current
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            s3.put_object(Bucket=bucket_name,
+                          Key=f'{CHECKPOINT_PREFIX}/{table_name}.json',
+                          Body=json.dumps(checkpoint), **condition)
+            return checkpoint
+        except ClientError as e:
+            if e.response['Error']['Code'] not in CHECKPOINT_CONFLICTS:
+                logger.error(
+                    f'An error occurred while saving the {table_name} checkpoint: {e}')
+                raise e
+            logger.info(f'{table_name} checkpoint changed while saving, retrying.')
+    raise RuntimeError(
+        f'Could not save the {table_name} checkpoint after {CHECKPOINT_ATTEMPTS} attempts')
+
+
+def rebuild_checkpoint(bucket_name, table_name):
+    """Rebuilds the checkpoint of a table from the keys already in S3.
+
+    Args:
+        bucket_name (str): The bucket holding the table's files.
+        table_name (str): The table name.
+
+    Returns:
+        dict: The rebuilt checkpoint, or None if the table has no files.
+    """
+    newest = find_latest_file(bucket_name, table_name)
+    if newest is None:
+        return None
+    logger.info(f'Rebuilding the {table_name} checkpoint from {newest["key"]}.')
+    return save_checkpoint(bucket_name, table_name, newest['key'],
+                           newest.get('partitions'))
+
+
+def get_checkpoint(bucket_name, table_name):
+    """Returns the checkpoint of a table, rebuilding it if it is missing.
+
+    Args:
+        bucket_name (str): The bucket holding the table's files.
+        table_name (str): The table name.
+
+    Returns:
+        dict: The checkpoint, or None if the table has no files.
+    """
+    checkpoint, _ = read_checkpoint(bucket_name, table_name)
+    if checkpoint is None:
+        checkpoint = rebuild_checkpoint(bucket_name, table_name)
+    return checkpoint
 
 
 def extract_data_from_ingestion_s3(bucket, key):
@@ -128,7 +567,7 @@ def extract_data_from_ingestion_s3(bucket, key):
         Exception: If any other unexpected error occurs during the data extraction process.
     """
 
-    s3_client = boto3.client("s3")
+    s3_client = get_checkpoint_client()
     try:
         res = s3_client.get_object(Bucket=bucket, Key=key)
         json_data = res["Body"].read().decode()
@@ -141,6 +580,431 @@ def extract_data_from_ingestion_s3(bucket, key):
         raise e
 
 
+def get_ingestion_object(bucket_name, table_name, latest):
+    """Finds an ingested file, whatever format it was written in.
+
+    Args:
+        bucket_name (str): The ingestion bucket.
+        table_name (str): The totesys table, used as the key prefix.
+        latest (str): The file name without its extension.
+
+    Returns:
+        dict: The file's Key and ETag as listed by S3. If none is found the
+        JSON key is returned without an ETag.
+    """
+    s3 = get_checkpoint_client()
+    response = s3.list_objects_v2(
+        Bucket=bucket_name, Prefix=f'{table_name}/{latest}.')
+    for obj in response.get('Contents', []):
+        return obj
+    return {'Key': f'{table_name}/{latest}.json', 'ETag': None}
+
+
+def get_ingestion_key(bucket_name, table_name, latest):
+    """Finds the key of an ingested file, whatever format it was written in.
+
+    Args:
+        bucket_name (str): The ingestion bucket.
+        table_name (str): The totesys table, used as the key prefix.
+        latest (str): The file name without its extension.
+
+    Returns:
+        str: The key of the file, defaulting to the JSON key if none is found.
+    """
+    return get_ingestion_object(bucket_name, table_name, latest)['Key']
+
+
+def extract_dataframe_from_ingestion_s3(bucket, key):
+    """Reads an ingested file into a DataFrame.
+
+    Parquet files are read directly and keep the column types written by
+    the ingestion lambda. JSON files are expected to hold the rows under a
+    "data" key.
+
+    Args:
+        bucket (str): The name of the S3 bucket holding the file.
+        key (str): The key of the file, ending in .json or .parquet.
+
+    Returns:
+        pandas.DataFrame: One row per ingested row.
+    """
+    if key.endswith('.parquet'):
+        s3_client = get_checkpoint_client()
+        try:
+            res = s3_client.get_object(Bucket=bucket, Key=key)
+            return pd.read_parquet(io.BytesIO(res["Body"].read()))
+        except ClientError as e:
+            logger.error(f"An error occurred while retrieving data from S3: {e}")
+            raise e
+    json_data = json.loads(extract_data_from_ingestion_s3(bucket, key))
+    return pd.DataFrame(json_data["data"])
+
+
+def parse_ingestion_timestamps(column):
+    """Converts an ingested timestamp column to datetime64.
+
+    JSON files store timestamps as "%Y-%m-%d, %H:%M:%S:%f" strings, which
+    are parsed in one vectorised call. Parquet timestamps are returned as
+    they are.
+
+    Args:
+        column (pandas.Series): The created_at or last_updated column.
+
+    Returns:
+        pandas.Series: The column as datetime64 values.
+    """
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return column
+    return pd.to_datetime(column, format="%Y-%m-%d, %H:%M:%S:%f")
+
+
+def reset_ingestion_cache():
+    """Empties the ingestion cache and its counters at the start of a run."""
+    with _ingestion_cache_lock:
+        _ingestion_cache.clear()
+        _ingestion_cache_stats.update(hits=0, misses=0, bytes=0)
+
+
+def log_ingestion_cache():
+    """Logs how many ingested files were read from the cache this run."""
+    stats = dict(_ingestion_cache_stats)
+    logger.info(f"Ingestion cache: {stats['hits']} hits, {stats['misses']} misses, "
+                f"{stats['bytes'] / 1024 / 1024:.1f} MB held.")
+
+
+def read_ingestion_object(bucket_name, obj):
+    """Returns an ingested file as a DataFrame, reading it at most once per run.
+
+    Files are cached by bucket, key and ETag. The least recently used files
+    are dropped once the cache holds more than INGESTION_CACHE_BYTES. Each
+    caller gets its own copy, so transforms can change it freely.
+
+    Args:
+        bucket_name (str): The ingestion bucket.
+        obj (dict): The file's Key and ETag. Files without an ETag are not
+            cached.
+
+    Returns:
+        pandas.DataFrame: One row per ingested row.
+    """
+    cache_key = (bucket_name, obj['Key'], obj.get('ETag'))
+    with _ingestion_cache_lock:
+        cached = _ingestion_cache.get(cache_key)
+        if cached is not None:
+            _ingestion_cache.move_to_end(cache_key)
+            _ingestion_cache_stats['hits'] += 1
+            return cached[0].copy()
+        _ingestion_cache_stats['misses'] += 1
+    frame = extract_dataframe_from_ingestion_s3(bucket=bucket_name, key=obj['Key'])
+    size = int(frame.memory_usage(deep=True).sum())
+    if cache_key[2] is None or size > INGESTION_CACHE_BYTES:
+        return frame
+    with _ingestion_cache_lock:
+        if cache_key not in _ingestion_cache:
+            _ingestion_cache[cache_key] = (frame, size)
+            _ingestion_cache_stats['bytes'] += size
+        while _ingestion_cache_stats['bytes'] > INGESTION_CACHE_BYTES:
+            _, (_, evicted_size) = _ingestion_cache.popitem(last=False)
+            _ingestion_cache_stats['bytes'] -= evicted_size
+    return frame.copy()
+
+
+def list_pending_objects(bucket_name, table_name, stored, latest):
+    """Lists the ingested files of a table newer than stored, up to latest.
+
+    In a run started by a run manifest the files are taken from the
+    manifests if they account for all of them. Otherwise the bucket is
+    listed: file names are fixed width timestamps, so the listing starts
+    after the stored file and the names can be compared as strings.
+
+    Args:
+        bucket_name (str): The ingestion bucket.
+        table_name (str): The totesys table, used as the key prefix.
+        stored (str): The newest file already processed, or "null".
+        latest (str): The newest file to process.
+
+    Returns:
+        list: The Key and ETag of each pending file, oldest first.
+    """
+    if _run_manifest is not None:
+        pending = manifest_pending_objects(table_name, stored, latest)
+        if pending is not None:
+            return pending
+        logger.info(f'The run manifests miss some {table_name} files, listing them.')
+    s3 = get_checkpoint_client()
+    kwargs = {'Bucket': bucket_name, 'Prefix': f'{table_name}/'}
+    if stored not in (None, "null"):
+        kwargs['StartAfter'] = f'{table_name}/{stored}'
+    pending = []
+    for page in s3.get_paginator('list_objects_v2').paginate(**kwargs):
+        for obj in page.get('Contents', []):
+            stem = obj['Key'][len(table_name) + 1:].rsplit('.', 1)[0]
+            if (stored in (None, "null") or stem > stored) and stem <= latest:
+                pending.append(obj)
+    return pending
+
+
+def file_stem(key):
+    """Returns the file name of a key without its extension."""
+    return key.split('/')[-1].rsplit('.', 1)[0]
+
+
+def load_run_manifests(bucket_name, stage):
+    """Reads the run manifests written since the last one applied.
+
+    The newest manifest read is staged as the last one applied, so it is
+    recorded with the rest of the state by commit_state.
+
+    Args:
+        bucket_name (str): The bucket the stage writes its manifests to.
+        stage (str): The stage that wrote them, e.g. 'ingestion'.
+
+    Returns:
+        dict: Each table's manifest entries, oldest first, or None if no
+        manifest has been applied yet and the files have to be listed.
+    """
+    stored = load_state()['data'].get(RUN_MANIFEST_STATE)
+    prefix = f'{RUN_MANIFEST_PREFIX}/{stage}/'
+    kwargs = {'Bucket': bucket_name, 'Prefix': prefix}
+    if stored not in (None, "null"):
+        kwargs['StartAfter'] = f'{prefix}{stored}.json'
+    s3 = get_checkpoint_client()
+    tables = {}
+    newest = None
+    try:
+        for page in s3.get_paginator('list_objects_v2').paginate(**kwargs):
+            for obj in page.get('Contents', []):
+                res = s3.get_object(Bucket=bucket_name, Key=obj['Key'])
+                manifest = json.loads(res['Body'].read())
+                for table_name, entry in manifest['tables'].items():
+                    tables.setdefault(table_name, []).append(entry)
+                newest = manifest['run_id']
+    except ClientError as e:
+        logger.error(f'An error occurred while reading the {stage} run manifests: {e}')
+        raise e
+    if newest is not None:
+        processed_update(RUN_MANIFEST_STATE, newest)
+    logger.info(f'Read {len(tables)} tables from the {stage} run manifests.')
+    return tables if stored not in (None, "null") else None
+
+
+def manifest_pending_objects(table_name, stored, latest):
+    """Returns a table's pending files as recorded in the run manifests.
+
+    Every entry names the key the table had before its run, so the
+    entries after stored must follow on from each other. If they do not,
+    files were written by a run that never wrote its manifest.
+
+    Args:
+        table_name (str): The totesys table.
+        stored (str): The newest file already processed, or "null".
+        latest (str): The newest file to process.
+
+    Returns:
+        list: The Key and ETag of each pending file, oldest first, or None
+        if the manifests do not account for every file.
+    """
+    current = None if stored in (None, "null") else stored
+    pending = []
+    for entry in _run_manifest.get(table_name, []):
+        stem = file_stem(entry['key'])
+        if current is not None and stem <= current:
+            continue
+        if stem > latest:
+            break
+        previous = entry['previous'] and file_stem(entry['previous'])
+        if previous != current:
+            return None
+        pending.append({'Key': entry['key'], 'ETag': entry['etag']})
+        current = stem
+    return pending
+
+
+def coalesce_increments(frames, table_name):
+    """Concatenates increments and keeps the newest version of each row.
+
+    Args:
+        frames (list): DataFrames of the increments, oldest first.
+        table_name (str): The totesys table, used to find its primary key.
+
+    Returns:
+        pandas.DataFrame: One row per primary key, taken from the row with
+        the latest last_updated. Ties go to the later file.
+    """
+    frames = [frame for frame in frames if not frame.empty] or frames[:1]
+    if len(frames) == 1:
+        return frames[0]
+    combined = pd.concat(frames, ignore_index=True)
+    last_updated = pd.concat(
+        [parse_ingestion_timestamps(frame['last_updated']) for frame in frames],
+        ignore_index=True)
+    order = last_updated.sort_values(kind='stable').index
+    newest = combined.loc[order].drop_duplicates(
+        PRIMARY_KEYS[table_name], keep='last').index.sort_values()
+    return combined.loc[newest].reset_index(drop=True)
+
+
+def extract_pending_increments(bucket_name, table_name, latest):
+    """Reads every unprocessed increment of a table into one DataFrame.
+
+    The files newer than the date stored in processed_update.json, up to
+    latest, are read in order and coalesced by primary key, so a run that
+    starts after several ingestions transforms all of them at once. If
+    nothing is pending, the latest file is read on its own.
+
+    Args:
+        bucket_name (str): The ingestion bucket.
+        table_name (str): The totesys table.
+        latest (str): The newest file to read.
+
+    Returns:
+        pandas.DataFrame: The coalesced rows of the pending files.
+    """
+    stored = load_state()['data'].get(table_name, "null")
+    pending = list_pending_objects(bucket_name, table_name, stored, latest)
+    if not pending:
+        pending = [get_ingestion_object(bucket_name, table_name, latest)]
+    elif len(pending) > 1:
+        logger.info(f'Reading {len(pending)} pending {table_name} increments.')
+    frames = [read_ingestion_object(bucket_name, obj) for obj in pending]
+    return coalesce_increments(frames, table_name)
+
+
+def read_snapshot(table_name):
+    """Reads the stored snapshot of an entity table.
+
+    Args:
+        table_name (str): The totesys table.
+
+    Returns:
+        tuple: The snapshot DataFrame and its ETag, or (None, None) if the
+        table has no snapshot yet.
+    """
+    s3 = get_checkpoint_client()
+    try:
+        res = s3.get_object(Bucket=state_bucket,
+                            Key=f'{SNAPSHOT_PREFIX}/{table_name}.parquet')
+        return pd.read_parquet(io.BytesIO(res['Body'].read())), res['ETag']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None, None
+        logger.error(f'An error occurred while reading the {table_name} snapshot: {e}')
+        raise e
+
+
+def load_snapshot(bucket_name, table_name):
+    """Returns the current state of an entity table, one row per primary key.
+
+    The stored snapshot is merged with the increments not yet processed
+    and kept for the rest of the run. A table without a snapshot is built
+    once from all of its ingested files.
+
+    Args:
+        bucket_name (str): The ingestion bucket.
+        table_name (str): The totesys table.
+
+    Returns:
+        pandas.DataFrame: A copy of the table's current rows.
+    """
+    return _load_snapshot_entry(bucket_name, table_name)['frame'].copy()
+
+
+def _load_snapshot_entry(bucket_name, table_name):
+    with _snapshot_lock:
+        if table_name in _snapshots:
+            return _snapshots[table_name]
+    latest = get_latest_file_name(bucket_name, table_name)
+    snapshot, etag = read_snapshot(table_name)
+    stored = "null" if snapshot is None else load_state()['data'].get(table_name, "null")
+    pending = []
+    if latest is not None and is_newer(latest, stored):
+        pending = list_pending_objects(bucket_name, table_name, stored, latest)
+    frames = [read_ingestion_object(bucket_name, obj) for obj in pending]
+    if snapshot is not None:
+        frames.insert(0, snapshot)
+    frame = coalesce_increments(frames, table_name) if frames else pd.DataFrame()
+    with _snapshot_lock:
+        return _snapshots.setdefault(
+            table_name, {'frame': frame, 'etag': etag, 'changed': bool(pending),
+                         'indexes': {}})
+
+
+def snapshot_rows(bucket_name, table_name, column, keys):
+    """Looks up the snapshot rows of a table whose column holds one of keys.
+
+    The first lookup on a column builds an index from each value to the
+    positions of the rows holding it. Later lookups in the run only touch
+    the rows asked for.
+
+    Args:
+        bucket_name (str): The ingestion bucket.
+        table_name (str): The totesys table.
+        column (str): The column to look up, e.g. a primary or foreign key.
+        keys (iterable): The values to find.
+
+    Returns:
+        pandas.DataFrame: The matching rows, in snapshot order.
+    """
+    entry = _load_snapshot_entry(bucket_name, table_name)
+    frame = entry['frame']
+    index = entry['indexes'].get(column)
+    if index is None:
+        index = frame.groupby(column, sort=False).indices if not frame.empty else {}
+        index = entry['indexes'].setdefault(column, index)
+    positions = set()
+    for key in keys:
+        positions.update(index.get(key, ()))
+    return frame.iloc[sorted(positions)].reset_index(drop=True)
+
+
+def newest_file_name(*names):
+    """Returns the newest of several file names, ignoring "null"."""
+    return max(name for name in names if name not in (None, "null"))
+
+
+def save_snapshots():
+    """Writes the snapshots that changed during the run.
+
+    Each write is conditional on the ETag the snapshot was read with. If
+    another run has replaced it in the meantime it is read again and
+    merged, keeping the latest last_updated of each row, and the write is
+    retried.
+
+    Returns:
+        list: The names of the tables whose snapshot was written.
+    """
+    s3 = get_checkpoint_client()
+    saved = []
+    for table_name, snapshot in _snapshots.items():
+        if not snapshot['changed']:
+            continue
+        frame, etag = snapshot['frame'], snapshot['etag']
+        for attempt in range(CHECKPOINT_ATTEMPTS):
+            out_buffer = io.BytesIO()
+            frame.to_parquet(out_buffer, index=False)
+            condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+            try:
+                s3.put_object(Bucket=state_bucket,
+                              Key=f'{SNAPSHOT_PREFIX}/{table_name}.parquet',
+                              Body=out_buffer.getvalue(), **condition)
+                break
+            except ClientError as e:
+                if e.response['Error']['Code'] not in CHECKPOINT_CONFLICTS:
+                    logger.error(
+                        f'An error occurred while saving the {table_name} snapshot: {e}')
+                    raise e
+                logger.info(f'{table_name} snapshot changed while saving, retrying.')
+                current, etag = read_snapshot(table_name)
+                if current is not None:
+                    frame = coalesce_increments([current, frame], table_name)
+        else:
+            raise RuntimeError(
+                f'Could not save the {table_name} snapshot after '
+                f'{CHECKPOINT_ATTEMPTS} attempts')
+        saved.append(table_name)
+    return saved
+
+
 def upload_to_processing_s3(destination_bucket, destination_key, file_contents):
     """
     Uploads the provided file contents as a Parquet object to the specified S3 bucket.
@@ -158,7 +1022,7 @@ def upload_to_processing_s3(destination_bucket, destination_key, file_contents):
         None: The function does not return anything explicitly, but raises exceptions when
         necessary.
     """
-    s3_client = boto3.client("s3")
+    s3_client = get_checkpoint_client()
 
     try:
         s3_client.head_object(Bucket=destination_bucket, Key=destination_key)
@@ -189,63 +1053,288 @@ def upload_to_processing_s3(destination_bucket, destination_key, file_contents):
             raise e
 
 
-def trigger_lambda_warehouse():
-    s3 = boto3.client('s3')
+def write_fact_partition(destination_bucket, key, partition, sort_key):
+    """Uploads one partition of a fact table.
+
+    Rows are sorted by sort_key, so the row group statistics of the id
+    column do not overlap and readers can skip row groups by id.
+
+    Args:
+        destination_bucket (str): The processed bucket.
+        key (str): The partition's key.
+        partition (pandas.DataFrame): The partition's rows, without created_date.
+        sort_key (str): The column to sort the rows by.
+    """
+    out_buffer = io.BytesIO()
+    partition.sort_values(sort_key, kind='stable').to_parquet(
+        out_buffer, index=False, compression='zstd',
+        row_group_size=FACT_ROW_GROUP_SIZE, use_dictionary=True,
+        write_statistics=True)
     try:
-        res = s3.get_object(
-            Bucket="processed-bucket-1158020804995033", Key='warehouse_trigger.txt')
-        data = res['Body'].read().decode('utf-8')
-        s3.put_object(Bucket="processed-bucket-1158020804995033",
-                      Key='warehouse_trigger.txt', Body=data)
-        print('\nlambda 2 trigger........\n')
+        get_checkpoint_client().put_object(
+            Bucket=destination_bucket, Key=key, Body=out_buffer.getvalue())
     except ClientError as e:
-        logger.error(
-            f"An error occurred while retrieving warehouse_trigger.txt from S3: {e}")
+        logger.error(f"An error occurred while uploading data to S3: {e}")
         raise e
-    except Exception as e:
-        logger.error(f"An error occurred: {e}")
+
+
+def read_fact_manifest(bucket_name, table_name):
+    """Reads the manifest listing the current file of each partition.
+
+    Args:
+        bucket_name (str): The processed bucket.
+        table_name (str): A partitioned fact table.
+
+    Returns:
+        tuple: The manifest and its ETag. A table without a manifest gets
+        an empty one and None.
+    """
+    s3 = get_checkpoint_client()
+    try:
+        res = s3.get_object(Bucket=bucket_name,
+                            Key=f'{MANIFEST_PREFIX}/{table_name}.json')
+        return json.loads(res['Body'].read()), res['ETag']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return {'table': table_name, 'latest': None, 'partitions': {}}, None
+        logger.error(f'An error occurred while reading the {table_name} manifest: {e}')
         raise e
 
 
-def processed_update(table_name, latest):
+def upsert_fact_partitions(destination_bucket, destination_key, file_contents, sort_key):
+    """Merges changed fact rows into the created_date partitions they touch.
+
+    Each touched partition is copied into a new file with the changed rows
+    replacing the old versions of the same ids. The new file set is then
+    published by replacing the table's manifest, conditional on the ETag
+    it was read with, so readers see either all of the run's partitions or
+    none of them. On a conflict the merge is redone on top of the other
+    run's files. Partitions without changes are not read or written.
+
+    Args:
+        destination_bucket (str): The processed bucket.
+        destination_key (str): The unpartitioned key, '<table>/<file>.parquet'.
+        file_contents (pandas.DataFrame): The changed rows, with a created_date column.
+        sort_key (str): The fact's id column.
+
+    Returns:
+        list: The keys written, oldest partition first.
+    """
+    table_name, file_name = destination_key.split('/', 1)
+    changes = {f'{created_date:%Y-%m-%d}': partition.drop(columns=PARTITION_COLUMN)
+               for created_date, partition in file_contents.groupby(PARTITION_COLUMN)}
+    s3 = get_checkpoint_client()
+    for attempt in range(CHECKPOINT_ATTEMPTS):
+        manifest, etag = read_fact_manifest(destination_bucket, table_name)
+        keys = []
+        for created_date, changed in changes.items():
+            key = f'{table_name}/{PARTITION_COLUMN}={created_date}/{file_name}'
+            current = manifest['partitions'].get(created_date)
+            if current is not None:
+                res = s3.get_object(Bucket=destination_bucket, Key=current)
+                changed = pd.concat(
+                    [pd.read_parquet(io.BytesIO(res['Body'].read())), changed],
+                    ignore_index=True).drop_duplicates(sort_key, keep='last')
+            write_fact_partition(destination_bucket, key, changed, sort_key)
+            manifest['partitions'][created_date] = key
+            keys.append(key)
+        manifest['latest'] = file_name.split('.')[0]
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            s3.put_object(Bucket=destination_bucket,
+                          Key=f'{MANIFEST_PREFIX}/{table_name}.json',
+                          Body=json.dumps(manifest, sort_keys=True), **condition)
+            return keys
+        except ClientError as e:
+            if e.response['Error']['Code'] not in CHECKPOINT_CONFLICTS:
+                logger.error(f'An error occurred while saving the {table_name} manifest: {e}')
+                raise e
+            logger.info(f'{table_name} manifest changed while saving, merging again.')
+    raise RuntimeError(
+        f'Could not save the {table_name} manifest after {CHECKPOINT_ATTEMPTS} attempts')
+
+
+def new_run_id():
+    """Returns a unique id for a run manifest, sortable by time.
+
+    The time is given to the microsecond and followed by a random suffix,
+    so runs finishing in the same second still write different manifests.
+
+    Returns:
+        str: The id, e.g. '2022-11-03-14-20-49-123456-1f2e3d4c'.
+    """
+    return f"{datetime.utcnow().strftime('%Y-%m-%d-%H-%M-%S-%f')}-{uuid.uuid4().hex[:8]}"
+
+
+def trigger_lambda_warehouse(bucket_name, written):
+    """Starts the warehouse lambda by writing the run's manifest.
 
-    s3 = boto3.client('s3')
+    The manifest lists the checkpoint of every table written by the run,
+    with its row count, and is written once all of them are in place. It
+    is never overwritten. Runs that wrote nothing write no manifest.
+
+    Args:
+        bucket_name (str): The processed bucket.
+        written (dict): The checkpoint and rows of each table written.
+
+    Returns:
+        str: The manifest's key, or None if nothing was written.
+    """
+    if not written:
+        logger.info('Nothing written, the warehouse lambda is not triggered.')
+        return None
+    run_id = new_run_id()
+    manifest = {'stage': 'processed', 'run_id': run_id, 'bucket': bucket_name,
+                'tables': written}
+    key = f'{RUN_MANIFEST_PREFIX}/processed/{run_id}.json'
     try:
-        res = s3.get_object(
-            Bucket="processed-bucket-1158020804995033", Key='processed_update.json')
-        data = res['Body'].read().decode('utf-8')
-        data = json.loads(data)
-        if data[table_name] == "null":
-            data[table_name] = latest
-            skip = False
-        else:
-            new_file_date = datetime.strptime(latest, '%Y-%m-%d-%H-%M-%S')
-            json_date = datetime.strptime(
-                data[table_name], '%Y-%m-%d-%H-%M-%S')
-            if new_file_date > json_date:
-                data[table_name] = new_file_date.strftime('%Y-%m-%d-%H-%M-%S')
-                skip = False
-            else:
-                skip = True
-        new_file_name = data[table_name]
-        data = json.dumps(data)
-        s3.put_object(Bucket="processed-bucket-1158020804995033",
-                      Key='processed_update.json', Body=data)
-        return new_file_name, skip
+        get_checkpoint_client().put_object(
+            Bucket=bucket_name, Key=key,
+            Body=json.dumps(manifest, sort_keys=True), IfNoneMatch='*')
     except ClientError as e:
-        logger.error(
-            f"An error occurred while retrieving warehouse_update.json from S3: {e}")
+        logger.error(f"An error occurred while writing {key}: {e}")
         raise e
-    except Exception as e:
-        logger.error(f"An error occurred: {e}")
+    logger.info(f'Wrote {key}.')
+    return key
+
+
+def trigger_carried_run(bucket_name):
+    """Starts another run for the files this run carried over.
+
+    An ingestion run manifest is written naming the newest file of every
+    table carried over. Its entries have no previous key, so the next run
+    lists the files it has not read yet, again at most
+    PENDING_FILES_PER_RUN of each table. It is written after the state is
+    committed, so the next run starts after the files read by this one.
+
+    Args:
+        bucket_name (str): The ingestion bucket.
+
+    Returns:
+        str: The manifest's key, or None if nothing was carried over.
+    """
+    if not _carried:
+        return None
+    run_id = new_run_id()
+    manifest = {'stage': 'ingestion', 'run_id': run_id, 'bucket': bucket_name,
+                'tables': dict(_carried)}
+    key = f'{RUN_MANIFEST_PREFIX}/ingestion/{run_id}.json'
+    try:
+        get_checkpoint_client().put_object(
+            Bucket=bucket_name, Key=key,
+            Body=json.dumps(manifest, sort_keys=True), IfNoneMatch='*')
+    except ClientError as e:
+        logger.error(f"An error occurred while writing {key}: {e}")
         raise e
+    logger.info(f'Wrote {key} for {len(_carried)} tables carried over.')
+    return key
+
+
+def load_state(refresh=False):
+    """Returns the run's copy of processed_update.json, reading it once.
+
+    Args:
+        refresh (bool): Discard any state left by a previous invocation of
+            a warm container and read the file again.
+
+    Returns:
+        dict: The stored table dates ('data'), the ETag they were read
+        with ('etag') and the dates staged by this run ('changes').
+    """
+    global _state
+    if _state is None or refresh:
+        s3 = get_checkpoint_client()
+        try:
+            res = s3.get_object(Bucket=state_bucket, Key=STATE_KEY)
+        except ClientError as e:
+            logger.error(
+                f"An error occurred while retrieving {STATE_KEY} from S3: {e}")
+            raise e
+        _state = {'data': json.loads(res['Body'].read()),
+                  'etag': res['ETag'],
+                  'changes': {}}
+    return _state
+
+
+def is_newer(latest, stored):
+    """Returns True if the file name or run id latest is newer than stored.
+
+    Both start with a '%Y-%m-%d-%H-%M-%S' timestamp. Run ids go on with a
+    fixed width suffix, which orders the runs made within one second.
+    """
+    if stored is None or stored == "null":
+        return True
+    return ((datetime.strptime(latest[:19], '%Y-%m-%d-%H-%M-%S'), latest)
+            > (datetime.strptime(stored[:19], '%Y-%m-%d-%H-%M-%S'), stored))
+
+
+def processed_update(table_name, latest):
+    """Checks whether a table has a newer file and stages it if so.
+
+    The decision is made against the state as it was read at the start of
+    the run, so every transform that reads a table in the same run sees
+    the same answer. Nothing is written to S3 until commit_state.
+
+    Args:
+        table_name (str): The key in processed_update.json.
+        latest (str): The name of the newest file for the table.
+
+    Returns:
+        tuple: The file name to read and True if the table can be skipped.
+    """
+    state = load_state()
+    stored = state['data'].get(table_name, "null")
+    if latest is None or not is_newer(latest, stored):
+        return stored, True
+    with _state_lock:
+        if is_newer(latest, state['changes'].get(table_name)):
+            state['changes'][table_name] = latest
+    return latest, False
+
+
+def commit_state():
+    """Writes the dates staged by this run back to processed_update.json.
+
+    The write is conditional on the ETag that was read. If another run
+    has changed the file in the meantime it is read again, the staged
+    dates are reapplied on top of it, and the write is retried.
+
+    Returns:
+        dict: The state as written, or None if nothing was staged.
+    """
+    global _state
+    state = _state
+    _state = None
+    if state is None or not state['changes']:
+        return None
+    s3 = get_checkpoint_client()
+    for attempt in range(CHECKPOINT_ATTEMPTS):
+        data = dict(state['data'])
+        for table_name, latest in state['changes'].items():
+            if is_newer(latest, data.get(table_name)):
+                data[table_name] = latest
+        try:
+            s3.put_object(Bucket=state_bucket, Key=STATE_KEY,
+                          Body=json.dumps(data), IfMatch=state['etag'])
+            return data
+        except ClientError as e:
+            if e.response['Error']['Code'] not in CHECKPOINT_CONFLICTS:
+                logger.error(f"An error occurred while saving {STATE_KEY}: {e}")
+                raise e
+            logger.info(f'{STATE_KEY} changed while saving, retrying.')
+            res = s3.get_object(Bucket=state_bucket, Key=STATE_KEY)
+            state['data'] = json.loads(res['Body'].read())
+            state['etag'] = res['ETag']
+    raise RuntimeError(
+        f'Could not save {STATE_KEY} after {CHECKPOINT_ATTEMPTS} attempts')
 
 
 def create_dim_currency(bucket_name=None):
     """Creates a dimension table for currency data.
 
     The function extracts currency data from the ingestion S3 bucket, processes it, and returns
-    a pandas DataFrame containing relevant currency information.
+    a pandas DataFrame containing relevant currency information. Each name is looked up
+    from its code in CURRENCY_NAMES, so any number of rows can be processed.
 
     Returns:
         pandas.DataFrame: A dimension table containing currency data with the following columns:
@@ -258,24 +1347,21 @@ def create_dim_currency(bucket_name=None):
     try:
         latest = get_latest_file_name(bucket_name, "currency")
         latest, skip = processed_update('currency', latest)
-        key = f'currency/{latest}.json'
         key_parquet = f'dim_currency/{latest}.parquet'
 
         if skip:
             return pd.DataFrame(), key_parquet
         else:
-            json_currency = extract_data_from_ingestion_s3(
-                bucket="ingestion-bucket-1158020804995033", key=key
-            )
-            json_currency = json.loads(json_currency)
-            df_currency = pd.DataFrame(json_currency["data"])
-            dim_currency = df_currency.iloc[:, :2]
-            dim_currency["currency_name"] = ["pound", "dollar", "euro"]
+            df_currency = extract_pending_increments(bucket_name, 'currency', latest)
+            dim_currency = df_currency.iloc[:, :2].copy()
+            dim_currency["currency_name"] = dim_currency["currency_code"].map(
+                CURRENCY_NAMES).fillna(dim_currency["currency_code"])
             return dim_currency, key_parquet
     except Exception as e:
         logger.error(
             f"An error occurred while creating the dim_currency DataFrame: {e}"
         )
+        raise e
 
 
 def create_dim_design(bucket_name=None):
@@ -303,17 +1389,12 @@ def create_dim_design(bucket_name=None):
     try:
         latest = get_latest_file_name(bucket_name, "design")
         latest, skip = processed_update('design', latest)
-        key = f'design/{latest}.json'
         key_parquet = f'dim_design/{latest}.parquet'
 
         if skip:
             return pd.DataFrame(), key_parquet
         else:
-            json_design = extract_data_from_ingestion_s3(
-                bucket="ingestion-bucket-1158020804995033", key=key
-            )
-            json_design = json.loads(json_design)
-            df_design = pd.DataFrame(json_design["data"])
+            df_design = extract_pending_increments(bucket_name, 'design', latest)
             dim_design = df_design[
                 ["design_id", "design_name", "file_location", "file_name"]
             ]
@@ -321,6 +1402,7 @@ def create_dim_design(bucket_name=None):
     except Exception as e:
         logger.error(
             f"An error occurred while creating the dim_design DataFrame: {e}")
+        raise e
 
 
 def create_dim_staff(bucket_name=None):
@@ -358,27 +1440,29 @@ def create_dim_staff(bucket_name=None):
         latest_department = get_latest_file_name(bucket_name, "department")
         latest_department, skip = processed_update(
             'department', latest_department)
-        key_department = f'department/{latest_department}.json'
 
         latest_staff = get_latest_file_name(bucket_name, "staff")
         latest_staff, skip2 = processed_update('staff', latest_staff)
-        key_staff = f'staff/{latest_staff}.json'
         key_parquet = f'dim_staff/{latest_staff}.parquet'
 
         if skip and skip2:
             return pd.DataFrame(), key_parquet
         else:
-            json_department = extract_data_from_ingestion_s3(
-                bucket="ingestion-bucket-1158020804995033", key=key_department
-            )
-            key_parquet = f'dim_staff/{latest_staff}.parquet'
-            json_staff = extract_data_from_ingestion_s3(
-                bucket="ingestion-bucket-1158020804995033", key=key_staff
-            )
-            json_department = json.loads(json_department)
-            df_department = pd.DataFrame(json_department["data"])
-            json_staff = json.loads(json_staff)
-            df_staff1 = pd.DataFrame(json_staff["data"])
+            # Only the staff that changed, or whose department changed,
+            # are rebuilt.
+            key_parquet = f'dim_staff/{newest_file_name(latest_staff, latest_department)}.parquet'
+            staff_ids = set()
+            if not skip2:
+                staff_ids.update(extract_pending_increments(
+                    bucket_name, 'staff', latest_staff)['staff_id'])
+            if not skip:
+                department_ids = extract_pending_increments(
+                    bucket_name, 'department', latest_department)['department_id']
+                staff_ids.update(snapshot_rows(
+                    bucket_name, 'staff', 'department_id', department_ids)['staff_id'])
+            df_staff1 = snapshot_rows(bucket_name, 'staff', 'staff_id', staff_ids)
+            df_department = snapshot_rows(
+                bucket_name, 'department', 'department_id', df_staff1['department_id'])
             df_staff = df_staff1.merge(
                 df_department[["department_id",
                                "department_name", "location"]],
@@ -393,6 +1477,7 @@ def create_dim_staff(bucket_name=None):
     except Exception as e:
         logger.error(
             f"An error occurred while creating the dim_staff DataFrame: {e}")
+        raise e
 
 
 def create_dim_location(bucket_name=None):
@@ -427,16 +1512,11 @@ def create_dim_location(bucket_name=None):
     try:
         latest = get_latest_file_name(bucket_name, "address")
         latest, skip = processed_update('address', latest)
-        key = f'address/{latest}.json'
         key_parquet = f'dim_location/{latest}.parquet'
         if skip:
             return pd.DataFrame(), key_parquet
         else:
-            json_location = extract_data_from_ingestion_s3(
-                bucket="ingestion-bucket-1158020804995033", key=key
-            )
-            json_location = json.loads(json_location)
-            df_location = pd.DataFrame(json_location["data"])
+            df_location = extract_pending_increments(bucket_name, 'address', latest)
             dim_location = df_location[
                 [
                     "address_id",
@@ -456,6 +1536,7 @@ def create_dim_location(bucket_name=None):
         logger.error(
             f"An error occurred while creating the dim_location DataFrame: {e}"
         )
+        raise e
 
 
 def create_dim_counterparty(bucket_name=None):
@@ -494,26 +1575,31 @@ def create_dim_counterparty(bucket_name=None):
         latest_counterparty, skip = processed_update(
             'counterparty', latest_counterparty)
         key_parquet = f'dim_counterparty/{latest_counterparty}.parquet'
-        key_counterparty = f'counterparty/{latest_counterparty}.json'
 
         latest_address = get_latest_file_name(bucket_name, "address")
         latest_address, skip2 = processed_update('address', latest_address)
-        key_address = f'address/{latest_address}.json'
 
         if skip and skip2:
             return pd.DataFrame(), key_parquet
         else:
-            json_counterparty = extract_data_from_ingestion_s3(
-                bucket="ingestion-bucket-1158020804995033", key=key_counterparty
-            )
-
-            json_location = extract_data_from_ingestion_s3(
-                bucket="ingestion-bucket-1158020804995033", key=key_address
-            )
-            json_counterparty = json.loads(json_counterparty)
-            df_counterparty = pd.DataFrame(json_counterparty["data"])
-            json_location = json.loads(json_location)
-            df_location = pd.DataFrame(json_location["data"])
+            # Only the counterparties that changed, or whose legal address
+            # changed, are rebuilt.
+            key_parquet = ('dim_counterparty/'
+                           f'{newest_file_name(latest_counterparty, latest_address)}.parquet')
+            counterparty_ids = set()
+            if not skip:
+                counterparty_ids.update(extract_pending_increments(
+                    bucket_name, 'counterparty', latest_counterparty)['counterparty_id'])
+            if not skip2:
+                address_ids = extract_pending_increments(
+                    bucket_name, 'address', latest_address)['address_id']
+                counterparty_ids.update(snapshot_rows(
+                    bucket_name, 'counterparty', 'legal_address_id',
+                    address_ids)['counterparty_id'])
+            df_counterparty = snapshot_rows(
+                bucket_name, 'counterparty', 'counterparty_id', counterparty_ids)
+            df_location = snapshot_rows(
+                bucket_name, 'address', 'address_id', df_counterparty['legal_address_id'])
             dim_counterparty = pd.merge(
                 df_counterparty,
                 df_location,
@@ -551,6 +1637,7 @@ def create_dim_counterparty(bucket_name=None):
         logger.error(
             f"An error occurred while creating the dim_counterparty DataFrame: {e}"
         )
+        raise e
 
 
 def create_dim_date(bucket_name=None):
@@ -579,6 +1666,7 @@ def create_dim_date(bucket_name=None):
     except Exception as e:
         logger.error(
             f"An error occurred while creating the dim_date DataFrame: {e}")
+        raise e
 
 
 def create_dim_transaction(bucket_name=None):
@@ -604,16 +1692,11 @@ def create_dim_transaction(bucket_name=None):
     try:
         latest = get_latest_file_name(bucket_name, "transaction")
         latest, skip = processed_update('transaction', latest)
-        key = f'transaction/{latest}.json'
         key_parquet = f'dim_transaction/{latest}.parquet'
         if skip:
             return pd.DataFrame(), key_parquet
         else:
-            json_transaction_data = extract_data_from_ingestion_s3(
-                bucket="ingestion-bucket-1158020804995033", key=key
-            )
-            json_transaction_data = json.loads(json_transaction_data)
-            df_transaction = pd.DataFrame(json_transaction_data["data"])
+            df_transaction = extract_pending_increments(bucket_name, 'transaction', latest)
             dim_transaction = df_transaction.drop(
                 ["created_at", "last_updated"], axis=1)
             dim_transaction[["sales_order_id", "purchase_order_id"]] = (
@@ -626,6 +1709,7 @@ def create_dim_transaction(bucket_name=None):
         logger.error(
             f"An error occurred while creating the dim_transaction DataFrame: {e}"
         )
+        raise e
 
 
 def create_dim_payment_type(bucket_name=None):
@@ -633,16 +1717,11 @@ def create_dim_payment_type(bucket_name=None):
     try:
         latest = get_latest_file_name(bucket_name, "payment_type")
         latest, skip = processed_update('payment_type', latest)
-        key = f'payment_type/{latest}.json'
         key_parquet = f'dim_payment_type/{latest}.parquet'
         if skip:
             return pd.DataFrame(), key_parquet
         else:
-            json_payment_type_data = extract_data_from_ingestion_s3(
-                bucket="ingestion-bucket-1158020804995033", key=key
-            )
-            json_payment_type_data = json.loads(json_payment_type_data)
-            df_payment_type = pd.DataFrame(json_payment_type_data["data"])
+            df_payment_type = extract_pending_increments(bucket_name, 'payment_type', latest)
             dim_payment_type = df_payment_type.drop(
                 ["created_at", "last_updated"], axis=1)
             return dim_payment_type, key_parquet
@@ -650,6 +1729,7 @@ def create_dim_payment_type(bucket_name=None):
         logger.error(
             f"An error occurred while creating the dim_payment_type DataFrame: {e}"
         )
+        raise e
 
 
 def create_fact_sales_order(bucket_name=None):
@@ -675,22 +1755,17 @@ def create_fact_sales_order(bucket_name=None):
     try:
         latest = get_latest_file_name(bucket_name, "sales_order")
         latest, skip = processed_update('sales_order', latest)
-        key = f'sales_order/{latest}.json'
         key_parquet = f'fact_sales_order/{latest}.parquet'
         if skip:
             return pd.DataFrame(), key_parquet
         else:
-            json_sales_order = extract_data_from_ingestion_s3(
-                bucket="ingestion-bucket-1158020804995033", key=key
-            )
-            json_sales_order = json.loads(json_sales_order)
-            df_sales_order = pd.DataFrame(json_sales_order["data"])
-            df_sales_order[["created_date", "created_time"]] = df_sales_order[
-                "created_at"
-            ].str.split(", ", expand=True)
-            df_sales_order[["last_updated_date", "last_updated_time"]] = df_sales_order[
-                "last_updated"
-            ].str.split(", ", expand=True)
+            df_sales_order = extract_pending_increments(bucket_name, 'sales_order', latest)
+            created_at = parse_ingestion_timestamps(df_sales_order["created_at"])
+            last_updated = parse_ingestion_timestamps(df_sales_order["last_updated"])
+            df_sales_order["created_date"] = created_at.dt.normalize()
+            df_sales_order["created_time"] = created_at.dt.floor("s").dt.time
+            df_sales_order["last_updated_date"] = last_updated.dt.normalize()
+            df_sales_order["last_updated_time"] = last_updated.dt.floor("s").dt.time
             fact_sales_order = df_sales_order[
                 [
                     "sales_order_id",
@@ -711,24 +1786,6 @@ def create_fact_sales_order(bucket_name=None):
             ].copy()
             fact_sales_order["unit_price"] = pd.to_numeric(
                 fact_sales_order["unit_price"])
-            fact_sales_order["created_date"] = pd.to_datetime(
-                fact_sales_order["created_date"]
-            )
-            fact_sales_order["created_time"] = (
-                pd.to_datetime(
-                    fact_sales_order["created_time"], format="%H:%M:%S:%f")
-                .dt.floor("s")
-                .dt.time
-            )
-            fact_sales_order["last_updated_date"] = pd.to_datetime(
-                fact_sales_order["last_updated_date"]
-            )
-            fact_sales_order["last_updated_time"] = (
-                pd.to_datetime(
-                    fact_sales_order["last_updated_time"], format="%H:%M:%S:%f")
-                .dt.floor("s")
-                .dt.time
-            )
             fact_sales_order["agreed_payment_date"] = pd.to_datetime(
                 fact_sales_order["agreed_payment_date"]
             )
@@ -740,25 +1797,24 @@ def create_fact_sales_order(bucket_name=None):
     except Exception as e:
         logger.error(
             f"An error occurred while creating the fact_sales DataFrame: {e}")
+        raise e
 
 
 def create_fact_purchase_order(bucket_name=None):
     try:
         latest = get_latest_file_name(bucket_name, "purchase_order")
         latest, skip = processed_update('purchase_order', latest)
-        key = f'purchase_order/{latest}.json'
         key_parquet = f'fact_purchase_order/{latest}.parquet'
         if skip:
             return pd.DataFrame(), key_parquet
         else:
-            json_purchase_order = extract_data_from_ingestion_s3(
-                bucket='ingestion-bucket-1158020804995033', key=key)
-            json_purchase_order = json.loads(json_purchase_order)
-            df_purchase_order = pd.DataFrame(json_purchase_order['data'])
-            df_purchase_order[['created_date', 'created_time']
-                              ] = df_purchase_order['created_at'].str.split(', ', expand=True)
-            df_purchase_order[['last_updated_date', 'last_updated_time']
-                              ] = df_purchase_order['last_updated'].str.split(', ', expand=True)
+            df_purchase_order = extract_pending_increments(bucket_name, 'purchase_order', latest)
+            created_at = parse_ingestion_timestamps(df_purchase_order['created_at'])
+            last_updated = parse_ingestion_timestamps(df_purchase_order['last_updated'])
+            df_purchase_order['created_date'] = created_at.dt.normalize()
+            df_purchase_order['created_time'] = created_at.dt.floor('s').dt.time
+            df_purchase_order['last_updated_date'] = last_updated.dt.normalize()
+            df_purchase_order['last_updated_time'] = last_updated.dt.floor('s').dt.time
             fact_purchase_order = df_purchase_order[[
                 'purchase_order_id',
                 'created_date',
@@ -776,14 +1832,6 @@ def create_fact_purchase_order(bucket_name=None):
                 'agreed_delivery_location_id']].copy()
             fact_purchase_order['item_unit_price'] = pd.to_numeric(
                 fact_purchase_order['item_unit_price'])
-            fact_purchase_order['created_date'] = pd.to_datetime(
-                fact_purchase_order['created_date'])
-            fact_purchase_order['created_time'] = pd.to_datetime(
-                fact_purchase_order['created_time'], format='%H:%M:%S:%f').dt.floor('s').dt.time
-            fact_purchase_order['last_updated_date'] = pd.to_datetime(
-                fact_purchase_order['last_updated_date'])
-            fact_purchase_order['last_updated_time'] = pd.to_datetime(
-                fact_purchase_order['last_updated_time'], format='%H:%M:%S:%f').dt.floor('s').dt.time
             fact_purchase_order['agreed_payment_date'] = pd.to_datetime(
                 fact_purchase_order['agreed_payment_date'])
             fact_purchase_order['agreed_delivery_date'] = pd.to_datetime(
@@ -793,6 +1841,7 @@ def create_fact_purchase_order(bucket_name=None):
         logger.error(
             f"An error occurred while creating the fact_purchase_order DataFrame: {e}"
         )
+        raise e
 
 
 def create_fact_payment(bucket_name=None):
@@ -800,19 +1849,17 @@ def create_fact_payment(bucket_name=None):
     try:
         latest = get_latest_file_name(bucket_name, "payment")
         latest, skip = processed_update('payment', latest)
-        key = f'payment/{latest}.json'
         key_parquet = f'fact_payment/{latest}.parquet'
         if skip:
             return pd.DataFrame(), key_parquet
         else:
-            json_payment = extract_data_from_ingestion_s3(
-                bucket='ingestion-bucket-1158020804995033', key=key)
-            json_payment = json.loads(json_payment)
-            df_payment = pd.DataFrame(json_payment['data'])
-            df_payment[['created_date', 'created_time']
-                       ] = df_payment['created_at'].str.split(', ', expand=True)
-            df_payment[['last_updated_date', 'last_updated']
-                       ] = df_payment['last_updated'].str.split(', ', expand=True)
+            df_payment = extract_pending_increments(bucket_name, 'payment', latest)
+            created_at = parse_ingestion_timestamps(df_payment['created_at'])
+            last_updated = parse_ingestion_timestamps(df_payment['last_updated'])
+            df_payment['created_date'] = created_at.dt.normalize()
+            df_payment['created_time'] = created_at.dt.floor('s').dt.time
+            df_payment['last_updated_date'] = last_updated.dt.normalize()
+            df_payment['last_updated'] = last_updated.dt.floor('s').dt.time
             fact_payment = df_payment[[
                 'payment_id',
                 'created_date',
@@ -828,14 +1875,6 @@ def create_fact_payment(bucket_name=None):
                 'payment_date']].copy()
             fact_payment['payment_amount'] = pd.to_numeric(
                 fact_payment['payment_amount'])
-            fact_payment['created_date'] = pd.to_datetime(
-                fact_payment['created_date'])
-            fact_payment['created_time'] = pd.to_datetime(
-                fact_payment['created_time'], format='%H:%M:%S:%f').dt.floor('s').dt.time
-            fact_payment['last_updated_date'] = pd.to_datetime(
-                fact_payment['last_updated_date'])
-            fact_payment['last_updated'] = pd.to_datetime(
-                fact_payment['last_updated'], format='%H:%M:%S:%f').dt.floor('s').dt.time
             fact_payment['payment_date'] = pd.to_datetime(
                 fact_payment['payment_date'])
             return fact_payment, key_parquet
@@ -843,3 +1882,4 @@ def create_fact_payment(bucket_name=None):
         logger.error(
             f"An error occurred while creating the fact_payment DataFrame: {e}"
         )
+        raise e
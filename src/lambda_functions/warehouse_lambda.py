@@ -7,7 +7,6 @@ import json
 import io
 import time
 from datetime import datetime
-from pprint import pprint
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -15,34 +14,124 @@ logger.setLevel(logging.INFO)
 
 processed_bucket = "processed-bucket-1158020804995033"
 
+# Warehouse tables in load order, dimensions before facts. 'rename' maps
+# processed parquet columns onto warehouse columns where they differ.
+WAREHOUSE_TABLES = {
+    'dim_counterparty': {
+        'primary_key': 'counterparty_id',
+        'columns': ['counterparty_id', 'counterparty_legal_name',
+                    'counterparty_legal_address_line_1',
+                    'counterparty_legal_address_line_2',
+                    'counterparty_legal_district', 'counterparty_legal_city',
+                    'counterparty_legal_postal_code',
+                    'counterparty_legal_country',
+                    'counterparty_legal_phone_number']},
+    'dim_currency': {
+        'primary_key': 'currency_id',
+        'columns': ['currency_id', 'currency_code', 'currency_name']},
+    'dim_design': {
+        'primary_key': 'design_id',
+        'columns': ['design_id', 'design_name', 'file_location', 'file_name']},
+    'dim_location': {
+        'primary_key': 'location_id',
+        'columns': ['location_id', 'address_line_1', 'address_line_2',
+                    'district', 'city', 'postal_code', 'country', 'phone']},
+    'dim_staff': {
+        'primary_key': 'staff_id',
+        'columns': ['staff_id', 'first_name', 'last_name', 'email_address',
+                    'department_name', 'location']},
+    'dim_payment_type': {
+        'primary_key': 'payment_type_id',
+        'columns': ['payment_type_id', 'payment_type_name']},
+    'dim_transaction': {
+        'primary_key': 'transaction_id',
+        'columns': ['transaction_id', 'transaction_type', 'sales_order_id',
+                    'purchase_order_id']},
+    'fact_sales_order': {
+        'primary_key': 'sales_order_id',
+        'rename': {'staff_id': 'sales_staff_id'},
+        'columns': ['sales_order_id', 'created_date', 'created_time',
+                    'last_updated_date', 'last_updated_time',
+                    'sales_staff_id', 'counterparty_id', 'units_sold',
+                    'unit_price', 'currency_id', 'design_id',
+                    'agreed_payment_date', 'agreed_delivery_date',
+                    'agreed_delivery_location_id']},
+    'fact_purchase_order': {
+        'primary_key': 'purchase_order_id',
+        'columns': ['purchase_order_id', 'created_date', 'created_time',
+                    'last_updated_date', 'last_updated_time', 'staff_id',
+                    'counterparty_id', 'item_code', 'item_quantity',
+                    'item_unit_price', 'currency_id', 'agreed_delivery_date',
+                    'agreed_payment_date', 'agreed_delivery_location_id']},
+    'fact_payment': {
+        'primary_key': 'payment_id',
+        'rename': {'last_updated': 'last_updated_time'},
+        'columns': ['payment_id', 'created_date', 'created_time',
+                    'last_updated_date', 'last_updated_time',
+                    'transaction_id', 'counterparty_id', 'payment_amount',
+                    'currency_id', 'payment_type_id', 'paid',
+                    'payment_date']},
+}
+
+DATE_TABLE = {
+    'primary_key': 'date_id',
+    'columns': ['date_id', 'year', 'month', 'day', 'day_of_week',
+                'day_name', 'month_name', 'quarter']}
+
+_unique_keys = {}
+
+# Fact tables may be written as Hive style partitions of created_date, in
+# which case their checkpoint lists the partitions of the newest file and
+# table_manifests/<table>.json the current file of every partition.
+PARTITION_COLUMN = 'created_date'
+MANIFEST_PREFIX = 'table_manifests'
+
+# Kept between warm invocations of the Lambda container.
+_credentials = None
+_connection = None
+
+# The newest file of each table is recorded in checkpoints/<table>.json, so
+# finding it is one GET instead of a listing of the table's history. The
+# checkpoints are replaced with conditional writes.
+CHECKPOINT_PREFIX = 'checkpoints'
+CHECKPOINT_ATTEMPTS = 5
+CHECKPOINT_CONFLICTS = ('PreconditionFailed', 'ConditionalRequestConflict', '409', '412')
+CONDITIONAL_HEADERS = {'IfMatch': 'If-Match', 'IfNoneMatch': 'If-None-Match'}
+_checkpoint_client = None
+
+# warehouse_update.json is read once per run into _state. warehouse_update
+# stages changes there and commit_state writes them back in one request.
+state_bucket = processed_bucket
+STATE_KEY = 'warehouse_update.json'
+_state = None
+
+# The processed lambda starts a run by writing run_manifests/processed/
+# <run>.json with the checkpoint of every table it wrote. The manifests not
+# yet applied, recorded as 'run_manifest' in warehouse_update.json, say
+# which tables to load and from which keys, so no checkpoint is read.
+RUN_MANIFEST_PREFIX = 'run_manifests'
+RUN_MANIFEST_STATE = 'run_manifest'
+_run_manifest = None
+
 
 def lambda_handler(event, context):
-    # Get secret
-    secret_string = get_secret()
-    warehouse = json.loads(secret_string)
-    user = warehouse["User"]
-    host = warehouse["Host"]
-    db = warehouse["Schema"]
-    port = warehouse["Port"]
-    password = warehouse["Password"]
+    global _run_manifest
     s3_bucket_name, s3_object_name = get_object_path(event["Records"])
-    if s3_object_name == "warehouse_trigger.txt":
+    # warehouse_trigger.txt still starts a run that reads every checkpoint.
+    manifest_run = s3_object_name.startswith(f'{RUN_MANIFEST_PREFIX}/processed/')
+    if s3_object_name == "warehouse_trigger.txt" or manifest_run:
         try:
             # delete_tables_in_order(user, host, db, port, password)
-            table_utils = {'dim_counterparty': counterparty_util,
-                           'dim_currency': currency_util,
-                           'dim_design': design_util,
-                           'dim_location': location_util,
-                           'dim_staff': staff_util,
-                           'dim_payment_type': payment_type_util,
-                           'dim_transaction': transaction_util,
-                           'fact_sales_order': sales_order_util,
-                           'fact_purchase_order': purchase_order_util,
-                           'fact_payment': payment_util}
-
-            for table_name, util_func in table_utils.items():
+            load_state(refresh=True)
+            _run_manifest = None
+            if manifest_run:
+                _run_manifest = load_run_manifests(processed_bucket, 'processed')
+            conn = get_connection()
+            # Every table is loaded in one transaction so the star schema is
+            # never visible half loaded.
+            for table_name in WAREHOUSE_TABLES:
                 start_time = time.time()
-                skipped = util_func(user, host, db, port, password)
+                skipped = table_util(conn, table_name)
                 if skipped:
                     end_time = time.time()
                     logger.info(
@@ -59,10 +148,16 @@ def lambda_handler(event, context):
                     print(
                         f'{table_name} uploaded to the data warehouse:\
                         {end_time - start_time} seconds to execute.')
+            conn.commit()
+            # Only recorded once the data is committed, so a failed run is
+            # loaded again by the next one.
+            commit_state()
 
         except ClientError as e:
+            rollback_connection()
             logger.error(f"An S3 has occurred: {e}")
         except Exception as e:
+            rollback_connection()
             logger.error(f"An Error has occurred: {e}")
 
 
@@ -102,27 +197,175 @@ def delete_tables_in_order(user, host, db, port, password):
 
 
 def get_latest_file_name(prefix):
-    bucket_name = "processed-bucket-1158020804995033"
-    s3 = boto3.client('s3')
-
-    response = s3.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
-    dates = []
-    file_names = []
-    for obj in response.get('Contents', []):
-        key = obj['Key']
-        file_name = key.split('/')[-1].split('.')[0]
-        date_string = file_name.split('.')[0]
-        date = datetime.strptime(date_string, '%Y-%m-%d-%H-%M-%S')
-        dates.append(date)
-        file_names.append(file_name)
-
-    if dates:
-        latest_date_index = dates.index(max(dates))
-        latest_file_name = file_names[latest_date_index]
-        print(f'\n latest filename = {prefix}/{latest_file_name}')
-        return latest_file_name
-    else:
+    checkpoint = get_checkpoint(processed_bucket, prefix)
+    if checkpoint is None:
         return None
+    print(f'\n latest filename = {prefix}/{checkpoint["latest"]}')
+    return checkpoint['latest']
+
+
+def _stash_conditional_headers(params, context, **kwargs):
+    for name, header in CONDITIONAL_HEADERS.items():
+        if name in params:
+            context.setdefault('conditional_headers', {})[header] = params.pop(name)
+
+
+def _add_conditional_headers(request, **kwargs):
+    for header, value in request.context.get('conditional_headers', {}).items():
+        request.headers[header] = value
+
+
+def get_checkpoint_client():
+    """Returns the S3 client used for checkpoints, creating it once.
+
+    The client's put_object accepts IfMatch and IfNoneMatch, which are sent
+    as the If-Match and If-None-Match headers S3 uses for conditional writes.
+
+    Returns:
+        boto3.client: An S3 client.
+    """
+    global _checkpoint_client
+    if _checkpoint_client is None:
+        client = boto3.client('s3')
+        client.meta.events.register(
+            'before-parameter-build.s3.PutObject', _stash_conditional_headers)
+        client.meta.events.register(
+            'before-sign.s3.PutObject', _add_conditional_headers)
+        _checkpoint_client = client
+    return _checkpoint_client
+
+
+def read_checkpoint(bucket_name, table_name):
+    """Reads the checkpoint of a table.
+
+    Args:
+        bucket_name (str): The bucket holding the table's files.
+        table_name (str): The table name.
+
+    Returns:
+        tuple: The checkpoint dictionary and its ETag, or (None, None) if
+        the table has no checkpoint yet.
+    """
+    s3 = get_checkpoint_client()
+    try:
+        res = s3.get_object(
+            Bucket=bucket_name, Key=f'{CHECKPOINT_PREFIX}/{table_name}.json')
+        return json.loads(res['Body'].read()), res['ETag']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None, None
+        logger.error(f'An error occurred while reading the {table_name} checkpoint: {e}')
+        raise e
+
+
+def find_latest_file(bucket_name, table_name):
+    """Finds the newest file of a table by listing all of its keys.
+
+    Args:
+        bucket_name (str): The bucket holding the table's files.
+        table_name (str): The table name, used as the key prefix.
+
+    Returns:
+        dict: A checkpoint for the newest file, or None if there are none.
+        For partitioned tables it lists every partition of that file.
+    """
+    s3 = get_checkpoint_client()
+    paginator = s3.get_paginator('list_objects_v2')
+    newest = None
+    partitions = []
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=f'{table_name}/'):
+        for obj in page.get('Contents', []):
+            latest = obj['Key'].split('/')[-1].split('.')[0]
+            date = datetime.strptime(latest, '%Y-%m-%d-%H-%M-%S')
+            if newest is None or date > newest[0]:
+                newest = (date, obj['Key'], latest)
+                partitions = []
+            if date == newest[0] and '=' in obj['Key']:
+                partitions.append(obj['Key'])
+    if newest is None:
+        return None
+    checkpoint = {'table': table_name, 'key': newest[1], 'latest': newest[2]}
+    if partitions:
+        checkpoint['partitions'] = partitions
+    return checkpoint
+
+
+def save_checkpoint(bucket_name, table_name, key, partitions=None):
+    """Records key as the newest file of a table.
+
+    The checkpoint is replaced with a conditional write against the ETag
+    that was read, so concurrent writers cannot overwrite each other. On a
+    conflict the checkpoint is read again and the write retried. A
+    checkpoint never moves back to an older file.
+
+    Args:
+        bucket_name (str): The bucket holding the table's files.
+        table_name (str): The table name.
+        key (str): The key of the file just written.
+        partitions (list): Every key written for a partitioned table.
+
+    Returns:
+        dict: The checkpoint as stored.
+    """
+    s3 = get_checkpoint_client()
+    latest = key.split('/')[-1].split('.')[0]
+    checkpoint = {'table': table_name, 'key': key, 'latest': latest}
+    if partitions:
+        checkpoint['partitions'] = list(partitions)
+    for attempt in range(CHECKPOINT_ATTEMPTS):
+        current, etag = read_checkpoint(bucket_name, table_name)
+        if current is not None and datetime.strptime(
+                current['latest'], '%Y-%m-%d-%H-%M-%S') >= datetime.strptime(
+                latest, '%Y-%m-%d-%H-%M-%S'):
+            return current
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            s3.put_object(Bucket=bucket_name,
+                          Key=f'{CHECKPOINT_PREFIX}/{table_name}.json',
+                          Body=json.dumps(checkpoint), **condition)
+            return checkpoint
+        except ClientError as e:
+            if e.response['Error']['Code'] not in CHECKPOINT_CONFLICTS:
+                logger.error(
+                    f'An error occurred while saving the {table_name} checkpoint: {e}')
+                raise e
+            logger.info(f'{table_name} checkpoint changed while saving, retrying.')
+    raise RuntimeError(
+        f'Could not save the {table_name} checkpoint after {CHECKPOINT_ATTEMPTS} attempts')
+
+
+def rebuild_checkpoint(bucket_name, table_name):
+    """Rebuilds the checkpoint of a table from the keys already in S3.
+
+    Args:
+        bucket_name (str): The bucket holding the table's files.
+        table_name (str): The table name.
+
+    Returns:
+        dict: The rebuilt checkpoint, or None if the table has no files.
+    """
+    newest = find_latest_file(bucket_name, table_name)
+    if newest is None:
+        return None
+    logger.info(f'Rebuilding the {table_name} checkpoint from {newest["key"]}.')
+    return save_checkpoint(bucket_name, table_name, newest['key'],
+                           newest.get('partitions'))
+
+
+def get_checkpoint(bucket_name, table_name):
+    """Returns the checkpoint of a table, rebuilding it if it is missing.
+
+    Args:
+        bucket_name (str): The bucket holding the table's files.
+        table_name (str): The table name.
+
+    Returns:
+        dict: The checkpoint, or None if the table has no files.
+    """
+    checkpoint, _ = read_checkpoint(bucket_name, table_name)
+    if checkpoint is None:
+        checkpoint = rebuild_checkpoint(bucket_name, table_name)
+    return checkpoint
 
 
 def extract_data_from_processed_s3(bucket, key):
@@ -138,6 +381,180 @@ def extract_data_from_processed_s3(bucket, key):
         logger.error(f"An error occurred: {e}")
 
 
+def get_processed_keys(table_name, latest):
+    """Returns the keys making up a processed file.
+
+    Args:
+        table_name (str): A key of WAREHOUSE_TABLES.
+        latest (str): The file name without its extension.
+
+    Returns:
+        list: The partitions recorded in the table's checkpoint for that
+        file, or its single unpartitioned key.
+    """
+    checkpoint, _ = read_checkpoint(processed_bucket, table_name)
+    if checkpoint and checkpoint['latest'] == latest and checkpoint.get('partitions'):
+        return checkpoint['partitions']
+    return [f'{table_name}/{latest}.parquet']
+
+
+def list_pending_keys(table_name, stored, latest):
+    """Lists the processed files of a table written after stored, up to latest.
+
+    Partitioned tables are listed across all of their partitions.
+
+    Args:
+        table_name (str): A key of WAREHOUSE_TABLES.
+        stored (str): The newest file already loaded, or "null".
+        latest (str): The newest file to load.
+
+    Returns:
+        list: The keys, oldest file first.
+    """
+    s3 = get_checkpoint_client()
+    pending = []
+    for page in s3.get_paginator('list_objects_v2').paginate(
+            Bucket=processed_bucket, Prefix=f'{table_name}/'):
+        for obj in page.get('Contents', []):
+            stem = obj['Key'].split('/')[-1].rsplit('.', 1)[0]
+            if is_newer(stem, stored) and not is_newer(stem, latest):
+                pending.append((stem, obj['Key']))
+    return [key for _, key in sorted(pending)]
+
+
+def partition_values(key):
+    """Returns the Hive style partition values in a key as timestamps."""
+    values = {}
+    for segment in key.split('/')[1:-1]:
+        column, _, value = segment.partition('=')
+        if value:
+            values[column] = pd.Timestamp(value)
+    return values
+
+
+def extract_processed_data(bucket, keys):
+    """Reads processed Parquet files into one DataFrame.
+
+    Partition values in the keys are added back as columns.
+
+    Args:
+        bucket (str): The processed bucket.
+        keys (list): The keys to read.
+
+    Returns:
+        pandas.DataFrame: The rows of all the files, in order.
+    """
+    frames = []
+    for key in keys:
+        frame = extract_data_from_processed_s3(bucket, key)
+        for column, value in partition_values(key).items():
+            frame[column] = value
+        frames.append(frame)
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True)
+
+
+def read_fact_manifest(bucket_name, table_name):
+    """Reads the manifest listing the current file of each partition.
+
+    Args:
+        bucket_name (str): The processed bucket.
+        table_name (str): A partitioned fact table.
+
+    Returns:
+        tuple: The manifest and its ETag, or (None, None) if the table has
+        no manifest.
+    """
+    s3 = get_checkpoint_client()
+    try:
+        res = s3.get_object(Bucket=bucket_name,
+                            Key=f'{MANIFEST_PREFIX}/{table_name}.json')
+        return json.loads(res['Body'].read()), res['ETag']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None, None
+        logger.error(f'An error occurred while reading the {table_name} manifest: {e}')
+        raise e
+
+
+def list_fact_partitions(table_name, since=None):
+    """Lists the files of each partition of a fact table without a manifest.
+
+    Args:
+        table_name (str): A partitioned fact table.
+        since (str): The first created_date to list, as 'YYYY-MM-DD'.
+
+    Returns:
+        dict: Each created_date mapped to its keys, oldest file first.
+    """
+    s3 = get_checkpoint_client()
+    paginator = s3.get_paginator('list_objects_v2')
+    prefix = f'{table_name}/{PARTITION_COLUMN}='
+    listing = {'Bucket': processed_bucket, 'Prefix': prefix, 'Delimiter': '/'}
+    if since:
+        listing['StartAfter'] = f'{prefix}{since}'
+    partitions = {}
+    for page in paginator.paginate(**listing):
+        for partition in page.get('CommonPrefixes', []):
+            value = partition['Prefix'][len(prefix):].rstrip('/')
+            partitions[value] = sorted(
+                obj['Key'] for file_page in paginator.paginate(
+                    Bucket=processed_bucket, Prefix=partition['Prefix'])
+                for obj in file_page.get('Contents', []))
+    return partitions
+
+
+def read_fact_partitions(table_name, since=None, until=None, filters=None, columns=None):
+    """Reads the rows of a partitioned fact table created in a date range.
+
+    The partitions are taken from the table's manifest, one file each, so
+    only the partitions in the range are downloaded. Tables written before
+    manifests existed are listed instead, and the newest file's version of
+    each row is kept. filters are pyarrow filters, e.g.
+    [('sales_order_id', '>=', 1000)], and are checked against each row
+    group's statistics so non-matching row groups are not decoded.
+
+    Args:
+        table_name (str): A partitioned fact table, e.g. 'fact_sales_order'.
+        since (str): The first created_date to read, as 'YYYY-MM-DD'.
+        until (str): The last created_date to read, as 'YYYY-MM-DD'.
+        filters (list): Row filters pushed down to the Parquet reader.
+        columns (list): The columns to read, all if None.
+
+    Returns:
+        pandas.DataFrame: The matching rows with their created_date.
+    """
+    import pyarrow.parquet as pq
+
+    manifest, _ = read_fact_manifest(processed_bucket, table_name)
+    if manifest is not None:
+        partitions = {value: [key] for value, key in manifest['partitions'].items()}
+    else:
+        partitions = list_fact_partitions(table_name, since)
+    primary_key = WAREHOUSE_TABLES[table_name]['primary_key']
+    if columns is not None and primary_key not in columns:
+        columns = [primary_key] + list(columns)
+    s3 = get_checkpoint_client()
+    frames = []
+    for value, keys in sorted(partitions.items()):
+        if (since and value < since) or (until and value > until):
+            continue
+        versions = []
+        for key in keys:
+            res = s3.get_object(Bucket=processed_bucket, Key=key)
+            versions.append(pq.read_table(
+                io.BytesIO(res['Body'].read()), columns=columns,
+                filters=filters).to_pandas())
+        frame = pd.concat(versions, ignore_index=True).drop_duplicates(
+            subset=primary_key, keep='last')
+        frame[PARTITION_COLUMN] = pd.Timestamp(value)
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+
 def get_object_path(records):
     """Extracts bucket and object references from Records field of event."""
     return records[0]["s3"]["bucket"]["name"], records[0]["s3"]["object"]["key"]
@@ -164,834 +581,390 @@ def get_secret():
     return secret
 
 
-def warehouse_update(table_name, latest):
+def get_credentials(refresh=False):
+    """Returns the warehouse credentials, cached across warm invocations.
 
-    s3 = boto3.client('s3')
-    try:
-        res = s3.get_object(
-            Bucket="processed-bucket-1158020804995033", Key='warehouse_update.json')
-        data = res['Body'].read().decode('utf-8')
-        data = json.loads(data)
-        pprint(data)
-        if data[table_name] == "null":
-            data[table_name] = latest
-            skip = False
-        else:
-            parquet_date = datetime.strptime(latest, '%Y-%m-%d-%H-%M-%S')
-            json_date = datetime.strptime(
-                data[table_name], '%Y-%m-%d-%H-%M-%S')
-            if parquet_date > json_date:
-                data[table_name] = parquet_date.strftime('%Y-%m-%d-%H-%M-%S')
-                skip = False
-            else:
-                skip = True
-        parquet_file_name = data[table_name]
-        data = json.dumps(data)
-        s3.put_object(Bucket="processed-bucket-1158020804995033",
-                      Key='warehouse_update.json', Body=data)
-        return parquet_file_name, skip
-    except ClientError as e:
-        logger.error(
-            f"An error occurred while retrieving warehouse_update.json from S3: {e}")
-        raise e
-    except Exception as e:
-        logger.error(f"An error occurred: {e}")
-        raise e
+    Secrets Manager is only called on a cold start, or when refresh is set
+    because the cached credentials were rejected (e.g. after a rotation).
+    """
+    global _credentials
+    if _credentials is None or refresh:
+        _credentials = json.loads(get_secret())
+    return _credentials
 
 
-def counterparty_util(user, host, db, port, password):
-    latest = get_latest_file_name('dim_counterparty')
-    latest_parquet, skip = warehouse_update('dim_counterparty', latest)
-    if skip:
-        return True
-    else:
-        key = f'dim_counterparty/{latest_parquet}.parquet'
-        counterparty_data = extract_data_from_processed_s3(
-            processed_bucket, key
-        )
-        try:
-            conn = pg8000.connect(user=user, password=password,
-                                  host=host, port=port, database=db)
-            cursor = conn.cursor()
-            try:
-                counterparty_data = counterparty_data.fillna('Null')
-                for index, row in counterparty_data.iterrows():
-                    cursor.execute('''SELECT * FROM dim_counterparty WHERE counterparty_id = %s''', (row['counterparty_id'],))
-                    result = cursor.fetchone()
-                    if result:
-                        cursor.execute('''UPDATE dim_counterparty SET counterparty_legal_name = %s,
-                                        counterparty_legal_address_line_1 = %s,
-                                        counterparty_legal_address_line_2 = %s,
-                                        counterparty_legal_district = %s,
-                                        counterparty_legal_city = %s,
-                                        counterparty_legal_postal_code = %s,
-                                        counterparty_legal_country = %s,
-                                        counterparty_legal_phone_number = %s
-                                        WHERE counterparty_id = %s''',
-                                    (
-                                        row['counterparty_legal_name'],
-                                        row['counterparty_legal_address_line_1'],
-                                        row['counterparty_legal_address_line_2'],
-                                        row['counterparty_legal_district'],
-                                        row['counterparty_legal_city'],
-                                        row['counterparty_legal_postal_code'],
-                                        row['counterparty_legal_country'],
-                                        row['counterparty_legal_phone_number'],
-                                        row['counterparty_id']
-                                    )
-                                    )
-                    else:
-                        cursor.execute('''INSERT INTO dim_counterparty (counterparty_id,
-                                        counterparty_legal_name,
-                                        counterparty_legal_address_line_1,
-                                        counterparty_legal_address_line_2,
-                                        counterparty_legal_district,
-                                        counterparty_legal_city,
-                                        counterparty_legal_postal_code,
-                                        counterparty_legal_country,
-                                        counterparty_legal_phone_number)
-                                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)''',
-                                    (
-                                        row['counterparty_id'],
-                                        row['counterparty_legal_name'],
-                                        row['counterparty_legal_address_line_1'],
-                                        row['counterparty_legal_address_line_2'],
-                                        row['counterparty_legal_district'],
-                                        row['counterparty_legal_city'],
-                                        row['counterparty_legal_postal_code'],
-                                        row['counterparty_legal_country'],
-                                        row['counterparty_legal_phone_number']
-                                    )
-                                    )
-                conn.commit()
-
-                pass
-            except Exception as e:
-                conn.rollback()
-                logger.error(
-                    f"An error occurred while executing SQL queries: {e}")
-        except Exception as e:
-            logger.error(
-                f"An error occurred while connecting to the database: {e}")
-        finally:
-            if 'cursor' in locals():
-                cursor.close()
-            if 'conn' in locals():
-                conn.close()
-            return False
-
-
-
-def currency_util(user, host, db, port, password):
-    latest = get_latest_file_name('dim_currency')
-    latest_parquet, skip = warehouse_update('dim_currency', latest)
-
-    if skip:
-        return True
-    else:
-        key = f'dim_currency/{latest_parquet}.parquet'
-        currency_data = extract_data_from_processed_s3(
-            processed_bucket, key)
-        try:
-            conn = pg8000.connect(user=user, password=password,
-                                  host=host, port=port, database=db)
-            cursor = conn.cursor()
-            try:
-                for index, row in currency_data.iterrows():
-                    cursor.execute('''SELECT * FROM dim_currency WHERE currency_id = %s''', (row['currency_id'],))
-                    result = cursor.fetchone()
-                    if result:
-                        cursor.execute('''UPDATE dim_currency SET currency_code = %s,
-                                        currency_name = %s
-                                        WHERE currency_id = %s''',
-                                       (
-                                           row['currency_code'],
-                                           row['currency_name'],
-                                           row['currency_id']
-                                       )
-                                       )
-                    else:
-                        cursor.execute('''INSERT INTO dim_currency
-                                    (currency_id,currency_code ,currency_name )
-                                    VALUES (%s, %s, %s)''',
-                                       (row['currency_id'],
-                                        row['currency_code'],
-                                        row['currency_name']))
-                conn.commit()
-            except Exception as e:
-                logger.error(
-                    f"An error occurred while executing SQL queries: {e}")
-        except Exception as e:
-            conn.rollback()
-            logger.error(
-                f"An error occurred while connecting to the database: {e}")
-        finally:
-            if 'cursor' in locals():
-                cursor.close()
-            if 'conn' in locals():
-                conn.close()
-            return False
+def get_connection():
+    """Returns the warehouse connection shared by every table in a run.
 
+    The connection is kept at module level so warm Lambda invocations skip
+    the TCP, TLS and authentication handshakes. A reused connection is
+    validated with a trivial round trip, and replaced if it has gone away.
+    If connecting with cached credentials fails they are fetched again once.
 
-def date_util(user, host, db, port, password):
-    date_data = extract_data_from_processed_s3(
-        processed_bucket, "dim_date.parquet"
-    )
-    try:
-        conn = pg8000.connect(user=user, password=password,
-                              host=host, port=port, database=db)
-        cursor = conn.cursor()
+    Returns:
+        pg8000.Connection: An open connection with no transaction in progress.
+    """
+    global _connection
+    if _connection is not None:
         try:
-            date_data.index = pd.RangeIndex(
-                start=1, stop=len(date_data) + 1, step=1)
-            date_data['quarter'] = date_data['date_id'].dt.quarter
-            for index, row in date_data.iterrows():
-                cursor.execute('''INSERT INTO dim_date (date_id,
-                                year,
-                                month,
-                                day,
-                                day_of_week,
-                                day_name,
-                                month_name,
-                                quarter)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)''',
-                               (
-                                   row['date_id'],
-                                   row['year'],
-                                   row['month'],
-                                   row['day'],
-                                   row['day_of_week'],
-                                   row['day_name'],
-                                   row['month_name'],
-                                   row['quarter']
-                               )
-                               )
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            logger.error(f"An error occurred while executing SQL queries: {e}")
-    except Exception as e:
-        logger.error(
-            f"An error occurred while connecting to the database: {e}")
-    finally:
-        if 'cursor' in locals():
+            cursor = _connection.cursor()
+            cursor.execute('SELECT 1')
             cursor.close()
-        if 'conn' in locals():
-            conn.close()
-
-
-
-def design_util(user, host, db, port, password):
-    latest = get_latest_file_name('dim_design')
-    latest_parquet, skip = warehouse_update('dim_design', latest)
-    if skip:
-        return True
-    else:
-        key = f'dim_design/{latest_parquet}.parquet'
-        design_data = extract_data_from_processed_s3(
-            processed_bucket, key
-        )
-        try:
-            conn = pg8000.connect(user=user, password=password,
-                                  host=host, port=port, database=db)
-            cursor = conn.cursor()
-            try:
-                for index, row in design_data.iterrows():
-                    cursor.execute('''SELECT * FROM dim_design WHERE design_id = %s''', (row['design_id'],))
-                    result = cursor.fetchone()
-                    if result:
-                        cursor.execute('''UPDATE dim_design SET design_name = %s,
-                                        file_location = %s,
-                                        file_name = %s
-                                        WHERE design_id = %s''',
-                                       (
-                                           row['design_name'],
-                                           row['file_location'],
-                                           row['file_name'],
-                                           row['design_id']
-                                       )
-                                       )
-                    else:
-                        cursor.execute('''INSERT INTO dim_design (design_id,
-                                    design_name,
-                                    file_location,
-                                    file_name)
-                                    VALUES (%s, %s, %s, %s)''',
-                                       (
-                                           row['design_id'],
-                                           row['design_name'],
-                                           row['file_location'],
-                                           row['file_name']
-                                       )
-                                       )
-                conn.commit()
-            except Exception as e:
-                conn.rollback()
-                logger.error(
-                    f"An error occurred while executing SQL queries: {e}")
+            _connection.rollback()
+            return _connection
         except Exception as e:
-            logger.error(
-                f"An error occurred while connecting to the database: {e}")
-        finally:
-            if 'cursor' in locals():
-                cursor.close()
-            if 'conn' in locals():
-                conn.close()
-            return False
-
-
+            logger.info(f"Warehouse connection is stale, reconnecting: {e}")
+            close_connection()
 
-def location_util(user, host, db, port, password):
-    latest = get_latest_file_name('dim_location')
-    latest_parquet, skip = warehouse_update('dim_location', latest)
-    if skip:
-        return True
-    else:
-        key = f'dim_location/{latest_parquet}.parquet'
-        location_data = extract_data_from_processed_s3(
-            processed_bucket, key
-        )
+    for refresh in (False, True):
+        warehouse = get_credentials(refresh)
         try:
-            conn = pg8000.connect(user=user, password=password,
-                                  host=host, port=port, database=db)
-            cursor = conn.cursor()
-            try:
-                for index, row in location_data.iterrows():
-                    cursor.execute('''SELECT * FROM dim_location WHERE location_id = %s''', (row['location_id'],))
-                    result = cursor.fetchone()
-                    if result:
-                        cursor.execute('''UPDATE dim_location SET address_line_1 = %s,
-                                        address_line_2 = %s,
-                                        district = %s,
-                                        city = %s,
-                                        postal_code = %s,
-                                        country = %s,
-                                        phone = %s
-                                        WHERE location_id = %s''',
-                                       (
-                                           row['address_line_1'],
-                                           row['address_line_2'],
-                                           row['district'],
-                                           row['city'],
-                                           row['postal_code'],
-                                           row['country'],
-                                           row['phone'],
-                                           row['location_id']
-                                       )
-                                       )
-                    else:
-                        cursor.execute('''INSERT INTO dim_location (location_id,
-                                    address_line_1,
-                                    address_line_2,
-                                    district,
-                                    city,
-                                    postal_code,
-                                    country,
-                                    phone)
-                                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)''',
-                                       (
-                                           row['location_id'],
-                                           row['address_line_1'],
-                                           row['address_line_2'],
-                                           row['district'],
-                                           row['city'],
-                                           row['postal_code'],
-                                           row['country'],
-                                           row['phone']
-                                       )
-                                       )
-                conn.commit()
-            except Exception as e:
-                conn.rollback()
+            _connection = pg8000.connect(user=warehouse["User"],
+                                         password=warehouse["Password"],
+                                         host=warehouse["Host"],
+                                         port=warehouse["Port"],
+                                         database=warehouse["Schema"])
+            return _connection
+        except pg8000.DatabaseError as e:
+            if refresh:
                 logger.error(
-                    f"An error occurred while executing SQL queries: {e}")
-        except Exception as e:
-            logger.error(
-                f"An error occurred while connecting to the database: {e}")
-        finally:
-            if 'cursor' in locals():
-                cursor.close()
-            if 'conn' in locals():
-                conn.close()
-            return False
+                    f"An error occurred while connecting to the database: {e}")
+                raise e
 
 
-
-def staff_util(user, host, db, port, password):
-    latest = get_latest_file_name('dim_staff')
-    latest_parquet, skip = warehouse_update('dim_staff', latest)
-    if skip:
-        return True
-    else:
-        key = f'dim_staff/{latest_parquet}.parquet'
-        staff_data = extract_data_from_processed_s3(
-            processed_bucket, key
-        )
+def rollback_connection():
+    """Rolls back the shared connection, discarding it if that fails."""
+    if _connection is not None:
         try:
-            conn = pg8000.connect(user=user, password=password,
-                                  host=host, port=port, database=db)
-            cursor = conn.cursor()
-            try:
-                for index, row in staff_data.iterrows():
-                    cursor.execute('''SELECT * FROM dim_staff WHERE staff_id = %s''', (row['staff_id'],))
-                    result = cursor.fetchone()
-                    if result:
-                        cursor.execute('''UPDATE dim_staff SET first_name = %s,
-                                        last_name = %s,
-                                        email_address = %s,
-                                        department_name = %s,
-                                        location = %s
-                                        WHERE staff_id = %s''',
-                                       (
-                                           row['first_name'],
-                                           row['last_name'],
-                                           row['email_address'],
-                                           row['department_name'],
-                                           row['location'],
-                                           row['staff_id']
-                                       )
-                                       )
-                    else:
-                        cursor.execute('''INSERT INTO dim_staff (staff_id,
-                                    first_name,
-                                    last_name,
-                                    email_address,
-                                    department_name,
-                                    location)
-                                    VALUES (%s, %s, %s, %s, %s, %s)''',
-                                       (
-                                           row['staff_id'],
-                                           row['first_name'],
-                                           row['last_name'],
-                                           row['email_address'],
-                                           row['department_name'],
-                                           row['location']
-                                       )
-                                       )
-                conn.commit()
-            except Exception as e:
-                conn.rollback()
-                logger.error(
-                    f"An error occurred while executing SQL queries: {e}")
+            _connection.rollback()
         except Exception as e:
-            logger.error(
-                f"An error occurred while connecting to the database: {e}")
-        finally:
-            if 'cursor' in locals():
-                cursor.close()
-            if 'conn' in locals():
-                conn.close()
-            return False
-
-
+            logger.error(f"An error occurred while rolling back: {e}")
+            close_connection()
 
 
-def payment_type_util(user, host, db, port, password):
-    latest = get_latest_file_name('dim_payment_type')
-    latest_parquet, skip = warehouse_update('dim_payment_type', latest)
-    if skip:
-        return True
-    else:
-        key = f'dim_payment_type/{latest_parquet}.parquet'
-        payment_type_data = extract_data_from_processed_s3(
-            processed_bucket, key
-        )
+def close_connection():
+    """Closes and forgets the shared connection."""
+    global _connection
+    if _connection is not None:
         try:
-            conn = pg8000.connect(user=user, password=password,
-                                  host=host, port=port, database=db)
-            cursor = conn.cursor()
-            try:
-                for index, row in payment_type_data.iterrows():
-                    cursor.execute('''SELECT * FROM dim_payment_type WHERE payment_type_id = %s''', (row['payment_type_id'],))
-                    result = cursor.fetchone()
-                    if result:
-                        cursor.execute('''UPDATE dim_payment_type SET payment_type_name = %s
-                                        WHERE payment_type_id = %s''',
-                                       (
-                                           row['payment_type_name'],
-                                           row['payment_type_id']
-                                       )
-                                       )
-                    else:
-                        cursor.execute('''INSERT INTO dim_payment_type
-                                    (payment_type_id, payment_type_name )
-                                    VALUES (%s, %s)''',
-                                       (row['payment_type_id'],
-                                        row['payment_type_name']))
-                conn.commit()
-            except Exception as e:
-                conn.rollback()
-                logger.error(
-                    f"An error occurred while executing SQL queries: {e}")
-        except Exception as e:
-            logger.error(
-                f"An error occurred while connecting to the database: {e}")
-        finally:
-            if 'cursor' in locals():
-                cursor.close()
-            if 'conn' in locals():
-                conn.close()
-            return False
-
-
-
-
-def transaction_util(user, host, db, port, password):
-    latest = get_latest_file_name('dim_transaction')
-    latest_parquet, skip = warehouse_update('dim_transaction', latest)
-    if skip:
-        return True
-    else:
-        key = f'dim_transaction/{latest_parquet}.parquet'
-        transaction_data = extract_data_from_processed_s3(
-            processed_bucket, key
-        )
+            _connection.close()
+        except Exception:
+            pass
+        _connection = None
+
+
+def load_state(refresh=False):
+    """Returns the run's copy of warehouse_update.json, reading it once.
+
+    Args:
+        refresh (bool): Discard any state left by a previous invocation of
+            a warm container and read the file again.
+
+    Returns:
+        dict: The stored table dates ('data'), the ETag they were read
+        with ('etag') and the dates staged by this run ('changes').
+    """
+    global _state
+    if _state is None or refresh:
+        s3 = get_checkpoint_client()
         try:
-            conn = pg8000.connect(user=user, password=password,
-                                  host=host, port=port, database=db)
-            cursor = conn.cursor()
-            try:
-                for index, row in transaction_data.iterrows():
-                    cursor.execute('''SELECT * FROM dim_transaction WHERE transaction_id = %s''', (row['transaction_id'],))
-                    result = cursor.fetchone()
-                    if result:
-                        cursor.execute('''UPDATE dim_transaction SET transaction_type = %s,
-                                        sales_order_id = %s,
-                                        purchase_order_id = %s
-                                        WHERE transaction_id = %s''',
-                                       (
-                                           row['transaction_type'],
-                                           row['sales_order_id'],
-                                           row['purchase_order_id'],
-                                           row['transaction_id']
-                                       )
-                                       )
-                    else:
-                        cursor.execute('''INSERT INTO dim_transaction (transaction_id,
-                                    transaction_type,
-                                    sales_order_id,
-                                    purchase_order_id)
-                                    VALUES (%s, %s, %s, %s)''',
-                                       (
-                                           row['transaction_id'],
-                                           row['transaction_type'],
-                                           row['sales_order_id'],
-                                           row['purchase_order_id']
-                                       )
-                                       )
-                conn.commit()
-            except Exception as e:
-                conn.rollback()
-                logger.error(
-                    f"An error occurred while executing SQL queries: {e}")
-        except Exception as e:
+            res = s3.get_object(Bucket=state_bucket, Key=STATE_KEY)
+        except ClientError as e:
             logger.error(
-                f"An error occurred while connecting to the database: {e}")
-        finally:
-            if 'cursor' in locals():
-                cursor.close()
-            if 'conn' in locals():
-                conn.close()
-            return False
+                f"An error occurred while retrieving {STATE_KEY} from S3: {e}")
+            raise e
+        _state = {'data': json.loads(res['Body'].read()),
+                  'etag': res['ETag'],
+                  'changes': {}}
+    return _state
 
 
+def is_newer(latest, stored):
+    """Returns True if the file name or run id latest is newer than stored.
 
-
-def sales_order_util(user, host, db, port, password):
-    latest = get_latest_file_name('fact_sales_order')
-    latest_parquet, skip = warehouse_update('fact_sales_order', latest)
-    if skip:
+    Both start with a '%Y-%m-%d-%H-%M-%S' timestamp. Run ids go on with a
+    fixed width suffix, which orders the runs made within one second.
+    """
+    if stored is None or stored == "null":
         return True
-    else:
-        key = f'fact_sales_order/{latest_parquet}.parquet'
-        sales_order_data = extract_data_from_processed_s3(
-            processed_bucket, key
-        )
-        try:
-            conn = pg8000.connect(user=user, password=password,
-                                  host=host, port=port, database=db)
-            cursor = conn.cursor()
-            try:
-                sales_order_data = sales_order_data.rename(
-                    columns={'staff_id': 'sales_staff_id'})
-                for index, row in sales_order_data.iterrows():
-                    cursor.execute('''SELECT * FROM fact_sales_order WHERE sales_order_id = %s''', (row['sales_order_id'],))
-                    result = cursor.fetchone()
-                    if result:
-                        cursor.execute('''UPDATE fact_sales_order SET created_date = %s,
-                                        created_time = %s,
-                                        last_updated_date = %s,
-                                        last_updated_time = %s,
-                                        sales_staff_id = %s,
-                                        counterparty_id = %s,
-                                        units_sold = %s,
-                                        unit_price = %s,
-                                        currency_id = %s,
-                                        design_id = %s,
-                                        agreed_payment_date = %s,
-                                        agreed_delivery_date = %s,
-                                        agreed_delivery_location_id = %s
-                                        WHERE sales_order_id = %s''',
-                                       (
-                                           row['created_date'],
-                                           row['created_time'],
-                                           row['last_updated_date'],
-                                           row['last_updated_time'],
-                                           row['sales_staff_id'],
-                                           row['counterparty_id'],
-                                           row['units_sold'],
-                                           row['unit_price'],
-                                           row['currency_id'],
-                                           row['design_id'],
-                                           row['agreed_payment_date'],
-                                           row['agreed_delivery_date'],
-                                           row['counterparty_id'],
-                                           row['sales_order_id']
-                                       )
-                                       )
-                    else:
-                        cursor.execute('''INSERT INTO fact_sales_order (sales_order_id,
-                                    created_date,
-                                    created_time,
-                                    last_updated_date,
-                                    last_updated_time,
-                                    sales_staff_id,
-                                    counterparty_id,
-                                    units_sold,
-                                    unit_price,
-                                    currency_id,
-                                    design_id,
-                                    agreed_payment_date,
-                                    agreed_delivery_date,
-                                    agreed_delivery_location_id)
-                                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s,
-                                            %s, %s, %s, %s, %s, %s)''',
-                                       (
-                                           row['sales_order_id'],
-                                           row['created_date'],
-                                           row['created_time'],
-                                           row['last_updated_date'],
-                                           row['last_updated_time'],
-                                           row['sales_staff_id'],
-                                           row['counterparty_id'],
-                                           row['units_sold'],
-                                           row['unit_price'],
-                                           row['currency_id'],
-                                           row['design_id'],
-                                           row['agreed_payment_date'],
-                                           row['agreed_delivery_date'],
-                                           row['counterparty_id']
-                                       )
-                                       )
-                conn.commit()
-            except Exception as e:
-                conn.rollback()
-                logger.error(
-                    f"An error occurred while executing SQL queries: {e}")
-        except Exception as e:
-            logger.error(
-                f"An error occurred while connecting to the database: {e}")
-        finally:
-            if 'cursor' in locals():
-                cursor.close()
-            if 'conn' in locals():
-                conn.close()
-            return False
-
+    return ((datetime.strptime(latest[:19], '%Y-%m-%d-%H-%M-%S'), latest)
+            > (datetime.strptime(stored[:19], '%Y-%m-%d-%H-%M-%S'), stored))
 
 
-
-def purchase_order_util(user, host, db, port, password):
-    latest = get_latest_file_name('fact_purchase_order')
-    latest_parquet, skip = warehouse_update('fact_purchase_order', latest)
+def warehouse_update(table_name, latest):
+    """Checks whether a table has a newer file and stages it if so.
+
+    Nothing is written to S3 until commit_state, which the handler calls
+    after the warehouse transaction has been committed.
+
+    Args:
+        table_name (str): The key in warehouse_update.json.
+        latest (str): The name of the newest file for the table.
+
+    Returns:
+        tuple: The file name to read and True if the table can be skipped.
+    """
+    state = load_state()
+    stored = state['data'].get(table_name, "null")
+    if latest is None or not is_newer(latest, stored):
+        return stored, True
+    if is_newer(latest, state['changes'].get(table_name)):
+        state['changes'][table_name] = latest
+    return latest, False
+
+
+def load_run_manifests(bucket_name, stage):
+    """Reads the run manifests written since the last one applied.
+
+    The newest manifest read is staged as the last one applied, so it is
+    recorded with the rest of the state by commit_state.
+
+    Args:
+        bucket_name (str): The bucket the stage writes its manifests to.
+        stage (str): The stage that wrote them, e.g. 'processed'.
+
+    Returns:
+        dict: Each table's manifest entries, oldest first, or None if no
+        manifest has been applied yet and every checkpoint has to be read.
+    """
+    stored = load_state()['data'].get(RUN_MANIFEST_STATE)
+    prefix = f'{RUN_MANIFEST_PREFIX}/{stage}/'
+    kwargs = {'Bucket': bucket_name, 'Prefix': prefix}
+    if stored not in (None, "null"):
+        kwargs['StartAfter'] = f'{prefix}{stored}.json'
+    s3 = get_checkpoint_client()
+    tables = {}
+    newest = None
+    try:
+        for page in s3.get_paginator('list_objects_v2').paginate(**kwargs):
+            for obj in page.get('Contents', []):
+                res = s3.get_object(Bucket=bucket_name, Key=obj['Key'])
+                manifest = json.loads(res['Body'].read())
+                for table_name, entry in manifest['tables'].items():
+                    tables.setdefault(table_name, []).append(entry)
+                newest = manifest['run_id']
+    except ClientError as e:
+        logger.error(f'An error occurred while reading the {stage} run manifests: {e}')
+        raise e
+    if newest is not None:
+        warehouse_update(RUN_MANIFEST_STATE, newest)
+    logger.info(f'Read {len(tables)} tables from the {stage} run manifests.')
+    return tables if stored not in (None, "null") else None
+
+
+def commit_state():
+    """Writes the dates staged by this run back to warehouse_update.json.
+
+    The write is conditional on the ETag that was read. If another run
+    has changed the file in the meantime it is read again, the staged
+    dates are reapplied on top of it, and the write is retried.
+
+    Returns:
+        dict: The state as written, or None if nothing was staged.
+    """
+    global _state
+    state = _state
+    _state = None
+    if state is None or not state['changes']:
+        return None
+    s3 = get_checkpoint_client()
+    for attempt in range(CHECKPOINT_ATTEMPTS):
+        data = dict(state['data'])
+        for table_name, latest in state['changes'].items():
+            if is_newer(latest, data.get(table_name)):
+                data[table_name] = latest
+        try:
+            s3.put_object(Bucket=state_bucket, Key=STATE_KEY,
+                          Body=json.dumps(data), IfMatch=state['etag'])
+            return data
+        except ClientError as e:
+            if e.response['Error']['Code'] not in CHECKPOINT_CONFLICTS:
+                logger.error(f"An error occurred while saving {STATE_KEY}: {e}")
+                raise e
+            logger.info(f'{STATE_KEY} changed while saving, retrying.')
+            res = s3.get_object(Bucket=state_bucket, Key=STATE_KEY)
+            state['data'] = json.loads(res['Body'].read())
+            state['etag'] = res['ETag']
+    raise RuntimeError(
+        f'Could not save {STATE_KEY} after {CHECKPOINT_ATTEMPTS} attempts')
+
+
+def table_util(conn, table_name):
+    """Loads the latest processed parquet for a table into the data warehouse.
+
+    The parquet is only loaded if it is newer than the one recorded in
+    warehouse_update.json. Every file written since then is loaded, oldest
+    first, as each holds only one processed run's changes. In a run
+    started by a run manifest the files come from the manifests, and
+    tables missing from them are skipped without reading their checkpoint.
+    Otherwise they are listed. Rows are merged with bulk_upsert, so the
+    files cost a COPY and a single merge statement instead of two round
+    trips per row. Nothing is committed here: the caller commits once all
+    tables are loaded, and rolls back if any of them raises.
+
+    Args:
+        conn (pg8000.Connection): The connection returned by get_connection.
+        table_name (str): A key of WAREHOUSE_TABLES, e.g. 'dim_staff'.
+
+    Returns:
+        bool: True if the table was skipped because there was nothing new.
+    """
+    if _run_manifest is not None:
+        if not _run_manifest.get(table_name):
+            return True
+        # Each processed run writes only its own changes, so every entry
+        # not yet applied is loaded, oldest first. format_for_copy keeps the
+        # last row for each key, so the newest version of a row wins.
+        keys = []
+        for entry in _run_manifest[table_name]:
+            latest_parquet, skip = warehouse_update(table_name, entry['latest'])
+            if not skip:
+                keys.extend(entry.get('partitions') or [entry['key']])
+        skip = not keys
+    else:
+        # Without a manifest the processed files written since the stored
+        # one are listed, so none of the increments in between are skipped.
+        latest = get_latest_file_name(table_name)
+        stored = load_state()['data'].get(table_name, "null")
+        latest_parquet, skip = warehouse_update(table_name, latest)
+        keys = None if skip else list_pending_keys(table_name, stored, latest_parquet)
     if skip:
         return True
-    else:
-        key = f'fact_purchase_order/{latest_parquet}.parquet'
-        purchase_order_data = extract_data_from_processed_s3(
-            processed_bucket, key
-        )
-        try:
-            conn = pg8000.connect(user=user, password=password,
-                                  host=host, port=port, database=db)
-            cursor = conn.cursor()
-            try:
-                for index, row in purchase_order_data.iterrows():
-                    cursor.execute('''SELECT * FROM fact_purchase_order WHERE purchase_order_id = %s''', (row['purchase_order_id'],))
-                    result = cursor.fetchone()
-                    if result:
-                        cursor.execute('''UPDATE fact_purchase_order SET created_date = %s,
-                                        created_time = %s,
-                                        last_updated_date = %s,
-                                        last_updated_time = %s,
-                                        staff_id = %s,
-                                        counterparty_id = %s,
-                                        item_code = %s,
-                                        item_quantity = %s,
-                                        item_unit_price = %s,
-                                        currency_id = %s,
-                                        agreed_delivery_date = %s,
-                                        agreed_payment_date = %s,
-                                        agreed_delivery_location_id = %s
-                                        WHERE purchase_order_id = %s''',
-                                       (
-                                           row['created_date'],
-                                           row['created_time'],
-                                           row['last_updated_date'],
-                                           row['last_updated_time'],
-                                           row['staff_id'],
-                                           row['counterparty_id'],
-                                           row['item_code'],
-                                           row['item_quantity'],
-                                           row['item_unit_price'],
-                                           row['currency_id'],
-                                           row['agreed_delivery_date'],
-                                           row['agreed_payment_date'],
-                                           row['agreed_delivery_location_id'],
-                                           row['purchase_order_id']
-                                       )
-                                       )
-                    else:
-                        cursor.execute('''INSERT INTO fact_purchase_order (purchase_order_id,
-                                    created_date,
-                                    created_time,
-                                    last_updated_date,
-                                    last_updated_time,
-                                    staff_id,
-                                    counterparty_id,
-                                    item_code,
-                                    item_quantity,
-                                    item_unit_price,
-                                    currency_id,
-                                    agreed_delivery_date,
-                                    agreed_payment_date,
-                                    agreed_delivery_location_id)
-                                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s,
-                                            %s, %s, %s, %s, %s, %s)''',
-                                       (
-                                           row['purchase_order_id'],
-                                           row['created_date'],
-                                           row['created_time'],
-                                           row['last_updated_date'],
-                                           row['last_updated_time'],
-                                           row['staff_id'],
-                                           row['counterparty_id'],
-                                           row['item_code'],
-                                           row['item_quantity'],
-                                           row['item_unit_price'],
-                                           row['currency_id'],
-                                           row['agreed_delivery_date'],
-                                           row['agreed_payment_date'],
-                                           row['agreed_delivery_location_id']
-                                       )
-                                       )
-                conn.commit()
-            except Exception as e:
-                conn.rollback()
-                logger.error(
-                    f"An error occurred while executing SQL queries: {e}")
-        except Exception as e:
-            logger.error(
-                f"An error occurred while connecting to the database: {e}")
-        finally:
-            if 'cursor' in locals():
-                cursor.close()
-            if 'conn' in locals():
-                conn.close()
-            return False
-
+    keys = keys or get_processed_keys(table_name, latest_parquet)
+    data = extract_processed_data(processed_bucket, keys)
+    try:
+        inserted, updated = bulk_upsert(conn, table_name, data)
+        logger.info(
+            f'{table_name}: {inserted} rows inserted, {updated} rows updated')
+        return False
+    except Exception as e:
+        logger.error(
+            f"An error occurred while executing SQL queries for {table_name}: {e}")
+        raise e
 
 
+def format_for_copy(data, table):
+    """Renders a processed DataFrame as CSV ready for COPY ... FROM STDIN.
+
+    Columns are renamed and ordered to match the table spec, taking the
+    key from the index for parquet written with it set. Float columns
+    that only hold whole numbers (ids that became floats because of NaNs)
+    are written as integers so Postgres accepts them for INT columns, and
+    duplicate primary keys keep their last occurrence.
+
+    Args:
+        data (pandas.DataFrame): The processed data for the table.
+        table (dict): A WAREHOUSE_TABLES entry.
+
+    Returns:
+        io.StringIO: The CSV rows without a header, rewound to the start.
+    """
+    data = data.rename(columns=table.get('rename', {}))
+    if table['primary_key'] not in data.columns:
+        data = data.reset_index()
+    data = data[table['columns']].drop_duplicates(
+        subset=table['primary_key'], keep='last')
+    for column in table['columns']:
+        series = data[column]
+        if pd.api.types.is_float_dtype(series):
+            values = series.dropna()
+            if (values == values.round()).all():
+                data[column] = series.astype('Int64')
+    buffer = io.StringIO()
+    data.to_csv(buffer, header=False, index=False)
+    buffer.seek(0)
+    return buffer
+
+
+def has_unique_key(cursor, table_name, primary_key):
+    """Checks whether primary_key is backed by a single column unique index.
+
+    ON CONFLICT needs such an index. The fact tables are keyed on a serial
+    record id, so they are merged without ON CONFLICT instead. The answer
+    is cached for the lifetime of the Lambda container.
+    """
+    if table_name not in _unique_keys:
+        cursor.execute('''SELECT 1 FROM pg_index i
+                          JOIN pg_attribute a ON a.attrelid = i.indrelid
+                          AND a.attnum = i.indkey[0]
+                          WHERE i.indrelid = %s::regclass
+                          AND i.indisunique AND i.indnatts = 1
+                          AND a.attname = %s''', (table_name, primary_key))
+        _unique_keys[table_name] = cursor.fetchone() is not None
+    return _unique_keys[table_name]
+
+
+def bulk_upsert(conn, table_name, data):
+    """Merges a DataFrame into a warehouse table in one set-based operation.
+
+    The rows are streamed into a temporary staging table with
+    COPY ... FROM STDIN and merged with a single INSERT ... ON CONFLICT DO
+    UPDATE. Tables without a unique index on their key fall back to an
+    UPDATE ... FROM followed by an INSERT of the missing keys, still in one
+    statement. The caller owns the transaction.
+
+    Args:
+        conn (pg8000.Connection): An open warehouse connection.
+        table_name (str): A key of WAREHOUSE_TABLES, or 'dim_date'.
+        data (pandas.DataFrame): The processed data for the table.
+
+    Returns:
+        tuple: The number of rows inserted and the number of rows updated.
+    """
+    table = WAREHOUSE_TABLES.get(table_name, DATE_TABLE)
+    primary_key = table['primary_key']
+    columns = ', '.join(table['columns'])
+    non_keys = [c for c in table['columns'] if c != primary_key]
+    staging = f'staging_{table_name}'
+
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f'''CREATE TEMP TABLE {staging} AS
+                           SELECT {columns} FROM {table_name} WITH NO DATA''')
+        cursor.execute(f'COPY {staging} ({columns}) FROM STDIN WITH (FORMAT csv)',
+                       stream=format_for_copy(data, table))
+
+        if has_unique_key(cursor, table_name, primary_key):
+            updates = ', '.join(f'{c} = EXCLUDED.{c}' for c in non_keys)
+            cursor.execute(f'''WITH merged AS (
+                                   INSERT INTO {table_name} ({columns})
+                                   SELECT {columns} FROM {staging}
+                                   ON CONFLICT ({primary_key}) DO UPDATE SET {updates}
+                                   RETURNING (xmax = 0) AS inserted)
+                               SELECT COUNT(*) FILTER (WHERE inserted),
+                                      COUNT(*) FILTER (WHERE NOT inserted)
+                               FROM merged''')
+        else:
+            updates = ', '.join(f'{c} = s.{c}' for c in non_keys)
+            cursor.execute(f'''WITH updated AS (
+                                   UPDATE {table_name} t SET {updates}
+                                   FROM {staging} s
+                                   WHERE t.{primary_key} = s.{primary_key}
+                                   RETURNING 1),
+                               inserted AS (
+                                   INSERT INTO {table_name} ({columns})
+                                   SELECT {columns} FROM {staging} s
+                                   WHERE NOT EXISTS (
+                                       SELECT 1 FROM {table_name} t
+                                       WHERE t.{primary_key} = s.{primary_key})
+                                   RETURNING 1)
+                               SELECT (SELECT COUNT(*) FROM inserted),
+                                      (SELECT COUNT(*) FROM updated)''')
+        inserted, updated = cursor.fetchone()
+        cursor.execute(f'DROP TABLE {staging}')
+        return inserted, updated
+    finally:
+        cursor.close()
 
-def payment_util(user, host, db, port, password):
-    latest = get_latest_file_name('fact_payment')
-    latest_parquet, skip = warehouse_update('fact_payment', latest)
-    if skip:
-        return True
-    else:
-        key = f'fact_payment/{latest_parquet}.parquet'
-        payment_data = extract_data_from_processed_s3(
-            processed_bucket, key
-        )
-        try:
-            conn = pg8000.connect(user=user, password=password,
-                                  host=host, port=port, database=db)
-            cursor = conn.cursor()
-            try:
-                for index, row in payment_data.iterrows():
-                    cursor.execute('''SELECT * FROM fact_payment WHERE payment_id = %s''', (row['payment_id'],))
-                    result = cursor.fetchone()
-                    if result:
-                        cursor.execute('''UPDATE fact_payment SET created_date = %s,
-                                        created_time = %s,
-                                        last_updated_date = %s,
-                                        last_updated_time = %s,
-                                        transaction_id = %s,
-                                        counterparty_id = %s,
-                                        payment_amount = %s,
-                                        currency_id = %s,
-                                        payment_type_id = %s,
-                                        paid = %s,
-                                        payment_date = %s
-                                        WHERE payment_id = %s''',
-                                       (
-                                           row['created_date'],
-                                           row['created_time'],
-                                           row['last_updated_date'],
-                                           row['last_updated_time'],
-                                           row['transaction_id'],
-                                           row['counterparty_id'],
-                                           row['payment_amount'],
-                                           row['currency_id'],
-                                           row['payment_type_id'],
-                                           row['paid'],
-                                           row['payment_date'],
-                                           row['payment_id']
-                                       )
-                                       )
-                    else:
-                        cursor.execute('''INSERT INTO fact_payment (payment_id,
-                                    created_date,
-                                    created_time,
-                                    last_updated_date,
-                                    last_updated_time,
-                                    transaction_id,
-                                    counterparty_id,
-                                    payment_amount,
-                                    currency_id,
-                                    payment_type_id,
-                                    paid,
-                                    payment_date
-                                    )
-                                    VALUES (%s, %s, %s, %s, %s, %s,
-                                            %s, %s, %s, %s, %s, %s)''',
-                                       (
-                                           row['payment_id'],
-                                           row['created_date'],
-                                           row['created_time'],
-                                           row['last_updated_date'],
-                                           row['last_updated_time'],
-                                           row['transaction_id'],
-                                           row['counterparty_id'],
-                                           row['payment_amount'],
-                                           row['currency_id'],
-                                           row['payment_type_id'],
-                                           row['paid'],
-                                           row['payment_date']
-                                       )
-                                       )
-                conn.commit()
-            except Exception as e:
-                conn.rollback()
-                logger.error(
-                    f"An error occurred while executing SQL queries: {e}")
-        except Exception as e:
-            logger.error(
-                f"An error occurred while connecting to the database: {e}")
-        finally:
-            if 'cursor' in locals():
-                cursor.close()
-            if 'conn' in locals():
-                conn.close()
-            return False
 
+def date_util(conn):
+    date_data = extract_data_from_processed_s3(
+        processed_bucket, "dim_date.parquet"
+    )
+    try:
+        date_data['quarter'] = date_data['date_id'].dt.quarter
+        bulk_upsert(conn, 'dim_date', date_data)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"An error occurred while executing SQL queries: {e}")
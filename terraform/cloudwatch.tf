@@ -12,3 +12,8 @@ resource "aws_cloudwatch_log_group" "processed_log_group" {
 resource "aws_cloudwatch_log_group" "warehouse_log_group" {
   name = "/aws/lambda/${var.warehouse_lambda}"
 }
+
+# Compaction cloudwatch log group
+resource "aws_cloudwatch_log_group" "compaction_log_group" {
+  name = "/aws/lambda/${var.compaction_lambda}"
+}
@@ -1,7 +1,9 @@
-# Cloudwatch trigger 1 minute
+# Cloudwatch trigger 1 minute. The lambda's INGESTION_SCHEDULE decides
+# which tables are due on each tick, and its reserved concurrency of 1 keeps
+# ticks from overlapping a run that is still going.
 resource "aws_cloudwatch_event_rule" "ingestion_event_rule" {
   name                = "ingestion-event-rule-${var.ingestion_lambda}-${var.unique_number}"
-  schedule_expression = "rate(10 minutes)"
+  schedule_expression = "rate(1 minute)"
 }
 # attach the rule to the lambda
 resource "aws_cloudwatch_event_target" "ingestion_event_target" {
@@ -19,3 +21,21 @@ resource "aws_lambda_permission" "allow_scheduler" {
 }
 
 
+
+# Compact the small files of closed days once an hour
+resource "aws_cloudwatch_event_rule" "compaction_event_rule" {
+  name                = "compaction-event-rule-${var.compaction_lambda}-${var.unique_number}"
+  schedule_expression = "rate(1 hour)"
+}
+resource "aws_cloudwatch_event_target" "compaction_event_target" {
+  rule = aws_cloudwatch_event_rule.compaction_event_rule.name
+  arn  = aws_lambda_function.compaction_lambda.arn
+}
+resource "aws_lambda_permission" "allow_compaction_scheduler" {
+  statement_id   = "AllowExecutionFromEventBridge"
+  action         = "lambda:InvokeFunction"
+  function_name  = aws_lambda_function.compaction_lambda.function_name
+  principal      = "events.amazonaws.com"
+  source_arn     = aws_cloudwatch_event_rule.compaction_event_rule.arn
+  source_account = data.aws_caller_identity.current.account_id
+}
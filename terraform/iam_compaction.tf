@@ -0,0 +1,82 @@
+# compaction Lambda Role
+resource "aws_iam_role" "compaction_lambda_role" {
+  name               = "role-${var.compaction_lambda}-${var.unique_number}"
+  assume_role_policy = <<EOF
+    {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "sts:AssumeRole"
+                ],
+                "Principal": {
+                    "Service": [
+                        "lambda.amazonaws.com"
+                    ]
+                }
+            }
+        ]
+    }
+    EOF
+}
+# compaction lambda s3 policy document
+data "aws_iam_policy_document" "s3_compaction_document" {
+
+  statement {
+
+    actions = ["s3:PutObject", "s3:GetObject", "s3:DeleteObject"]
+
+    resources = [
+      "${aws_s3_bucket.ingestion_bucket.arn}/*",
+      "${aws_s3_bucket.processed_bucket.arn}/*",
+    ]
+  }
+  statement {
+    actions   = ["s3:ListBucket"]
+    resources = [
+      "${aws_s3_bucket.ingestion_bucket.arn}",
+      "${aws_s3_bucket.processed_bucket.arn}"
+    ]
+  }
+}
+# compaction lambda s3 policy
+resource "aws_iam_policy" "s3_compaction_policy" {
+  name   = "s3-policy-${var.compaction_lambda}-${var.unique_number}"
+  policy = data.aws_iam_policy_document.s3_compaction_document.json
+}
+# compaction lambda Attach policy to the lambda role
+resource "aws_iam_role_policy_attachment" "compaction_lambda_s3_policy_attachment" {
+  role       = aws_iam_role.compaction_lambda_role.name
+  policy_arn = aws_iam_policy.s3_compaction_policy.arn
+}
+
+# compaction cloudwatch document
+data "aws_iam_policy_document" "cw_compaction_document" {
+  statement {
+    actions = ["logs:CreateLogGroup"]
+
+    resources = [
+      "arn:aws:logs:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:*"
+    ]
+  }
+  statement {
+
+    actions = ["logs:CreateLogStream", "logs:PutLogEvents"]
+
+    resources = [
+      "arn:aws:logs:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:log-group:${resource.aws_cloudwatch_log_group.compaction_log_group.name}:*"
+    ]
+  }
+}
+# compaction cloudwatch policy
+resource "aws_iam_policy" "cw_compaction_policy" {
+  name   = "cw-policy-${var.compaction_lambda}-${var.unique_number}"
+  policy = data.aws_iam_policy_document.cw_compaction_document.json
+}
+
+# compaction attach cloudwatch policy to lambda role
+resource "aws_iam_role_policy_attachment" "compaction_cw_policy_attachment" {
+  role       = aws_iam_role.compaction_lambda_role.name
+  policy_arn = aws_iam_policy.cw_compaction_policy.arn
+}
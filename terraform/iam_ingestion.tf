@@ -25,7 +25,7 @@ resource "aws_iam_role" "ingestion_lambda_role" {
 # Ingestion lambda s3 policy document NOTE added sectrets permissions as well to lambda role
 data "aws_iam_policy_document" "s3_ingestion_document" {
   statement {
-    actions = ["s3:PutObject", "s3:GetObject"]
+    actions = ["s3:PutObject", "s3:GetObject", "s3:AbortMultipartUpload", "s3:DeleteObject"]
 
     resources = [
       "${aws_s3_bucket.ingestion_bucket.arn}/*",
@@ -0,0 +1,24 @@
+# STEP 1: zip the compaction lambda
+data "archive_file" "compaction_lambda" {
+  type        = "zip"
+  source_file = "${path.module}/../src/lambda_functions/compaction_lambda.py"
+  output_path = "${path.module}/../src/lambda_functions/compaction_lambda.zip"
+}
+
+# STEP 2: save the zipped lambda in the s3 lambda bucket
+resource "aws_s3_object" "compaction_lambda" {
+  bucket = aws_s3_bucket.lambda_bucket.id
+  key    = "lambda/compaction_lambda.zip"
+  source = data.archive_file.compaction_lambda.output_path
+}
+
+resource "aws_lambda_function" "compaction_lambda" {
+  function_name = var.compaction_lambda
+  role          = aws_iam_role.compaction_lambda_role.arn
+  handler       = "compaction_lambda.lambda_handler"
+  runtime       = "python3.9"
+  s3_bucket     = "lambda-bucket-1158020804995033"
+  s3_key        = "lambda/compaction_lambda.zip"
+  timeout       = 900
+  layers        = ["arn:aws:lambda:eu-west-2:336392948345:layer:AWSSDKPandas-Python39:8"]
+}
@@ -65,7 +65,28 @@ resource "aws_lambda_function" "ingestion_lambda" {
   s3_bucket     = aws_s3_bucket.lambda_bucket.bucket
   s3_key        = "lambda/ingestion_lambda.zip"
   timeout       = 300
-  layers        = [aws_lambda_layer_version.lambda_layer.arn] 
+  # Ticks come every minute but a run can take up to the timeout. One run
+  # at a time, so overlapping ticks never extract the same due tables twice.
+  reserved_concurrent_executions = 1
+  layers        = [aws_lambda_layer_version.lambda_layer.arn, "arn:aws:lambda:eu-west-2:336392948345:layer:AWSSDKPandas-Python39:8"]
+  environment {
+    variables = {
+      INGESTION_WORKERS       = 4
+      INGESTION_STREAMING     = "false"
+      INGESTION_FORMAT        = "json"
+      INGESTION_SNAPSHOT      = "true"
+      INGESTION_PROBE         = "true"
+      INGESTION_SCHEDULE      = "adaptive"
+      INGESTION_SOURCE        = "poll"
+      INGESTION_BACKFILL_ROWS = 100000
+    }
+  }
 }
 
-
+# A tick throttled while the previous run is still going is dropped rather
+# than queued: the next tick picks up whatever is due by then.
+resource "aws_lambda_function_event_invoke_config" "ingestion_lambda" {
+  function_name                = aws_lambda_function.ingestion_lambda.function_name
+  maximum_event_age_in_seconds = 60
+  maximum_retry_attempts       = 0
+}
@@ -38,7 +38,16 @@ resource "aws_lambda_function" "processed_lambda" {
   s3_bucket     = "lambda-bucket-1158020804995033"
   s3_key        = "lambda/processed_lambda.zip"
   timeout       = 300
+  # pandas, pyarrow, the entity snapshots and the ingestion cache, which is
+  # sized at a quarter of this, do not fit in the default 128 MB.
+  memory_size   = 1024
   layers        = ["arn:aws:lambda:eu-west-2:336392948345:layer:AWSSDKPandas-Python39:8",aws_lambda_layer_version.parquet_layer.arn] 
+  environment {
+    variables = {
+      PROCESSED_WORKERS = 4
+      FACT_LAYOUT       = "partitioned"
+    }
+  }
 }
 
 
@@ -57,6 +66,8 @@ resource "aws_s3_bucket_notification" "ingestion_bucket_notification" {
   lambda_function {
     lambda_function_arn = aws_lambda_function.processed_lambda.arn
     events              = ["s3:ObjectCreated:*"]
+    # only the run manifests start the next stage
+    filter_prefix       = "run_manifests/ingestion/"
   }
 
   depends_on = [aws_lambda_permission.allow_ingestion_s3]
@@ -37,6 +37,8 @@ resource "aws_s3_bucket_notification" "processed_bucket_notification" {
   lambda_function {
     lambda_function_arn = aws_lambda_function.warehouse_lambda.arn
     events              = ["s3:ObjectCreated:*"]
+    # only the run manifests start the next stage
+    filter_prefix       = "run_manifests/processed/"
   }
 
   depends_on = [aws_lambda_permission.allow_processed_s3]
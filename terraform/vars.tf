@@ -13,4 +13,8 @@ variable "processed_lambda" {
 variable "warehouse_lambda" {
   type    = string
   default = "s3-warehouse-lambda"
-}
\ No newline at end of file
+}
+variable "compaction_lambda" {
+  type    = string
+  default = "s3-compaction-lambda"
+}
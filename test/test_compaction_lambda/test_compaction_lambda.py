@@ -0,0 +1,169 @@
+import pytest
+import os
+import io
+import json
+import boto3
+import pandas as pd
+from unittest.mock import patch
+from botocore.exceptions import ClientError
+from moto import mock_s3
+from src.lambda_functions.compaction_lambda import lambda_handler
+
+ingestion = "ingestion-test-bucket"
+processed = "processed-test-bucket"
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_s3():
+        s3 = boto3.client("s3", region_name="eu-west-2")
+        for bucket in (ingestion, processed):
+            s3.create_bucket(
+                Bucket=bucket,
+                CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+            )
+        with patch("src.lambda_functions.compaction_lambda.ingestion_bucket", ingestion), \
+                patch("src.lambda_functions.compaction_lambda.processed_bucket", processed), \
+                patch("src.lambda_functions.compaction_lambda._checkpoint_client", None):
+            yield s3
+
+
+def currency(currency_id, code, last_updated):
+    return {'currency_id': currency_id, 'currency_code': code,
+            'created_at': '2022-11-03, 14:20:49:962000',
+            'last_updated': last_updated}
+
+
+def put_json(s3, key, rows):
+    s3.put_object(Bucket=ingestion, Key=key, Body=json.dumps({'data': rows}))
+
+
+def put_parquet(s3, key, frame):
+    buffer = io.BytesIO()
+    frame.to_parquet(buffer, index=False)
+    s3.put_object(Bucket=processed, Key=key, Body=buffer.getvalue())
+
+
+def put_state(s3, bucket, table_name, latest, state_key, stored):
+    s3.put_object(Bucket=bucket, Key=f'checkpoints/{table_name}.json',
+                  Body=json.dumps({'table': table_name, 'latest': latest,
+                                   'key': f'{table_name}/{latest}.json'}))
+    s3.put_object(Bucket=processed, Key=state_key,
+                  Body=json.dumps({table_name: stored}))
+
+
+def keys(s3, bucket, prefix):
+    res = s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
+    return [obj['Key'] for obj in res.get('Contents', [])]
+
+
+def read_json(s3, key):
+    return json.loads(s3.get_object(Bucket=ingestion, Key=key)['Body'].read())['data']
+
+
+def test_closed_days_are_merged_into_their_newest_file(s3):
+    put_json(s3, 'currency/2022-11-03-10-00-00.json',
+             [currency(1, 'GBP', '2022-11-03, 09:59:00:000000'),
+              currency(2, 'USD', '2022-11-03, 09:59:00:000000')])
+    put_json(s3, 'currency/2022-11-03-10-10-00.json',
+             [currency(1, 'EUR', '2022-11-03, 10:05:00:000000')])
+    put_json(s3, 'currency/2022-11-04-10-00-00.json',
+             [currency(2, 'JPY', '2022-11-04, 09:59:00:000000')])
+    put_json(s3, 'currency/2022-11-04-10-10-00.json',
+             [currency(3, 'CHF', '2022-11-04, 10:05:00:000000')])
+    put_state(s3, ingestion, 'currency', '2022-11-04-10-10-00',
+              'processed_update.json', '2022-11-04-10-10-00')
+
+    summary = lambda_handler({'buckets': ['ingestion']}, None)
+
+    assert summary == {'ingestion/currency': {'merged': 1, 'deleted': 1}}
+    assert keys(s3, ingestion, 'currency/') == [
+        'currency/2022-11-03-10-10-00.json',
+        'currency/2022-11-04-10-00-00.json',
+        'currency/2022-11-04-10-10-00.json']
+    assert read_json(s3, 'currency/2022-11-03-10-10-00.json') == [
+        currency(1, 'EUR', '2022-11-03, 10:05:00:000000'),
+        currency(2, 'USD', '2022-11-03, 09:59:00:000000')]
+
+
+def test_days_the_next_stage_has_not_read_are_left_alone(s3):
+    put_json(s3, 'currency/2022-11-03-10-00-00.json',
+             [currency(1, 'GBP', '2022-11-03, 09:59:00:000000')])
+    put_json(s3, 'currency/2022-11-03-10-10-00.json',
+             [currency(1, 'EUR', '2022-11-03, 10:05:00:000000')])
+    put_json(s3, 'currency/2022-11-04-10-00-00.json',
+             [currency(2, 'JPY', '2022-11-04, 09:59:00:000000')])
+    put_state(s3, ingestion, 'currency', '2022-11-04-10-00-00',
+              'processed_update.json', '2022-11-03-10-00-00')
+
+    assert lambda_handler({'buckets': ['ingestion']}, None) == {}
+    assert len(keys(s3, ingestion, 'currency/')) == 3
+
+
+def test_processed_files_keep_the_row_of_the_newest_file(s3):
+    put_parquet(s3, 'dim_currency/2022-11-03-10-00-00.parquet',
+                pd.DataFrame({'currency_id': [1, 2], 'currency_code': ['GBP', 'USD']}))
+    put_parquet(s3, 'dim_currency/2022-11-03-10-10-00.parquet',
+                pd.DataFrame({'currency_id': [1], 'currency_code': ['EUR']}))
+    put_parquet(s3, 'dim_currency/2022-11-04-10-00-00.parquet',
+                pd.DataFrame({'currency_id': [3], 'currency_code': ['CHF']}))
+    put_state(s3, processed, 'dim_currency', '2022-11-04-10-00-00',
+              'warehouse_update.json', '2022-11-04-10-00-00')
+
+    summary = lambda_handler({'buckets': ['processed']}, None)
+
+    assert summary == {'processed/dim_currency': {'merged': 1, 'deleted': 1}}
+    body = s3.get_object(Bucket=processed,
+                         Key='dim_currency/2022-11-03-10-10-00.parquet')['Body'].read()
+    merged = pd.read_parquet(io.BytesIO(body))
+    assert merged.to_dict('records') == [{'currency_id': 2, 'currency_code': 'USD'},
+                                         {'currency_id': 1, 'currency_code': 'EUR'}]
+
+
+def test_superseded_fact_partitions_are_removed(s3):
+    frame = pd.DataFrame({'payment_id': [1], 'amount': [1.5]})
+    old = 'fact_payment/created_date=2022-11-01/2022-11-02-10-00-00.parquet'
+    current = 'fact_payment/created_date=2022-11-01/2022-11-03-10-00-00.parquet'
+    newest = 'fact_payment/created_date=2022-11-04/2022-11-04-10-00-00.parquet'
+    for key in (old, current, newest):
+        put_parquet(s3, key, frame)
+    s3.put_object(Bucket=processed, Key='table_manifests/fact_payment.json',
+                  Body=json.dumps({'table': 'fact_payment', 'latest': '2022-11-04-10-00-00',
+                                   'partitions': {'2022-11-01': current,
+                                                  '2022-11-04': newest}}))
+    put_state(s3, processed, 'fact_payment', '2022-11-04-10-00-00',
+              'warehouse_update.json', '2022-11-04-10-00-00')
+
+    summary = lambda_handler({'buckets': ['processed']}, None)
+
+    assert summary == {'processed/fact_payment': {'merged': 0, 'deleted': 1}}
+    assert keys(s3, processed, 'fact_payment/') == [current, newest]
+
+
+def test_a_file_changed_while_compacting_is_not_replaced(s3):
+    put_json(s3, 'currency/2022-11-03-10-00-00.json',
+             [currency(1, 'GBP', '2022-11-03, 09:59:00:000000')])
+    put_json(s3, 'currency/2022-11-03-10-10-00.json',
+             [currency(1, 'EUR', '2022-11-03, 10:05:00:000000')])
+    put_state(s3, ingestion, 'currency', '2022-11-04-10-00-00',
+              'processed_update.json', '2022-11-04-10-00-00')
+
+    def conflict(**kwargs):
+        raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+
+    with patch('src.lambda_functions.compaction_lambda.get_checkpoint_client') as client:
+        client.return_value = s3
+        with patch.object(s3, 'put_object', side_effect=conflict):
+            assert lambda_handler({'buckets': ['ingestion']}, None) == {}
+    assert len(keys(s3, ingestion, 'currency/')) == 2
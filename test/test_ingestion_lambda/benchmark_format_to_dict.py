@@ -0,0 +1,79 @@
+import json
+import sys
+import timeit
+import datetime
+from decimal import Decimal
+from src.lambda_functions.ingestion_lambda import (encode_table_data,
+                                                   format_to_dict,
+                                                   TABLES)
+
+# Compares the columnar format_to_dict and encode_table_data with the
+# row-by-row format_to_dict they replaced, on generated sales_order rows:
+#
+#     PYTHONPATH=$(pwd) python test/test_ingestion_lambda/benchmark_format_to_dict.py [rows]
+#
+# Not collected by pytest. It checks the outputs are identical before
+# timing anything.
+
+
+def legacy_format_to_dict(rows, column_titles):
+    """The row-by-row format_to_dict, kept to benchmark against."""
+    data = []
+
+    for element in rows:
+        row = {}
+        i = 0
+        for name in column_titles:
+            row[name] = element[i]
+            i += 1
+
+        data.append(row)
+
+    for element in data:
+        if 'unit_price' in element:
+            element['unit_price'] = str(element['unit_price'])
+        elif 'payment_amount' in element:
+            element['payment_amount'] = str(element['payment_amount'])
+        elif 'item_unit_price' in element:
+            element['item_unit_price'] = str(element['item_unit_price'])
+        time1 = element['created_at']
+        element['created_at'] = time1.strftime("%Y-%m-%d, %X:%f")
+        time2 = element['last_updated']
+        element['last_updated'] = time2.strftime("%Y-%m-%d, %X:%f")
+
+    return {'data': data}
+
+
+def sales_order_rows(count):
+    start = datetime.datetime(2022, 11, 3, 14, 20, 52, 186000)
+    rows = []
+    for i in range(count):
+        timestamp = start + datetime.timedelta(seconds=i, microseconds=i)
+        rows.append([i, timestamp, timestamp, i % 50, i % 20, i % 30, 1000 + i,
+                     Decimal(f'{i % 500}.{i % 100:02d}'), i % 3,
+                     '2022-11-10', '2022-11-03', i % 30])
+    return rows
+
+
+def main(count=100000, repeat=5):
+    rows = sales_order_rows(count)
+    columns = TABLES['sales_order']['columns']
+    expected = json.dumps(legacy_format_to_dict(rows, columns))
+    assert format_to_dict(rows, columns) == legacy_format_to_dict(rows, columns)
+    assert encode_table_data(rows, columns) == expected
+
+    cases = {
+        'legacy format_to_dict': lambda: legacy_format_to_dict(rows, columns),
+        'format_to_dict': lambda: format_to_dict(rows, columns),
+        'legacy json.dumps(format_to_dict)':
+            lambda: json.dumps(legacy_format_to_dict(rows, columns)),
+        'encode_table_data': lambda: encode_table_data(rows, columns),
+    }
+    print(f'{count} sales_order rows, best of {repeat}:')
+    for name, case in cases.items():
+        best = min(timeit.repeat(case, number=1, repeat=repeat))
+        print(f'  {name:<36} {best * 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,130 @@
+import pytest
+import os
+import json
+import time
+import boto3
+import datetime
+from unittest.mock import patch, Mock
+from moto import mock_s3
+from src.lambda_functions.ingestion_lambda import (lambda_handler,
+                                                   plan_backfill_ranges,
+                                                   run_backfills,
+                                                   TABLES)
+
+bucket_name = "test-183947598437"
+newest = datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)
+rows = [[i, 'X', newest, newest] for i in range(1, 6)]
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_s3():
+        s3 = boto3.client("s3", region_name="eu-west-2")
+        s3.create_bucket(
+            Bucket=bucket_name,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        with patch("src.lambda_functions.ingestion_lambda.ingestion_bucket",
+                   bucket_name), \
+                patch("src.lambda_functions.ingestion_lambda._checkpoint_client", None), \
+                patch.dict(os.environ, {"INGESTION_BACKFILL_ROWS": "2"}):
+            yield s3
+
+
+def currency_connection(credentials=None):
+    """Returns a mock connection to a currency table with ids 1 to 5."""
+    conn = Mock()
+
+    def prepare(sql):
+        statement = Mock()
+        if sql.startswith('SELECT MIN'):
+            statement.run.return_value = [[1, 5, newest]]
+        elif 'pg_class' in sql:
+            statement.run.return_value = [[5.0]]
+        else:
+            statement.run.side_effect = lambda low, high: rows[low - 1:high]
+        return statement
+    conn.prepare.side_effect = prepare
+    return conn
+
+
+def keys(s3, prefix):
+    res = s3.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
+    return [obj['Key'] for obj in res.get('Contents', [])]
+
+
+def test_ranges_are_sized_from_the_planner_estimate():
+    conn = Mock()
+    conn.prepare.return_value.run.side_effect = [[[1, 250, newest]], [[250.0]]]
+    with patch.dict(os.environ, {"INGESTION_BACKFILL_ROWS": "100"}):
+        ranges, max_watermark = plan_backfill_ranges(conn, 'currency')
+    assert ranges == [[1, 84], [85, 168], [169, 250]]
+    assert max_watermark == newest
+
+
+def test_a_backfill_saves_one_file_per_range_then_checkpoints(s3):
+    with patch('src.lambda_functions.ingestion_lambda.connect_to_totesys',
+               side_effect=currency_connection):
+        progress, timings = run_backfills({}, s3, ['currency'], 2)
+
+    assert progress == {'currency': {'done': 3, 'ranges': 3}}
+    assert keys(s3, 'currency/') == ['currency/2022-11-03-14-20-50.json',
+                                     'currency/2022-11-03-14-20-51.json',
+                                     'currency/2022-11-03-14-20-52.json']
+    body = s3.get_object(Bucket=bucket_name,
+                         Key='currency/2022-11-03-14-20-51.json')['Body']
+    assert [row['currency_id'] for row in json.loads(body.read())['data']] == [3, 4]
+    checkpoint = json.loads(s3.get_object(
+        Bucket=bucket_name, Key='checkpoints/currency.json')['Body'].read())
+    assert checkpoint['key'] == 'currency/2022-11-03-14-20-52.json'
+    assert checkpoint['keyset'] == {'watermark': '2022-11-03T14:20:49.962000', 'id': None}
+    assert keys(s3, 'backfills/') == []
+    [timing] = timings
+    assert timing['rows'] == 5
+    assert timing['previous'] == 'currency/2022-11-03-14-20-51.json'
+
+
+def test_a_backfill_out_of_time_is_resumed_by_the_next_invocation(s3):
+    connections = []
+
+    def connect(credentials):
+        connections.append(currency_connection())
+        return connections[-1]
+    with patch('src.lambda_functions.ingestion_lambda.connect_to_totesys',
+               side_effect=connect):
+        progress, timings = run_backfills({}, s3, ['currency'], 2, time.time() - 1)
+        assert progress == {'currency': {'done': 0, 'ranges': 3}}
+        assert timings == []
+        assert keys(s3, 'backfills/') == ['backfills/currency.json']
+
+        progress, timings = run_backfills({}, s3, ['currency'], 2)
+    assert progress == {'currency': {'done': 3, 'ranges': 3}}
+    assert len(keys(s3, 'currency/')) == 3
+    # The second invocation picks up the saved plan instead of planning again.
+    planned = [c for conn in connections for c in conn.prepare.call_args_list
+               if c.args[0].startswith('SELECT MIN')]
+    assert len(planned) == 1
+
+
+def test_incremental_runs_skip_tables_being_backfilled(s3):
+    s3.put_object(Bucket=bucket_name, Key='backfills/currency.json', Body='{}')
+    with patch('src.lambda_functions.ingestion_lambda.get_secret', return_value='{}'), \
+            patch('src.lambda_functions.ingestion_lambda.connect_to_totesys'), \
+            patch('src.lambda_functions.ingestion_lambda.trigger_lambda_processed'), \
+            patch('src.lambda_functions.ingestion_lambda.ingest_table') as ingest:
+        ingest.side_effect = lambda conn, s3, table_name: {
+            'table': table_name, 'rows': 0, 'fetch': 0, 'upload': 0, 'total': 0}
+        lambda_handler(None, None)
+    assert [c.args[2] for c in ingest.call_args_list] == [
+        table_name for table_name in TABLES if table_name != 'currency']
@@ -0,0 +1,161 @@
+import pytest
+import os
+import json
+import boto3
+import datetime
+import io
+from decimal import Decimal
+import pyarrow as pa
+import pyarrow.parquet as pq
+from unittest.mock import patch, Mock
+from moto import mock_s3
+from src.lambda_functions.ingestion_lambda import (cdc_value,
+                                                   decode_changes,
+                                                   ingest_changes,
+                                                   save_changes,
+                                                   TABLES)
+
+bucket_name = "test-183947598437"
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_s3():
+        s3 = boto3.client("s3", region_name="eu-west-2")
+        s3.create_bucket(
+            Bucket=bucket_name,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        with patch("src.lambda_functions.ingestion_lambda.ingestion_bucket",
+                   bucket_name), \
+                patch("src.lambda_functions.ingestion_lambda._checkpoint_client", None):
+            yield s3
+
+
+def currency(action, currency_id, code, last_updated):
+    return json.dumps({'action': action, 'schema': 'public', 'table': 'currency', 'columns': [
+        {'name': 'currency_id', 'type': 'integer', 'value': currency_id},
+        {'name': 'currency_code', 'type': 'character varying(3)', 'value': code},
+        {'name': 'created_at', 'type': 'timestamp without time zone',
+         'value': '2022-11-03 14:20:49.962'},
+        {'name': 'last_updated', 'type': 'timestamp without time zone',
+         'value': last_updated}]})
+
+
+def deleted(currency_id):
+    return json.dumps({'action': 'D', 'schema': 'public', 'table': 'currency',
+                       'identity': [{'name': 'currency_id', 'type': 'integer',
+                                     'value': currency_id}]})
+
+
+begin = json.dumps({'action': 'B'})
+commit = json.dumps({'action': 'C'})
+changes = [['0/100', begin],
+           ['0/110', currency('I', 1, 'GBP', '2022-11-03 14:20:49.962')],
+           ['0/120', currency('I', 2, 'USD', '2022-11-03 14:20:49.962')],
+           ['0/150', commit],
+           ['0/160', begin],
+           ['0/170', currency('U', 1, 'EUR', '2022-11-03 14:25:01.5')],
+           ['0/180', deleted(2)],
+           ['0/200', commit]]
+
+
+def slot_connection(changes, slot_exists=True):
+    conn = Mock()
+
+    def run(sql, **params):
+        if 'pg_replication_slots' in sql:
+            return [[1]] if slot_exists else []
+        if 'pg_logical_slot_peek_changes' in sql:
+            return changes
+        return None
+    conn.run.side_effect = run
+    return conn
+
+
+def test_each_row_keeps_its_last_change():
+    tables, last_lsn = decode_changes(changes)
+    assert last_lsn == '0/200'
+    assert tables['currency'] == [
+        [2, 'USD', datetime.datetime(2022, 11, 3, 14, 20, 49, 962000),
+         datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)],
+        [1, 'EUR', datetime.datetime(2022, 11, 3, 14, 20, 49, 962000),
+         datetime.datetime(2022, 11, 3, 14, 25, 1, 500000)]]
+
+
+def test_transactions_committed_before_the_stored_lsn_are_skipped():
+    tables, last_lsn = decode_changes(changes, stored='0/150')
+    assert last_lsn == '0/200'
+    assert [row[:2] for row in tables['currency']] == [[1, 'EUR']]
+    assert decode_changes(changes, stored='0/200') == ({}, '0/200')
+
+
+def test_changes_are_saved_and_the_slot_confirmed(s3):
+    conn = slot_connection(changes)
+    [timing] = ingest_changes(conn, s3)
+
+    assert timing['key'] == 'currency/2022-11-03-14-25-02.json'
+    body = s3.get_object(Bucket=bucket_name, Key=timing['key'])['Body']
+    assert json.loads(body.read())['data'] == [
+        {'currency_id': 2, 'currency_code': 'USD',
+         'created_at': '2022-11-03, 14:20:49:962000',
+         'last_updated': '2022-11-03, 14:20:49:962000'},
+        {'currency_id': 1, 'currency_code': 'EUR',
+         'created_at': '2022-11-03, 14:20:49:962000',
+         'last_updated': '2022-11-03, 14:25:01:500000'}]
+    assert 'Contents' not in s3.list_objects_v2(Bucket=bucket_name, Prefix='deletes/')
+    peek = conn.run.call_args_list[1]
+    assert peek.kwargs['actions'] == 'insert,update'
+    checkpoint = json.loads(s3.get_object(
+        Bucket=bucket_name, Key='checkpoints/cdc.json')['Body'].read())
+    assert checkpoint['lsn'] == '0/200'
+    advance = conn.run.call_args_list[-1]
+    assert 'pg_replication_slot_advance' in advance.args[0]
+    assert advance.kwargs['lsn'] == '0/200'
+
+
+def test_changes_already_saved_are_only_confirmed(s3):
+    s3.put_object(Bucket=bucket_name, Key='checkpoints/cdc.json',
+                  Body=json.dumps({'slot': 'totesys_ingestion', 'lsn': '0/200'}))
+    conn = slot_connection(changes)
+    assert ingest_changes(conn, s3) == []
+    assert 'Contents' not in s3.list_objects_v2(Bucket=bucket_name, Prefix='currency/')
+    assert conn.run.call_args_list[-1].kwargs['lsn'] == '0/200'
+
+
+def test_the_first_run_creates_the_slot_then_polls_every_table(s3):
+    conn = slot_connection([], slot_exists=False)
+    with patch('src.lambda_functions.ingestion_lambda.ingest_table') as ingest:
+        ingest_changes(conn, s3)
+    assert 'pg_create_logical_replication_slot' in conn.run.call_args_list[1].args[0]
+    assert [c.args[2] for c in ingest.call_args_list] == list(TABLES)
+
+
+def test_numeric_values_are_read_as_decimals():
+    assert cdc_value({'name': 'unit_price', 'type': 'numeric(10,2)', 'value': '3.90'}) == \
+        Decimal('3.90')
+    assert cdc_value({'name': 'unit_price', 'type': 'numeric', 'value': None}) is None
+
+
+def test_parquet_changes_keep_their_decimal_prices(s3):
+    timestamp = datetime.datetime(2022, 11, 3, 14, 20, 52, 186000)
+    row = [1, timestamp, timestamp, 9, 16, 18, 84754,
+           cdc_value({'name': 'unit_price', 'type': 'numeric(10,2)', 'value': '2.43'}),
+           3, '2022-11-10', '2022-11-03', 4]
+    with patch.dict(os.environ, {'INGESTION_FORMAT': 'parquet'}):
+        timing = save_changes(s3, 'sales_order', [row])
+    body = s3.get_object(Bucket=bucket_name, Key=timing['key'])['Body'].read()
+    table = pq.read_table(io.BytesIO(body))
+    assert pa.types.is_decimal(table.schema.field('unit_price').type)
+    assert table.column('unit_price').to_pylist() == [Decimal('2.43')]
@@ -0,0 +1,95 @@
+import pytest
+import os
+import json
+import boto3
+import datetime
+from unittest.mock import patch, Mock
+from moto import mock_s3
+from src.lambda_functions.ingestion_lambda import (lambda_handler,
+                                                   probe_changed_tables,
+                                                   TABLES)
+
+bucket_name = "test-183947598437"
+newest = datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_s3():
+        s3 = boto3.client("s3", region_name="eu-west-2")
+        s3.create_bucket(
+            Bucket=bucket_name,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        with patch("src.lambda_functions.ingestion_lambda.ingestion_bucket",
+                   bucket_name), \
+                patch("src.lambda_functions.ingestion_lambda._checkpoint_client", None):
+            yield s3
+
+
+def put_checkpoint(s3, table_name, latest, keyset=None):
+    checkpoint = {'table': table_name, 'latest': latest,
+                  'key': f'{table_name}/{latest}.json'}
+    if keyset is not None:
+        checkpoint['keyset'] = keyset
+    s3.put_object(Bucket=bucket_name, Key=f'checkpoints/{table_name}.json',
+                  Body=json.dumps(checkpoint))
+
+
+def test_every_table_is_probed_in_one_query(s3):
+    put_checkpoint(s3, 'currency', '2022-11-03-14-20-50',
+                   {'watermark': newest.isoformat(), 'id': 4})
+    put_checkpoint(s3, 'department', '2022-11-03-14-20-50')
+    conn = Mock()
+    conn.run.return_value = [['currency', newest, 0],
+                             ['department', None, 0],
+                             ['design', newest, 12]]
+
+    changed, idle = probe_changed_tables(conn, ['currency', 'department', 'design'])
+
+    conn.run.assert_called_once()
+    sql = conn.run.call_args.args[0]
+    assert sql.count(' UNION ALL ') == 2
+    assert "SELECT 'currency', MAX(last_updated), COUNT(*) FROM currency " \
+        "WHERE (last_updated, currency_id) > (:last_updated_0, :last_id_0)" in sql
+    assert 'FROM department WHERE last_updated > :last_updated_1' in sql
+    assert sql.endswith('FROM design;')
+    assert conn.run.call_args.kwargs == {
+        'last_updated_0': newest, 'last_id_0': 4,
+        'last_updated_1': datetime.datetime(2022, 11, 3, 14, 20, 50)}
+    assert changed == ['design']
+    assert idle['currency']['key'] == 'currency/2022-11-03-14-20-50.json'
+    assert idle['currency']['previous'] == 'currency/2022-11-03-14-20-50.json'
+    assert idle['department']['rows'] == 0
+
+
+@pytest.mark.parametrize('workers', ['1', '3'])
+def test_only_changed_tables_are_extracted(s3, workers):
+    conn = Mock()
+    conn.run.return_value = [[table_name, newest, 3 if table_name == 'payment' else 0]
+                             for table_name in TABLES]
+    with patch('src.lambda_functions.ingestion_lambda.get_secret', return_value='{}'), \
+            patch('src.lambda_functions.ingestion_lambda.connect_to_totesys',
+                  return_value=conn), \
+            patch('src.lambda_functions.ingestion_lambda.trigger_lambda_processed') \
+            as trigger, \
+            patch('src.lambda_functions.ingestion_lambda.ingest_table') as ingest, \
+            patch.dict(os.environ, {"INGESTION_PROBE": "true",
+                                    "INGESTION_WORKERS": workers}):
+        ingest.side_effect = lambda conn, s3, table_name: {
+            'table': table_name, 'rows': 3, 'fetch': 0, 'upload': 0, 'total': 0}
+        lambda_handler(None, None)
+    assert [c.args[2] for c in ingest.call_args_list] == ['payment']
+    timings = trigger.call_args.args[0]
+    assert [timing['table'] for timing in timings] == list(TABLES)
@@ -0,0 +1,105 @@
+import pytest
+import os
+import json
+import boto3
+from unittest.mock import patch
+from botocore.exceptions import ClientError
+from moto import mock_s3
+from src.lambda_functions import ingestion_lambda
+from src.lambda_functions.ingestion_lambda import (get_latest_file_date,
+                                                   lambda_handler,
+                                                   read_checkpoint,
+                                                   save_checkpoint)
+
+bucket_name = "test-183947598437"
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_s3():
+        s3 = boto3.client("s3", region_name="eu-west-2")
+        s3.create_bucket(
+            Bucket=bucket_name,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        with patch("src.lambda_functions.ingestion_lambda.ingestion_bucket",
+                   bucket_name), \
+                patch("src.lambda_functions.ingestion_lambda._checkpoint_client", None):
+            yield s3
+
+
+def sent_headers():
+    """Records the headers of every PutObject sent by the checkpoint client."""
+    headers = []
+    ingestion_lambda.get_checkpoint_client().meta.events.register(
+        'before-send.s3.PutObject',
+        lambda request, **kwargs: headers.append(dict(request.headers)))
+    return headers
+
+
+def test_missing_checkpoint_is_rebuilt_from_every_page_of_keys(s3):
+    for second in range(1005):
+        minute, second = divmod(second, 60)
+        hour, minute = divmod(minute, 60)
+        s3.put_object(Bucket=bucket_name, Body='{}',
+                      Key=f'payment/2022-11-03-{hour:02}-{minute:02}-{second:02}.json')
+    s3.put_object(Bucket=bucket_name, Body='{}',
+                  Key='payment_type/2023-01-01-00-00-00.json')
+
+    latest = get_latest_file_date(bucket_name, 'payment')
+    assert latest.strftime('%H-%M-%S') == '00-16-44'
+    checkpoint, _ = read_checkpoint(bucket_name, 'payment')
+    assert checkpoint == {'table': 'payment',
+                          'key': 'payment/2022-11-03-00-16-44.json',
+                          'latest': '2022-11-03-00-16-44'}
+
+
+def test_table_without_files_has_no_checkpoint(s3):
+    assert get_latest_file_date(bucket_name, 'currency') is None
+    assert read_checkpoint(bucket_name, 'currency') == (None, None)
+
+
+def test_checkpoint_writes_are_conditional(s3):
+    headers = sent_headers()
+    save_checkpoint(bucket_name, 'currency', 'currency/2022-11-03-14-20-50.json')
+    _, etag = read_checkpoint(bucket_name, 'currency')
+    save_checkpoint(bucket_name, 'currency', 'currency/2022-11-04-14-20-50.json')
+    assert headers[0]['If-None-Match'] == b'*'
+    assert headers[1]['If-Match'] == etag.encode()
+
+
+def test_checkpoint_never_moves_back(s3):
+    save_checkpoint(bucket_name, 'currency', 'currency/2022-11-04-14-20-50.json')
+    save_checkpoint(bucket_name, 'currency', 'currency/2022-11-03-14-20-50.json')
+    checkpoint, _ = read_checkpoint(bucket_name, 'currency')
+    assert checkpoint['latest'] == '2022-11-04-14-20-50'
+
+
+def test_conflicting_write_is_retried(s3):
+    client = ingestion_lambda.get_checkpoint_client()
+    conflict = ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+    with patch.object(client, 'put_object', side_effect=[conflict, None]) as put:
+        save_checkpoint(bucket_name, 'currency', 'currency/2022-11-03-14-20-50.json')
+    assert put.call_count == 2
+
+
+def test_rebuild_event_writes_checkpoints_without_extracting(s3):
+    s3.put_object(Bucket=bucket_name, Body='{}',
+                  Key='staff/2022-11-03-14-20-50.json')
+    with patch("src.lambda_functions.ingestion_lambda.get_secret") as get_secret:
+        lambda_handler({'rebuild_checkpoints': True}, None)
+    get_secret.assert_not_called()
+    body = s3.get_object(Bucket=bucket_name, Key='checkpoints/staff.json')['Body']
+    assert json.loads(body.read())['latest'] == '2022-11-03-14-20-50'
+    assert read_checkpoint(bucket_name, 'sales_order') == (None, None)
@@ -0,0 +1,52 @@
+import json
+import datetime
+from decimal import Decimal
+from src.lambda_functions.ingestion_lambda import (encode_rows,
+                                                   encode_table_data,
+                                                   format_to_dict,
+                                                   TABLES)
+
+timestamp = datetime.datetime(2022, 11, 3, 14, 20, 52, 186000)
+midnight = datetime.datetime(2022, 1, 9, 0, 0, 0)
+sales_rows = [
+    [1, timestamp, timestamp, 9, 16, 18, 84754, Decimal('2.43'), 3,
+     '2022-11-10', '2022-11-03', 4],
+    [2, midnight, timestamp, 3, 19, 8, 42972, Decimal('3.90'), 2,
+     '2022-11-07', '2022-11-08', 8],
+]
+staff_rows = [
+    [1, 'Jérémie', 'O"Brien\\', 2, 'jeremie@terrifictotes.com\n', midnight, timestamp],
+    [2, '日本', None, 3, '', timestamp, midnight],
+]
+
+
+def test_rows_are_formatted_into_dictionaries():
+    assert format_to_dict(sales_rows[:1], TABLES['sales_order']['columns']) == {'data': [
+        {'sales_order_id': 1, 'created_at': '2022-11-03, 14:20:52:186000',
+         'last_updated': '2022-11-03, 14:20:52:186000', 'design_id': 9,
+         'staff_id': 16, 'counterparty_id': 18, 'units_sold': 84754,
+         'unit_price': '2.43', 'currency_id': 3, 'agreed_delivery_date': '2022-11-10',
+         'agreed_payment_date': '2022-11-03', 'agreed_delivery_location_id': 4}]}
+    assert format_to_dict([], TABLES['sales_order']['columns']) == {'data': []}
+
+
+def test_timestamps_match_strftime():
+    [row] = format_to_dict(sales_rows[1:], TABLES['sales_order']['columns'])['data']
+    assert row['created_at'] == midnight.strftime("%Y-%m-%d, %X:%f")
+    assert row['unit_price'] == '3.90'
+
+
+def test_encoding_is_byte_for_byte_json_dumps():
+    for table_name, rows in [('sales_order', sales_rows), ('staff', staff_rows)]:
+        columns = TABLES[table_name]['columns']
+        expected = json.dumps(format_to_dict(rows, columns))
+        assert encode_table_data(rows, columns) == expected
+        assert encode_rows(rows, columns) == [
+            json.dumps(row) for row in format_to_dict(rows, columns)['data']]
+    assert encode_table_data([], TABLES['staff']['columns']) == json.dumps({'data': []})
+
+
+def test_other_types_fall_back_to_json_dumps():
+    columns = ['value', 'flag', 'created_at', 'last_updated']
+    rows = [[1.5, True, timestamp, timestamp], [float('inf'), False, timestamp, timestamp]]
+    assert encode_table_data(rows, columns) == json.dumps(format_to_dict(rows, columns))
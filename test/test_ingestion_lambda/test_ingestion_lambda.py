@@ -1,9 +1,10 @@
 import pytest
 import os
+import json
 import boto3
 from unittest.mock import patch
 from moto import mock_s3
-from src.lambda_functions.ingestion_lambda import lambda_handler
+from src.lambda_functions.ingestion_lambda import lambda_handler, TABLES
 import datetime
 
 
@@ -33,91 +34,22 @@ def setup_s3_bucket(s3):
     )
 
 
-@pytest.fixture
-def mock_get_counterparty_data():
-    with patch("src.lambda_functions.ingestion_lambda.get_counterparty_data",
-               return_value=('''{
-                   "data": [{"something": "something"}]}''', datetime.date.today())) as mock:
-        yield mock
-
-
-@pytest.fixture
-def mock_get_address_data():
-    with patch("src.lambda_functions.ingestion_lambda.get_address_data",
-               return_value=('''{
-                   "data": [{"something": "something"}]}''', datetime.date.today())) as mock:
-        yield mock
+def table_data(conn, table_name, *args):
+    row = {TABLES[table_name]['primary_key']: 1,
+           'last_updated': '2022-11-03, 14:20:49:962000'}
+    return {"data": [row]}, datetime.datetime(2022, 11, 3, 14, 20, 50)
 
 
 @pytest.fixture
-def mock_get_currency_util():
-    with patch("src.lambda_functions.ingestion_lambda.get_currency_util",
-               return_value=('''{
-                   "data": [{"something": "something"}]}''', datetime.date.today())) as mock:
+def mock_get_table_data():
+    with patch("src.lambda_functions.ingestion_lambda.get_table_data",
+               side_effect=table_data) as mock:
         yield mock
 
 
 @pytest.fixture
-def mock_get_department_data():
-    with patch("src.lambda_functions.ingestion_lambda.get_department_data",
-               return_value=('''{
-                   "data": [{"something": "something"}]}''', datetime.date.today())) as mock:
-        yield mock
-
-
-@pytest.fixture
-def mock_get_design_data():
-    with patch("src.lambda_functions.ingestion_lambda.get_design_data",
-               return_value=('''{
-                   "data": [{"something": "something"}]}''', datetime.date.today())) as mock:
-        yield mock
-
-
-@pytest.fixture
-def mock_get_payment_data():
-    with patch("src.lambda_functions.ingestion_lambda.get_payment_data",
-               return_value=('''{
-                   "data": [{"something": "something"}]}''', datetime.date.today())) as mock:
-        yield mock
-
-
-@pytest.fixture
-def mock_get_payment_type_data():
-    with patch("src.lambda_functions.ingestion_lambda.get_payment_type_data",
-               return_value=('''{
-                   "data": [{"something": "something"}]}''', datetime.date.today())) as mock:
-        yield mock
-
-
-@pytest.fixture
-def mock_get_purchase_order_data():
-    with patch("src.lambda_functions.ingestion_lambda.get_purchase_order_data",
-               return_value=('''{
-                   "data": [{"something": "something"}]}''', datetime.date.today())) as mock:
-        yield mock
-
-
-@pytest.fixture
-def mock_get_sales_order_util():
-    with patch("src.lambda_functions.ingestion_lambda.get_sales_order_util",
-               return_value=('''{
-                   "data": [{"something": "something"}]}''', datetime.date.today())) as mock:
-        yield mock
-
-
-@pytest.fixture
-def mock_get_staff_data():
-    with patch("src.lambda_functions.ingestion_lambda.get_staff_data",
-               return_value=('''{
-                   "data": [{"something": "something"}]}''', datetime.date.today())) as mock:
-        yield mock
-
-
-@pytest.fixture
-def mock_get_transaction_data():
-    with patch("src.lambda_functions.ingestion_lambda.get_transaction_data",
-               return_value=('''{
-                   "data": [{"something": "something"}]}''', datetime.date.today())) as mock:
+def mock_connect_to_totesys():
+    with patch("src.lambda_functions.ingestion_lambda.connect_to_totesys") as mock:
         yield mock
 
 
@@ -158,12 +90,7 @@ def test_create_bucket(s3, setup_s3_bucket):
 
 
 def test_lambda_handler_ingests_all_data(s3, setup_s3_bucket, mock_ingestion_bucket,
-                                         mock_get_counterparty_data, mock_get_address_data,
-                                         mock_get_currency_util, mock_get_department_data,
-                                         mock_get_design_data, mock_get_payment_data,
-                                         mock_get_payment_type_data,
-                                         mock_get_purchase_order_data, mock_get_sales_order_util,
-                                         mock_get_staff_data, mock_get_transaction_data,
+                                         mock_get_table_data, mock_connect_to_totesys,
                                          mock_get_secret, mock_trigger_lambda_processed):
     list_of_bucket_keys = ['address', 'counterparty', 'currency',
                            'department', 'design', 'payment',
@@ -171,18 +98,112 @@ def test_lambda_handler_ingests_all_data(s3, setup_s3_bucket, mock_ingestion_buc
                            'staff', 'transaction']
     lambda_handler(None, None)
     result = s3.list_objects_v2(Bucket="test-183947598437")
-    for key in result['Contents']:
-        assert key['Key'].split('/')[0] in list_of_bucket_keys
-    assert len(result['Contents']) == 11
+    data_keys = [obj['Key'] for obj in result['Contents']
+                 if not obj['Key'].startswith('checkpoints/')]
+    for key in data_keys:
+        assert key.split('/')[0] in list_of_bucket_keys
+    assert len(data_keys) == 11
+    assert len(result['Contents']) == 22
+
+
+def test_lambda_handler_uses_one_connection_for_all_tables(
+        s3, setup_s3_bucket, mock_ingestion_bucket, mock_get_table_data,
+        mock_connect_to_totesys, mock_get_secret, mock_trigger_lambda_processed):
+    lambda_handler(None, None)
+    mock_connect_to_totesys.assert_called_once()
+    conn = mock_connect_to_totesys.return_value
+    tables = [c.args[1] for c in mock_get_table_data.call_args_list]
+    assert tables == list(TABLES)
+    assert all(c.args[0] is conn for c in mock_get_table_data.call_args_list)
+    conn.close.assert_called_once()
+    mock_trigger_lambda_processed.assert_called_once()
+
+
+def test_lambda_handler_ingests_tables_in_parallel(
+        s3, setup_s3_bucket, mock_ingestion_bucket, mock_get_table_data,
+        mock_connect_to_totesys, mock_get_secret, mock_trigger_lambda_processed):
+    with patch.dict(os.environ, {"INGESTION_WORKERS": "3"}):
+        lambda_handler(None, None)
+    result = s3.list_objects_v2(Bucket="test-183947598437")
+    assert len(result['Contents']) == 22
+    assert 1 <= mock_connect_to_totesys.call_count <= 3
+    tables = sorted(c.args[1] for c in mock_get_table_data.call_args_list)
+    assert tables == sorted(TABLES)
+    mock_trigger_lambda_processed.assert_called_once()
+
+
+def test_parallel_failure_does_not_trigger_processed(
+        s3, setup_s3_bucket, mock_ingestion_bucket, mock_get_table_data,
+        mock_connect_to_totesys, mock_get_secret, mock_trigger_lambda_processed):
+    def fail_on_staff(conn, table_name, *args):
+        if table_name == 'staff':
+            raise RuntimeError('connection lost')
+        return table_data(conn, table_name)
+    mock_get_table_data.side_effect = fail_on_staff
+    with patch.dict(os.environ, {"INGESTION_WORKERS": "4"}):
+        with pytest.raises(RuntimeError):
+            lambda_handler(None, None)
+    mock_trigger_lambda_processed.assert_not_called()
+    conn = mock_connect_to_totesys.return_value
+    assert conn.close.call_count == mock_connect_to_totesys.call_count
+
+
+def test_lambda_handler_writes_parquet_when_configured(
+        s3, setup_s3_bucket, mock_ingestion_bucket, mock_connect_to_totesys,
+        mock_get_secret, mock_trigger_lambda_processed):
+    timestamp = datetime.datetime(2022, 11, 3, 14, 20, 49)
+    with patch("src.lambda_functions.ingestion_lambda.fetch_table_rows",
+               return_value=([[1, 'GBP', timestamp, timestamp]], timestamp)), \
+            patch("src.lambda_functions.ingestion_lambda.TABLES",
+                  {'currency': TABLES['currency']}), \
+            patch.dict(os.environ, {"INGESTION_FORMAT": "parquet"}):
+        lambda_handler(None, None)
+    result = s3.list_objects_v2(Bucket="test-183947598437")
+    assert [obj['Key'] for obj in result['Contents']] == [
+        'checkpoints/currency.json', 'currency/2022-11-03-14-20-49.parquet']
 
 
 def test_error_handling_in_lambda_handler(s3, setup_s3_bucket, mock_ingestion_bucket,
-                                          mock_get_counterparty_data, mock_get_address_data,
-                                          mock_get_currency_util, mock_get_department_data,
-                                          mock_get_design_data, mock_get_payment_data,
-                                          mock_get_payment_type_data,
-                                          mock_get_purchase_order_data, mock_get_sales_order_util,
-                                          mock_get_staff_data, mock_get_transaction_data,
+                                          mock_get_table_data, mock_connect_to_totesys,
                                           mock_get_secret, mock_invalid_bucket):
     with pytest.raises(Exception):
         lambda_handler(None, None)
+
+
+def test_lambda_handler_writes_a_run_manifest(
+        s3, setup_s3_bucket, mock_ingestion_bucket, mock_connect_to_totesys,
+        mock_get_secret):
+    timestamp = datetime.datetime(2022, 11, 3, 14, 20, 49)
+    s3.put_object(Bucket="test-183947598437",
+                  Key='checkpoints/currency.json',
+                  Body=json.dumps({'table': 'currency', 'latest': '2022-11-02-10-00-00',
+                                   'key': 'currency/2022-11-02-10-00-00.json'}))
+    with patch("src.lambda_functions.ingestion_lambda.get_table_data",
+               return_value=({"data": [{"currency_id": 1,
+                                        "last_updated": "2022-11-03, 14:20:48:500000"}]},
+                             timestamp)), \
+            patch("src.lambda_functions.ingestion_lambda._checkpoint_client", None), \
+            patch("src.lambda_functions.ingestion_lambda.TABLES",
+                  {'currency': TABLES['currency']}):
+        lambda_handler(None, None)
+    result = s3.list_objects_v2(Bucket="test-183947598437", Prefix='run_manifests/')
+    [manifest_key] = [obj['Key'] for obj in result['Contents']]
+    assert manifest_key.startswith('run_manifests/ingestion/')
+    manifest = json.loads(s3.get_object(Bucket="test-183947598437",
+                                        Key=manifest_key)['Body'].read())
+    head = s3.head_object(Bucket="test-183947598437",
+                          Key='currency/2022-11-03-14-20-49.json')
+    assert manifest['tables'] == {'currency': {
+        'key': 'currency/2022-11-03-14-20-49.json', 'etag': head['ETag'], 'rows': 1,
+        'watermark': '2022-11-03T14:20:48.500000',
+        'previous': 'currency/2022-11-02-10-00-00.json'}}
+
+
+def test_lambda_handler_writes_no_manifest_without_new_rows(
+        s3, setup_s3_bucket, mock_ingestion_bucket, mock_connect_to_totesys,
+        mock_get_secret):
+    with patch("src.lambda_functions.ingestion_lambda.get_table_data",
+               return_value=({"data": []}, None)), \
+            patch("src.lambda_functions.ingestion_lambda._checkpoint_client", None):
+        lambda_handler(None, None)
+    assert 'Contents' not in s3.list_objects_v2(Bucket="test-183947598437")
@@ -0,0 +1,176 @@
+import pytest
+import os
+import json
+import boto3
+import datetime
+from collections import deque
+from unittest.mock import patch, Mock
+from moto import mock_s3
+import pg8000.native
+from botocore.exceptions import ClientError
+from src.lambda_functions import ingestion_lambda
+from src.lambda_functions.ingestion_listener import (collect_notifications,
+                                                     fetch_notified_rows,
+                                                     ingest_notified_rows,
+                                                     install_notify_triggers,
+                                                     remove_notify_triggers,
+                                                     NOTIFY_CHANNEL)
+
+bucket_name = "test-183947598437"
+newest = datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)
+
+user = "user123"
+host = "localhost"
+db = "test_tote_db"
+password = "password123"
+port = "5432"
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_s3():
+        s3 = boto3.client("s3", region_name="eu-west-2")
+        s3.create_bucket(
+            Bucket=bucket_name,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        with patch("src.lambda_functions.ingestion_lambda.ingestion_bucket",
+                   bucket_name), \
+                patch("src.lambda_functions.ingestion_lambda._checkpoint_client", None):
+            yield s3
+
+
+@pytest.fixture
+def conditional_s3(s3):
+    """Makes moto refuse IfNoneMatch writes to existing keys, as S3 does."""
+    client = ingestion_lambda.get_checkpoint_client()
+    put_object = client.put_object
+
+    def put(**kwargs):
+        if kwargs.get('IfNoneMatch') == '*':
+            try:
+                s3.head_object(Bucket=kwargs['Bucket'], Key=kwargs['Key'])
+            except ClientError:
+                return put_object(**kwargs)
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+        return put_object(**kwargs)
+    with patch.object(client, 'put_object', side_effect=put):
+        yield s3
+
+
+@pytest.fixture
+def local_db():
+    """A connection to the local test Postgres, skipping if it is not running."""
+    try:
+        conn = pg8000.native.Connection(
+            user=user, host=host, database=db, port=port, password=password)
+    except Exception:
+        pytest.skip('No local Postgres to test against')
+    yield conn
+    conn.close()
+
+
+def notifying_connection(*payloads):
+    conn = Mock()
+    conn.notifications = deque((1, NOTIFY_CHANNEL, json.dumps(payload))
+                               for payload in payloads)
+    return conn
+
+
+def test_notifications_are_collected_by_table():
+    conn = notifying_connection({'table': 'currency', 'id': 1},
+                                {'table': 'payment', 'id': 7},
+                                {'table': 'currency', 'id': 1},
+                                {'table': 'currency', 'id': 3})
+    assert collect_notifications(conn, window=0) == {'currency': {1, 3}, 'payment': {7}}
+
+
+def test_nothing_is_collected_when_the_timeout_passes():
+    conn = notifying_connection()
+    assert collect_notifications(conn, window=0, poll=0, timeout=0) == {}
+
+
+def test_notified_rows_keep_the_incremental_read_position(s3):
+    keyset = {'watermark': '2022-11-03T14:20:48.000000', 'id': 2}
+    s3.put_object(Bucket=bucket_name, Key='checkpoints/currency.json',
+                  Body=json.dumps({'table': 'currency', 'latest': '2022-11-03-14-20-50',
+                                   'key': 'currency/2022-11-03-14-20-50.json',
+                                   'keyset': keyset}))
+    conn = Mock()
+    conn.prepare.return_value.run.return_value = [[3, 'EUR', newest, newest]]
+
+    timing = ingest_notified_rows(conn, s3, 'currency', [3])
+
+    assert conn.prepare.return_value.run.call_args.kwargs == {'ids': [3]}
+    assert timing['key'] == 'currency/2022-11-03-14-20-51.json'
+    assert timing['previous'] == 'currency/2022-11-03-14-20-50.json'
+    checkpoint = json.loads(s3.get_object(
+        Bucket=bucket_name, Key='checkpoints/currency.json')['Body'].read())
+    assert checkpoint['key'] == 'currency/2022-11-03-14-20-51.json'
+    assert checkpoint['keyset'] == keyset
+
+
+def test_tables_never_ingested_are_left_to_the_lambda(s3):
+    conn = Mock()
+    assert ingest_notified_rows(conn, s3, 'currency', [3]) is None
+    conn.prepare.assert_not_called()
+
+
+def test_triggers_notify_changed_keys_on_a_local_database(local_db):
+    local_db.run('CREATE TEMP TABLE currency (currency_id int PRIMARY KEY, '
+                 'currency_code text, created_at timestamp, last_updated timestamp);')
+    install_notify_triggers(local_db, ['currency'])
+    try:
+        local_db.run(f'LISTEN {NOTIFY_CHANNEL};')
+        local_db.run("INSERT INTO currency VALUES (1, 'GBP', now(), now()), "
+                     "(2, 'USD', now(), now());")
+        local_db.run("UPDATE currency SET currency_code = 'EUR' WHERE currency_id = 2;")
+        changed = collect_notifications(local_db, window=0, timeout=5)
+        assert changed == {'currency': {1, 2}}
+        rows = fetch_notified_rows(local_db, 'currency', [2])
+        assert [row[:2] for row in rows] == [[2, 'EUR']]
+    finally:
+        remove_notify_triggers(local_db, ['currency'])
+        local_db.run(f'UNLISTEN {NOTIFY_CHANNEL};')
+
+
+def test_the_listener_and_a_scheduled_run_never_replace_each_others_files(conditional_s3):
+    s3 = conditional_s3
+    s3.put_object(Bucket=bucket_name, Key='checkpoints/currency.json',
+                  Body=json.dumps({'table': 'currency', 'latest': '2022-11-03-14-20-50',
+                                   'key': 'currency/2022-11-03-14-20-50.json',
+                                   'keyset': {'watermark': '2022-11-03T14:20:48.000000',
+                                              'id': 2}}))
+    listener = Mock()
+    listener.prepare.return_value.run.return_value = [[3, 'EUR', newest, newest]]
+
+    def poll(conn, table_name, *args):
+        # The listener saves its rows after the scheduled run has read the
+        # checkpoint, so both name their file after the same second.
+        ingest_notified_rows(listener, s3, 'currency', [3])
+        return ({'data': [{'currency_id': 4, 'currency_code': 'USD',
+                           'created_at': '2022-11-03, 14:20:49:962000',
+                           'last_updated': '2022-11-03, 14:20:49:962000'}]}, newest)
+    with patch('src.lambda_functions.ingestion_lambda.get_table_data', side_effect=poll):
+        timing = ingestion_lambda.ingest_table(Mock(), s3, 'currency')
+
+    assert timing['key'] == 'currency/2022-11-03-14-20-52.json'
+    listened = s3.get_object(Bucket=bucket_name, Key='currency/2022-11-03-14-20-51.json')
+    polled = s3.get_object(Bucket=bucket_name, Key=timing['key'])
+    assert [row['currency_id'] for row in json.loads(listened['Body'].read())['data']] == [3]
+    assert [row['currency_id'] for row in json.loads(polled['Body'].read())['data']] == [4]
+    checkpoint = json.loads(s3.get_object(
+        Bucket=bucket_name, Key='checkpoints/currency.json')['Body'].read())
+    assert checkpoint['key'] == timing['key']
+    assert checkpoint['keyset']['id'] == 4
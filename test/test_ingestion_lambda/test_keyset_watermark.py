@@ -0,0 +1,112 @@
+import pytest
+import os
+import json
+import boto3
+import datetime
+from unittest.mock import patch, Mock
+from moto import mock_s3
+from src.lambda_functions.ingestion_lambda import (ingest_table,
+                                                   fetch_table_rows,
+                                                   stream_table_to_s3)
+
+bucket_name = "test-183947598437"
+first = datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)
+second = datetime.datetime(2022, 11, 3, 14, 20, 49, 962001)
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_s3():
+        s3 = boto3.client("s3", region_name="eu-west-2")
+        s3.create_bucket(
+            Bucket=bucket_name,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        with patch("src.lambda_functions.ingestion_lambda.ingestion_bucket",
+                   bucket_name), \
+                patch("src.lambda_functions.ingestion_lambda._checkpoint_client", None):
+            yield s3
+
+
+def put_checkpoint(s3, latest, keyset=None):
+    checkpoint = {'table': 'currency', 'latest': latest,
+                  'key': f'currency/{latest}.json'}
+    if keyset is not None:
+        checkpoint['keyset'] = keyset
+    s3.put_object(Bucket=bucket_name, Key='checkpoints/currency.json',
+                  Body=json.dumps(checkpoint))
+
+
+def read_checkpoint(s3):
+    res = s3.get_object(Bucket=bucket_name, Key='checkpoints/currency.json')
+    return json.loads(res['Body'].read())
+
+
+def test_keyset_reads_compare_the_watermark_and_primary_key():
+    conn = Mock()
+    conn.prepare.return_value.run.side_effect = [[], [[first]]]
+    fetch_table_rows(conn, 'currency', first, 4)
+    query = conn.prepare.call_args_list[0].args[0]
+    assert 'WHERE (last_updated, currency_id) > (:last_updated, :last_id)' in query
+    assert query.endswith('ORDER BY last_updated, currency_id;')
+    conn.prepare.return_value.run.assert_any_call(last_updated=first, last_id=4)
+
+
+def test_the_checkpoint_keyset_is_the_exact_last_row(s3):
+    put_checkpoint(s3, '2022-11-03-14-20-50',
+                   {'watermark': first.isoformat(), 'id': 4})
+    conn = Mock()
+    conn.prepare.return_value.run.side_effect = [
+        [[5, 'GBP', first, first], [2, 'USD', first, second]], [[second]]]
+    result = ingest_table(conn, s3, 'currency')
+
+    assert conn.prepare.return_value.run.call_args_list[0].kwargs == {
+        'last_updated': first, 'last_id': 4}
+    # The rows fall in the second the previous file was named after, so
+    # the new file is named a second later rather than replacing it.
+    assert result['key'] == 'currency/2022-11-03-14-20-51.json'
+    assert result['watermark'] == '2022-11-03T14:20:49.962001'
+    assert read_checkpoint(s3) == {
+        'table': 'currency', 'latest': '2022-11-03-14-20-51',
+        'key': 'currency/2022-11-03-14-20-51.json',
+        'keyset': {'watermark': '2022-11-03T14:20:49.962001', 'id': 2}}
+
+
+def test_a_checkpoint_without_a_keyset_reads_after_its_file_date(s3):
+    put_checkpoint(s3, '2022-11-03-14-20-50')
+    conn = Mock()
+    conn.prepare.return_value.run.side_effect = [[], [[first]]]
+    ingest_table(conn, s3, 'currency')
+    assert conn.prepare.return_value.run.call_args_list[0].kwargs == {
+        'last_updated': datetime.datetime(2022, 11, 3, 14, 20, 50)}
+
+
+def test_streamed_tables_save_the_keyset_of_the_last_row(s3):
+    put_checkpoint(s3, '2022-11-03-14-20-50',
+                   {'watermark': first.isoformat(), 'id': 4})
+    conn = Mock()
+    conn.prepare.return_value.run.return_value = [[second]]
+    fetches = iter([[[5, 'GBP', first, first]], [[2, 'USD', first, second]], []])
+
+    def run(sql, **params):
+        return next(fetches) if sql.startswith('FETCH') else None
+    conn.run.side_effect = run
+    stream_table_to_s3(conn, s3, 'currency', first, 4, '2022-11-03-14-20-50')
+
+    assert conn.run.call_args_list[1].kwargs == {'last_updated': first, 'last_id': 4}
+    assert read_checkpoint(s3)['keyset'] == {
+        'watermark': '2022-11-03T14:20:49.962001', 'id': 2}
+    body = s3.get_object(Bucket=bucket_name,
+                         Key='currency/2022-11-03-14-20-51.json')['Body']
+    assert len(json.loads(body.read())['data']) == 2
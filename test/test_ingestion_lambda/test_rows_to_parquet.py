@@ -0,0 +1,31 @@
+import io
+import datetime
+from decimal import Decimal
+import pyarrow as pa
+import pyarrow.parquet as pq
+from src.lambda_functions.ingestion_lambda import rows_to_parquet
+
+timestamp = datetime.datetime(2022, 11, 3, 14, 20, 52, 186000)
+rows = [
+    [1, timestamp, timestamp, 9, 16, 18, 84754, Decimal('2.43'), 3,
+     '2022-11-10', '2022-11-03', 4],
+    [2, timestamp, timestamp, 3, 19, 8, 42972, Decimal('3.94'), 2,
+     '2022-11-07', '2022-11-08', 8],
+]
+
+
+def test_parquet_keeps_column_order_and_types():
+    table = pq.read_table(io.BytesIO(rows_to_parquet(rows, 'sales_order')))
+    assert table.column_names[:3] == ['sales_order_id', 'created_at', 'last_updated']
+    assert table.schema.field('sales_order_id').type == pa.int64()
+    assert table.schema.field('created_at').type == pa.timestamp('us')
+    assert pa.types.is_decimal(table.schema.field('unit_price').type)
+    assert table.column('unit_price').to_pylist() == [Decimal('2.43'), Decimal('3.94')]
+    assert table.column('created_at').to_pylist() == [timestamp, timestamp]
+
+
+def test_all_null_columns_are_written():
+    transaction_rows = [[1, 'SALE', 1, None, timestamp, timestamp]]
+    table = pq.read_table(
+        io.BytesIO(rows_to_parquet(transaction_rows, 'transaction')))
+    assert table.column('purchase_order_id').to_pylist() == [None]
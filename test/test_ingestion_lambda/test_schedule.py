@@ -0,0 +1,82 @@
+import pytest
+import os
+import json
+import boto3
+import datetime
+from unittest.mock import patch
+from moto import mock_s3
+from src.lambda_functions.ingestion_lambda import (due_tables,
+                                                   lambda_handler,
+                                                   save_schedule,
+                                                   TABLES)
+
+bucket_name = "test-183947598437"
+now = datetime.datetime(2022, 11, 3, 14, 0, 0)
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_s3():
+        s3 = boto3.client("s3", region_name="eu-west-2")
+        s3.create_bucket(
+            Bucket=bucket_name,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        with patch("src.lambda_functions.ingestion_lambda.ingestion_bucket",
+                   bucket_name), \
+                patch("src.lambda_functions.ingestion_lambda._checkpoint_client", None):
+            yield s3
+
+
+def timing(table_name, rows):
+    return {'table': table_name, 'rows': rows, 'fetch': 0, 'upload': 0, 'total': 0}
+
+
+def test_only_tables_due_are_polled():
+    schedule = {'currency': {'interval': 60, 'next': '2022-11-03-14-30-00'},
+                'payment': {'interval': 1, 'next': '2022-11-03-13-59-00'},
+                'sales_order': {'interval': 1, 'next': '2022-11-03-14-00-20'}}
+    assert due_tables(schedule, ['currency', 'payment', 'sales_order', 'staff'], now) == [
+        'payment', 'sales_order', 'staff']
+
+
+def test_adaptive_intervals_follow_the_changes_found(s3):
+    schedule = {'currency': {'interval': 60, 'next': '2022-11-03-14-00-00'},
+                'payment': {'interval': 8, 'next': '2022-11-03-14-00-00'},
+                'department': {'interval': 240, 'next': '2022-11-03-14-00-00'}}
+    saved = save_schedule(schedule, None,
+                          [timing('currency', 0), timing('payment', 12),
+                           timing('department', 0), timing('staff', 0)],
+                          now, adaptive=True)
+    assert saved == {'currency': {'interval': 120, 'next': '2022-11-03-16-00-00'},
+                     'payment': {'interval': 4, 'next': '2022-11-03-14-04-00'},
+                     'department': {'interval': 240, 'next': '2022-11-03-18-00-00'},
+                     'staff': {'interval': 10, 'next': '2022-11-03-14-10-00'}}
+    body = s3.get_object(Bucket=bucket_name, Key='schedules/ingestion.json')['Body']
+    assert json.loads(body.read()) == saved
+
+
+def test_a_table_is_not_polled_again_before_its_interval(s3):
+    def ingest(conn, s3, table_name):
+        return timing(table_name, 0)
+    with patch('src.lambda_functions.ingestion_lambda.get_secret', return_value='{}'), \
+            patch('src.lambda_functions.ingestion_lambda.connect_to_totesys'), \
+            patch('src.lambda_functions.ingestion_lambda.trigger_lambda_processed'), \
+            patch('src.lambda_functions.ingestion_lambda.ingest_table',
+                  side_effect=ingest) as mock_ingest, \
+            patch.dict(os.environ, {"INGESTION_SCHEDULE": "fixed"}):
+        lambda_handler(None, None)
+        assert mock_ingest.call_count == len(TABLES)
+        lambda_handler(None, None)
+        assert mock_ingest.call_count == len(TABLES)
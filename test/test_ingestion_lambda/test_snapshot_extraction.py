@@ -0,0 +1,68 @@
+import datetime
+from unittest.mock import Mock, patch
+from src.lambda_functions.ingestion_lambda import (begin_snapshot,
+                                                   fetch_table_rows,
+                                                   ingest_tables_parallel)
+
+snapshot_id = '00000003-0000001B-1'
+
+
+def test_begin_snapshot_exports_the_transaction_snapshot():
+    conn = Mock()
+    conn.run.return_value = [[snapshot_id]]
+    assert begin_snapshot(conn) == snapshot_id
+    assert [c.args[0] for c in conn.run.call_args_list] == [
+        'START TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;',
+        'SELECT pg_export_snapshot();']
+
+
+def test_begin_snapshot_imports_an_exported_snapshot():
+    conn = Mock()
+    assert begin_snapshot(conn, snapshot_id) == snapshot_id
+    assert [c.args[0] for c in conn.run.call_args_list] == [
+        'START TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;',
+        f"SET TRANSACTION SNAPSHOT '{snapshot_id}';"]
+
+
+def test_every_worker_reads_from_the_coordinator_snapshot():
+    connections = []
+
+    def connect(credentials):
+        conn = Mock()
+        conn.run.return_value = [[snapshot_id]]
+        connections.append(conn)
+        return conn
+    used = []
+
+    def ingest(conn, s3, file_name):
+        used.append(conn)
+        return {'table': file_name}
+    with patch('src.lambda_functions.ingestion_lambda.connect_to_totesys',
+               side_effect=connect), \
+            patch('src.lambda_functions.ingestion_lambda.ingest_table',
+                  side_effect=ingest):
+        ingest_tables_parallel({}, Mock(), 3, snapshot=True)
+    coordinator, workers = connections[0], connections[1:]
+    assert coordinator not in used
+    assert set(used) == set(workers)
+    assert coordinator.run.call_args_list[-1].args[0] == 'SELECT pg_export_snapshot();'
+    for conn in workers:
+        assert conn.run.call_args_list[-1].args[0] == \
+            f"SET TRANSACTION SNAPSHOT '{snapshot_id}';"
+    assert all(conn.close.call_count == 1 for conn in connections)
+
+
+def test_snapshot_watermark_is_taken_from_the_rows_fetched():
+    conn = Mock()
+    conn.run.return_value = [[snapshot_id]]
+    begin_snapshot(conn)
+    first = datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)
+    second = datetime.datetime(2022, 11, 3, 14, 25, 1, 5000)
+    conn.prepare.return_value.run.return_value = [[1, 'GBP', first, first],
+                                                  [2, 'USD', first, second]]
+    rows, max_last_updated = fetch_table_rows(conn, 'currency')
+    assert len(rows) == 2
+    assert max_last_updated == datetime.datetime(2022, 11, 3, 14, 25, 2)
+    # Only the data query is prepared: there is no separate MAX query.
+    assert conn.prepare.call_count == 1
+    assert 'MAX' not in conn.prepare.call_args.args[0]
@@ -0,0 +1,162 @@
+import pytest
+import os
+import json
+import boto3
+import datetime
+from unittest.mock import patch, Mock
+from moto import mock_s3
+from botocore.exceptions import ClientError
+from src.lambda_functions.ingestion_lambda import (stream_table_to_s3,
+                                                   get_checkpoint_client,
+                                                   get_table_data)
+
+bucket_name = "test-183947598437"
+timestamp = datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_s3():
+        s3 = boto3.client("s3", region_name="eu-west-2")
+        s3.create_bucket(
+            Bucket=bucket_name,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        with patch("src.lambda_functions.ingestion_lambda.ingestion_bucket",
+                   bucket_name):
+            yield s3
+
+
+def currency_rows(count, code_length=3):
+    return [[i, 'X' * code_length, timestamp, timestamp]
+            for i in range(1, count + 1)]
+
+
+def cursor_connection(rows, fetch_size):
+    """Returns a mock connection that serves rows through FETCH."""
+    conn = Mock()
+    conn.prepare.return_value.run.return_value = [[timestamp]]
+    chunks = [rows[i:i + fetch_size] for i in range(0, len(rows), fetch_size)]
+    remaining = iter(chunks + [[]])
+
+    def run(sql, **params):
+        if sql.startswith('FETCH'):
+            return next(remaining)
+        return None
+    conn.run.side_effect = run
+    return conn
+
+
+def test_streamed_object_matches_json_dumps(s3):
+    rows = currency_rows(25)
+    conn = cursor_connection(rows, 10)
+    with patch.dict(os.environ, {"INGESTION_FETCH_SIZE": "10"}):
+        row_count, _, written = stream_table_to_s3(conn, s3, 'currency')
+    assert row_count == 25
+
+    expected_conn = Mock()
+    expected_conn.prepare.return_value.run.side_effect = [rows, [[timestamp]]]
+    expected = json.dumps(get_table_data(expected_conn, 'currency')[0])
+    body = s3.get_object(Bucket=bucket_name,
+                         Key='currency/2022-11-03-14-20-50.json')['Body']
+    assert body.read().decode('utf-8') == expected
+    head = s3.head_object(Bucket=bucket_name, Key='currency/2022-11-03-14-20-50.json')
+    assert written == {'key': 'currency/2022-11-03-14-20-50.json',
+                       'etag': head['ETag'],
+                       'watermark': '2022-11-03T14:20:49.962000'}
+
+
+def test_large_tables_are_uploaded_in_several_parts(s3):
+    rows = currency_rows(24000, code_length=500)
+    conn = cursor_connection(rows, 4000)
+    with patch.dict(os.environ, {"INGESTION_FETCH_SIZE": "4000"}):
+        stream_table_to_s3(conn, s3, 'currency')
+    head = s3.head_object(Bucket=bucket_name,
+                          Key='currency/2022-11-03-14-20-50.json')
+    assert head['ETag'].strip('"').endswith('-3')
+    body = s3.get_object(Bucket=bucket_name,
+                         Key='currency/2022-11-03-14-20-50.json')['Body']
+    assert len(json.loads(body.read())['data']) == 24000
+
+
+def test_cursor_is_declared_with_a_bound_watermark(s3):
+    conn = cursor_connection(currency_rows(2), 10)
+    last_updated = datetime.datetime(2022, 11, 1)
+    stream_table_to_s3(conn, s3, 'currency', last_updated)
+    statements = [c.args[0] for c in conn.run.call_args_list]
+    assert statements[0] == 'BEGIN;'
+    assert statements[1].startswith('DECLARE currency_cursor NO SCROLL CURSOR')
+    assert conn.run.call_args_list[1].kwargs == {'last_updated': last_updated}
+    assert statements[-2:] == ['CLOSE currency_cursor;', 'COMMIT;']
+
+
+def test_no_object_is_written_without_new_rows(s3):
+    conn = cursor_connection([], 10)
+    assert stream_table_to_s3(conn, s3, 'currency') == (0, 0, None)
+    assert 'Contents' not in s3.list_objects_v2(Bucket=bucket_name)
+    assert s3.list_multipart_uploads(Bucket=bucket_name).get('Uploads') is None
+
+
+def test_failed_stream_aborts_the_upload_and_rolls_back(s3):
+    conn = cursor_connection(currency_rows(20000, code_length=500), 12000)
+    fetches = conn.run.side_effect
+
+    def fail_second_fetch(sql, **params):
+        if sql.startswith('FETCH') and fail_second_fetch.fetched:
+            raise RuntimeError('connection lost')
+        fail_second_fetch.fetched = sql.startswith('FETCH')
+        return fetches(sql, **params)
+    fail_second_fetch.fetched = False
+    conn.run.side_effect = fail_second_fetch
+    with patch.dict(os.environ, {"INGESTION_FETCH_SIZE": "12000"}):
+        with pytest.raises(RuntimeError):
+            stream_table_to_s3(conn, s3, 'currency')
+    assert conn.run.call_args_list[-1].args[0] == 'ROLLBACK;'
+    assert s3.list_multipart_uploads(Bucket=bucket_name).get('Uploads') is None
+    assert 'Contents' not in s3.list_objects_v2(Bucket=bucket_name)
+
+
+def test_a_key_taken_while_streaming_is_streamed_again_under_the_next_second(s3):
+    rows = currency_rows(5)
+    conn = Mock()
+    conn.prepare.return_value.run.return_value = [[timestamp]]
+    remaining = iter([])
+
+    def run(sql, **params):
+        nonlocal remaining
+        if sql.startswith('DECLARE'):
+            remaining = iter([rows, []])
+        if sql.startswith('FETCH'):
+            return next(remaining)
+        return None
+    conn.run.side_effect = run
+
+    client = get_checkpoint_client()
+    complete = client.complete_multipart_upload
+    completed = []
+
+    def taken_once(**kwargs):
+        completed.append((kwargs['Key'], kwargs['IfNoneMatch']))
+        if len(completed) == 1:
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}},
+                              'CompleteMultipartUpload')
+        return complete(**kwargs)
+    with patch.object(client, 'complete_multipart_upload', side_effect=taken_once):
+        row_count, _, written = stream_table_to_s3(conn, s3, 'currency')
+
+    assert completed == [('currency/2022-11-03-14-20-50.json', '*'),
+                         ('currency/2022-11-03-14-20-51.json', '*')]
+    assert row_count == 5
+    assert written['key'] == 'currency/2022-11-03-14-20-51.json'
+    assert s3.list_multipart_uploads(Bucket=bucket_name).get('Uploads', []) == []
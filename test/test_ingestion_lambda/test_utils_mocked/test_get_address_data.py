@@ -1,29 +1,25 @@
-from src.lambda_functions.ingestion_lambda import get_address_data
+from src.lambda_functions.ingestion_lambda import get_table_data
 import json
-from unittest.mock import patch, Mock
-from test_data.address_data import rows, columns
+from unittest.mock import Mock
+import datetime
+from test_data.address_data import rows
 
-user = "test"
-host = "test"
-db = "test"
-password = "test"
-port = "test"
 
+def mock_connection():
+    conn = Mock()
+    conn.prepare.return_value.run.side_effect = [
+        rows, [[datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)]]]
+    return conn
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_should_return_a_dict(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
-    result = get_address_data(user, host, db, port, password)[0]
+
+def test_should_return_a_dict():
+    result = get_table_data(mock_connection(), 'address')[0]
     assert type(result) is dict
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_dictionary_should_have_all_required_keys(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
+def test_dictionary_should_have_all_required_keys():
     expected = "keys are present"
-    result = get_address_data(user, host, db, port, password)[0]
+    result = get_table_data(mock_connection(), 'address')[0]
     for address in result["data"]:
         if all(
             key in address
@@ -47,12 +43,9 @@ def test_dictionary_should_have_all_required_keys(mock_connection):
     assert expected == are_keys_present
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_dictionary_should_be_ordered_by_address_id(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
+def test_dictionary_should_be_ordered_by_address_id():
     expected = "Correct Order"
-    result = get_address_data(user, host, db, port, password)[0]
+    result = get_table_data(mock_connection(), 'address')[0]
     x = result["data"][0]["address_id"]
     for address in result["data"]:
         if address["address_id"] >= x:
@@ -64,12 +57,9 @@ def test_dictionary_should_be_ordered_by_address_id(mock_connection):
     assert expected == checker
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_created_at_and_last_updated_should_be_strings(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
+def test_created_at_and_last_updated_should_be_strings():
     expected = "yes"
-    function = get_address_data(user, host, db, port, password)[0]
+    function = get_table_data(mock_connection(), 'address')[0]
     for value in function["data"]:
         print(type(value["created_at"]))
         if type(value["created_at"]) == str and type(value["last_updated"]) == str:
@@ -80,9 +70,6 @@ def test_created_at_and_last_updated_should_be_strings(mock_connection):
     assert expected == are_dates_strings
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_can_be_converted_to_json(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
-    result = json.dumps(get_address_data(user, host, db, port, password)[0])
+def test_can_be_converted_to_json():
+    result = json.dumps(get_table_data(mock_connection(), 'address')[0])
     assert type(result) == str
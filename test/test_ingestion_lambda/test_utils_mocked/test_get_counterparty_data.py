@@ -1,36 +1,29 @@
-from src.lambda_functions.ingestion_lambda import get_counterparty_data
+from src.lambda_functions.ingestion_lambda import get_table_data
 import json
-from test_data.counterparty_data import rows, columns
-from unittest.mock import patch, Mock
+from test_data.counterparty_data import rows
+from unittest.mock import Mock
+import datetime
 
-user = "test"
-host = "test"
-db = "test"
-password = "test"
-port = "test"
 
+def mock_connection():
+    conn = Mock()
+    conn.prepare.return_value.run.side_effect = [
+        rows, [[datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)]]]
+    return conn
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_should_return_a_dict(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
-    result = get_counterparty_data(user, host, db, port, password)[0]
+
+def test_should_return_a_dict():
+    result = get_table_data(mock_connection(), 'counterparty')[0]
     assert type(result) is dict
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_should_have_a_key_of_data(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
-    result = get_counterparty_data(user, host, db, port, password)[0]
+def test_should_have_a_key_of_data():
+    result = get_table_data(mock_connection(), 'counterparty')[0]
     assert "data" in result
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_data_key_should_contain_list_of_valid_dict_rows(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
-    result = get_counterparty_data(user, host, db, port, password)[0]["data"]
+def test_data_key_should_contain_list_of_valid_dict_rows():
+    result = get_table_data(mock_connection(), 'counterparty')[0]["data"]
     for row in result:
         assert "counterparty_id" in row
         assert "counterparty_legal_name" in row
@@ -41,11 +34,8 @@ def test_data_key_should_contain_list_of_valid_dict_rows(mock_connection):
         assert "last_updated" in row
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_data_for_correct_type(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
-    result = get_counterparty_data(user, host, db, port, password)[0]["data"]
+def test_data_for_correct_type():
+    result = get_table_data(mock_connection(), 'counterparty')[0]["data"]
     for row in result:
         assert type(row["counterparty_id"]) is int
         assert type(row["counterparty_legal_name"]) is str
@@ -56,10 +46,7 @@ def test_data_for_correct_type(mock_connection):
         assert type(row["last_updated"]) is str
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_can_be_converted_to_json(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
-    result = json.dumps(get_counterparty_data(
-        user, host, db, port, password)[0])
+def test_can_be_converted_to_json():
+    result = json.dumps(get_table_data(
+        mock_connection(), 'counterparty')[0])
     assert type(result) == str
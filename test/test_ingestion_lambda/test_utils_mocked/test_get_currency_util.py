@@ -1,21 +1,20 @@
-from src.lambda_functions.ingestion_lambda import get_currency_util
+from src.lambda_functions.ingestion_lambda import get_table_data
 import json
-from test_data.currency_data import rows, columns
-from unittest.mock import patch, Mock
+from test_data.currency_data import rows
+from unittest.mock import Mock
+import datetime
 
-user = "test"
-host = "test"
-db = "test"
-password = "test"
-port = "test"
 
+def mock_connection():
+    conn = Mock()
+    conn.prepare.return_value.run.side_effect = [
+        rows, [[datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)]]]
+    return conn
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_dictionary_should_have_all_required_keys(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
+
+def test_dictionary_should_have_all_required_keys():
     expected = "keys are present"
-    result = get_currency_util(user, host, db, port, password)[0]
+    result = get_table_data(mock_connection(), 'currency')[0]
     for currency in result["data"]:
         if all(
             key in currency
@@ -28,12 +27,9 @@ def test_dictionary_should_have_all_required_keys(mock_connection):
     assert expected == are_keys_present
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_dictionary_should_be_ordered_by_currency_id(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
+def test_dictionary_should_be_ordered_by_currency_id():
     expected = "Correct Order"
-    result = get_currency_util(user, host, db, port, password)[0]
+    result = get_table_data(mock_connection(), 'currency')[0]
     x = result["data"][0]["currency_id"]
     for currency in result["data"]:
         if currency["currency_id"] >= x:
@@ -45,12 +41,9 @@ def test_dictionary_should_be_ordered_by_currency_id(mock_connection):
     assert expected == checker
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_created_at_and_last_updated_should_be_strings(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
+def test_created_at_and_last_updated_should_be_strings():
     expected = "yes"
-    function = get_currency_util(user, host, db, port, password)[0]
+    function = get_table_data(mock_connection(), 'currency')[0]
     for value in function["data"]:
         if type(value["created_at"]) == str and type(value["last_updated"]) == str:
             are_dates_strings = "yes"
@@ -60,9 +53,20 @@ def test_created_at_and_last_updated_should_be_strings(mock_connection):
     assert expected == are_dates_strings
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_can_be_converted_to_json(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
-    result = json.dumps(get_currency_util(user, host, db, port, password)[0])
+def test_can_be_converted_to_json():
+    result = json.dumps(get_table_data(mock_connection(), 'currency')[0])
     assert type(result) == str
+
+
+def test_queries_are_prepared_once_and_parameterized():
+    conn = Mock()
+    conn.prepare.return_value.run.side_effect = [
+        rows, [[datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)]]] * 2
+    last_updated = datetime.datetime(2022, 11, 1)
+    get_table_data(conn, 'currency', last_updated)
+    get_table_data(conn, 'currency', last_updated)
+    assert conn.prepare.call_count == 2
+    data_query = conn.prepare.call_args_list[0].args[0]
+    assert ':last_updated' in data_query
+    assert str(last_updated) not in data_query
+    conn.prepare.return_value.run.assert_any_call(last_updated=last_updated)
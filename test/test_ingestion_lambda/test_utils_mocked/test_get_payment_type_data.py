@@ -1,38 +1,31 @@
-from src.lambda_functions.ingestion_lambda import get_payment_type_data
+from src.lambda_functions.ingestion_lambda import get_table_data
 import json
-from unittest.mock import patch, Mock
-from test_data.payment_type_data import rows, columns
+from unittest.mock import Mock
+import datetime
+from test_data.payment_type_data import rows
 
-user = "test"
-host = "test"
-db = "test"
-password = "test"
-port = "test"
+
+def mock_connection():
+    conn = Mock()
+    conn.prepare.return_value.run.side_effect = [
+        rows, [[datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)]]]
+    return conn
 
 # tests for get_payment_type data
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_should_return_a_dict(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
-    result = get_payment_type_data(user, host, db, port, password)[0]
+def test_should_return_a_dict():
+    result = get_table_data(mock_connection(), 'payment_type')[0]
     assert type(result) is dict
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_should_have_a_key_of_data(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
-    result = get_payment_type_data(user, host, db, port, password)[0]
+def test_should_have_a_key_of_data():
+    result = get_table_data(mock_connection(), 'payment_type')[0]
     assert 'data' in result
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_data_key_should_contain_list_of_valid_dict_rows(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
-    result = get_payment_type_data(user, host, db, port, password)[0]['data']
+def test_data_key_should_contain_list_of_valid_dict_rows():
+    result = get_table_data(mock_connection(), 'payment_type')[0]['data']
     for row in result:
         assert 'payment_type_id' in row
         assert 'payment_type_name' in row
@@ -40,11 +33,8 @@ def test_data_key_should_contain_list_of_valid_dict_rows(mock_connection):
         assert 'last_updated' in row
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_data_should_look_correct(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
-    result = get_payment_type_data(user, host, db, port, password)[0]['data']
+def test_data_should_look_correct():
+    result = get_table_data(mock_connection(), 'payment_type')[0]['data']
     for row in result:
         assert type(row['payment_type_id']) is int
         assert type(row['payment_type_name']) is str
@@ -52,10 +42,7 @@ def test_data_should_look_correct(mock_connection):
         assert type(row['last_updated']) is str
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_can_be_converted_to_json(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
-    result = json.dumps(get_payment_type_data(
-        user, host, db, port, password)[0])
+def test_can_be_converted_to_json():
+    result = json.dumps(get_table_data(
+        mock_connection(), 'payment_type')[0])
     assert type(result) == str
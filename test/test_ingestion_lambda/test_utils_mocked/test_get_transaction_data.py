@@ -1,39 +1,31 @@
-from src.lambda_functions.ingestion_lambda import get_transaction_data
+from src.lambda_functions.ingestion_lambda import get_table_data
 import json
-from unittest.mock import patch, Mock
-from test_data.transaction_data import rows, columns
+from unittest.mock import Mock
+import datetime
+from test_data.transaction_data import rows
 
 
-user = "test"
-host = "test"
-db = "test"
-password = "test"
-port = "test"
+def mock_connection():
+    conn = Mock()
+    conn.prepare.return_value.run.side_effect = [
+        rows, [[datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)]]]
+    return conn
 
 # tests for get_counter_party data
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_should_return_a_dict(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
-    result = get_transaction_data(user, host, db, port, password)[0]
+def test_should_return_a_dict():
+    result = get_table_data(mock_connection(), 'transaction')[0]
     assert type(result) is dict
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_should_have_a_key_of_data(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
-    result = get_transaction_data(user, host, db, port, password)[0]
+def test_should_have_a_key_of_data():
+    result = get_table_data(mock_connection(), 'transaction')[0]
     assert 'data' in result
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_data_key_should_contain_list_of_valid_dict_rows(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
-    result = get_transaction_data(user, host, db, port, password)[0]['data']
+def test_data_key_should_contain_list_of_valid_dict_rows():
+    result = get_table_data(mock_connection(), 'transaction')[0]['data']
     for row in result:
         assert 'transaction_id' in row
         assert 'transaction_type' in row
@@ -43,11 +35,8 @@ def test_data_key_should_contain_list_of_valid_dict_rows(mock_connection):
         assert 'last_updated' in row
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_data_for_correct_type(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
-    result = get_transaction_data(user, host, db, port, password)[0]['data']
+def test_data_for_correct_type():
+    result = get_table_data(mock_connection(), 'transaction')[0]['data']
     for row in result:
         assert type(row['transaction_id']) is int
         assert type(row['transaction_type']) is str
@@ -57,10 +46,7 @@ def test_data_for_correct_type(mock_connection):
         assert type(row['last_updated']) is str
 
 
-@patch("src.lambda_functions.ingestion_lambda.pg8000.native.Connection")
-def test_can_be_converted_to_json(mock_connection):
-    mock_connection().run = Mock(return_value=rows)
-    mock_connection().columns = columns
-    result = json.dumps(get_transaction_data(
-        user, host, db, port, password)[0])
+def test_can_be_converted_to_json():
+    result = json.dumps(get_table_data(
+        mock_connection(), 'transaction')[0])
     assert type(result) == str
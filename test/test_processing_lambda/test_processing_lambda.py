@@ -4,8 +4,45 @@ from moto import mock_s3
 import logging
 from src.lambda_functions.processed_lambda import (
     extract_data_from_ingestion_s3,
+    extract_dataframe_from_ingestion_s3,
+    coalesce_increments,
+    create_dim_counterparty,
+    create_dim_currency,
+    create_dim_location,
+    create_dim_staff,
+    critical_path,
+    commit_state,
+    extract_pending_increments,
+    get_checkpoint_client,
+    get_ingestion_key,
+    get_latest_file_name,
+    is_newer,
+    lambda_handler,
+    load_snapshot,
+    read_snapshot,
+    save_snapshots,
+    read_ingestion_object,
+    reset_ingestion_cache,
+    run_graph,
+    list_pending_objects,
+    load_run_manifests,
+    load_state,
+    processed_update,
+    read_checkpoint,
+    read_fact_manifest,
+    upsert_fact_partitions,
+    TRANSFORM_SOURCES,
+    trigger_carried_run,
+    trigger_lambda_warehouse,
     upload_to_processing_s3
 )
+import io
+import pyarrow.parquet as pq
+from botocore.exceptions import ClientError
+from unittest.mock import patch
+from contextlib import ExitStack
+from datetime import datetime
+import threading
 import pytest
 import os
 import pandas as pd
@@ -78,6 +115,23 @@ def test_extract_from_ingestion_s3(s3, ingestion_bucket):
     assert result == expected_data
 
 
+def test_extract_dataframe_from_json_ingestion_file(s3, ingestion_bucket):
+    result = extract_dataframe_from_ingestion_s3(
+        'ingestion_bucket', 'address.json')
+    pd.testing.assert_frame_equal(result, pd.DataFrame(test_data['data']))
+
+
+def test_extract_dataframe_from_parquet_ingestion_file(s3, ingestion_bucket):
+    expected = pd.DataFrame(test_data['data'])
+    s3.put_object(Body=expected.to_parquet(index=False),
+                  Bucket='ingestion_bucket',
+                  Key='address/2022-11-03-14-20-50.parquet')
+    key = get_ingestion_key('ingestion_bucket', 'address', '2022-11-03-14-20-50')
+    assert key == 'address/2022-11-03-14-20-50.parquet'
+    result = extract_dataframe_from_ingestion_s3('ingestion_bucket', key)
+    pd.testing.assert_frame_equal(result, expected)
+
+
 def test_should_handle_error_when_passed_invalid_key(s3, ingestion_bucket):
     with pytest.raises(Exception):
         extract_data_from_ingestion_s3(
@@ -143,3 +197,702 @@ def test_content_type_of_uploaded_file(s3, processed_bucket):
 def test_should_handle_if_error_for_upload_to_processing_s3(s3, processed_bucket):
     with pytest.raises(Exception):
         upload_to_processing_s3('processed_bucket', 'new-file', 'something')
+
+
+def test_get_latest_file_name_ignores_tables_sharing_a_prefix(s3, ingestion_bucket,
+                                                              state_bucket):
+    s3.put_object(Body='{}', Bucket='ingestion_bucket',
+                  Key='payment/2022-11-03-14-20-50.json')
+    s3.put_object(Body='{}', Bucket='ingestion_bucket',
+                  Key='payment_type/2023-01-01-00-00-00.json')
+    assert get_latest_file_name('ingestion_bucket', 'payment') == '2022-11-03-14-20-50'
+    checkpoint, _ = read_checkpoint('ingestion_bucket', 'payment')
+    assert checkpoint['key'] == 'payment/2022-11-03-14-20-50.json'
+
+
+def test_lambda_handler_checkpoints_uploaded_tables(s3, processed_bucket):
+    for bucket in ('processed-bucket-1158020804995033',
+                   'ingestion-bucket-1158020804995033'):
+        s3.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'}
+        )
+    s3.put_object(Body='{}', Bucket='processed-bucket-1158020804995033',
+                  Key='processed_update.json')
+    event = {"Records": [{"s3": {"bucket": {"name": "ingestion"},
+                                 "object": {"key": "processed_trigger.txt"}}}]}
+    dim_design = pd.DataFrame({'design_id': [1], 'design_name': ['Wooden']})
+    tables = ['dim_currency', 'dim_counterparty', 'dim_location', 'dim_staff',
+              'dim_transaction', 'dim_payment_type', 'fact_sales_order',
+              'fact_purchase_order', 'fact_payment']
+    with ExitStack() as stack:
+        for table in tables:
+            stack.enter_context(patch(
+                f'src.lambda_functions.processed_lambda.create_{table}',
+                return_value=(pd.DataFrame(), f'{table}/2022-11-03-14-20-50.parquet')))
+        stack.enter_context(patch(
+            'src.lambda_functions.processed_lambda.create_dim_design',
+            return_value=(dim_design, 'dim_design/2022-11-03-14-20-50.parquet')))
+        stack.enter_context(patch(
+            'src.lambda_functions.processed_lambda.trigger_lambda_warehouse'))
+        lambda_handler(event, None)
+    assert read_checkpoint('processed-bucket-1158020804995033',
+                           'dim_currency') == (None, None)
+    checkpoint, _ = read_checkpoint('processed-bucket-1158020804995033', 'dim_design')
+    assert checkpoint['latest'] == '2022-11-03-14-20-50'
+
+
+@pytest.fixture
+def state_bucket(s3, processed_bucket):
+    s3.put_object(Body=json.dumps({'address': '2022-11-03-14-20-50',
+                                   'staff': 'null'}),
+                  Bucket='processed_bucket', Key='processed_update.json')
+    with patch('src.lambda_functions.processed_lambda.state_bucket',
+               'processed_bucket'), \
+            patch('src.lambda_functions.processed_lambda._state', None):
+        yield s3
+
+
+def read_state(s3):
+    res = s3.get_object(Bucket='processed_bucket', Key='processed_update.json')
+    return json.loads(res['Body'].read())
+
+
+def test_state_is_read_once_and_written_once(state_bucket):
+    load_state(refresh=True)
+    with patch('src.lambda_functions.processed_lambda.get_checkpoint_client') as client:
+        assert processed_update('staff', '2022-11-03-14-20-50') == \
+            ('2022-11-03-14-20-50', False)
+        assert processed_update('address', '2022-11-04-09-00-00') == \
+            ('2022-11-04-09-00-00', False)
+        # A second reader of the same table in the run gets the same answer.
+        assert processed_update('address', '2022-11-04-09-00-00') == \
+            ('2022-11-04-09-00-00', False)
+        assert processed_update('currency', None) == ('null', True)
+    client.assert_not_called()
+    assert read_state(state_bucket)['staff'] == 'null'
+    commit_state()
+    assert read_state(state_bucket) == {'address': '2022-11-04-09-00-00',
+                                        'staff': '2022-11-03-14-20-50'}
+
+
+def test_older_files_are_skipped(state_bucket):
+    load_state(refresh=True)
+    assert processed_update('address', '2022-11-03-14-20-50') == \
+        ('2022-11-03-14-20-50', True)
+    assert commit_state() is None
+
+
+def test_commit_reapplies_changes_after_a_conflict(state_bucket):
+    load_state(refresh=True)
+    processed_update('staff', '2022-11-03-14-20-50')
+    processed_update('address', '2022-11-04-09-00-00')
+    # Another run commits in between.
+    state_bucket.put_object(
+        Body=json.dumps({'address': '2022-11-05-00-00-00', 'staff': 'null',
+                         'design': '2022-11-01-00-00-00'}),
+        Bucket='processed_bucket', Key='processed_update.json')
+    client = get_checkpoint_client()
+    put_object = client.put_object
+    conflict = ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+
+    def conflict_once(**kwargs):
+        if put.call_count == 1:
+            raise conflict
+        return put_object(**kwargs)
+    with patch.object(client, 'put_object', side_effect=conflict_once) as put:
+        commit_state()
+    assert put.call_count == 2
+    assert put.call_args.kwargs['IfMatch'] != put.call_args_list[0].kwargs['IfMatch']
+    assert read_state(state_bucket) == {'address': '2022-11-05-00-00-00',
+                                        'staff': '2022-11-03-14-20-50',
+                                        'design': '2022-11-01-00-00-00'}
+
+
+def put_increment(s3, table_name, stem, rows):
+    s3.put_object(Body=json.dumps({'data': rows}), Bucket='ingestion_bucket',
+                  Key=f'{table_name}/{stem}.json')
+
+
+def sales_order(sales_order_id, units_sold, last_updated):
+    return {'sales_order_id': sales_order_id, 'units_sold': units_sold,
+            'last_updated': f'2022-11-{last_updated}:000000'}
+
+
+@pytest.fixture
+def sales_order_increments(s3, ingestion_bucket):
+    put_increment(s3, 'sales_order', '2022-11-03-14-20-50',
+                  [sales_order(1, 10, '03, 14:20:50'),
+                   sales_order(2, 20, '03, 14:20:50')])
+    put_increment(s3, 'sales_order', '2022-11-04-09-00-00',
+                  [sales_order(2, 21, '04, 09:00:00'),
+                   sales_order(3, 30, '04, 09:00:00')])
+    put_increment(s3, 'sales_order', '2022-11-05-09-00-00',
+                  [sales_order(3, 31, '05, 09:00:00'),
+                   sales_order(4, 40, '05, 09:00:00')])
+    put_increment(s3, 'sales_order', '2022-11-06-09-00-00',
+                  [sales_order(4, 41, '06, 09:00:00')])
+
+
+def test_list_pending_objects_returns_files_after_the_stored_one(
+        s3, sales_order_increments):
+    pending = list_pending_objects('ingestion_bucket', 'sales_order',
+                                   '2022-11-03-14-20-50', '2022-11-05-09-00-00')
+    assert [obj['Key'] for obj in pending] == [
+        'sales_order/2022-11-04-09-00-00.json',
+        'sales_order/2022-11-05-09-00-00.json']
+    assert all(obj['ETag'] for obj in pending)
+    assert len(list_pending_objects('ingestion_bucket', 'sales_order',
+                                    'null', '2022-11-06-09-00-00')) == 4
+
+
+def test_pending_increments_are_coalesced_by_primary_key(
+        s3, sales_order_increments):
+    state = {'data': {'sales_order': '2022-11-03-14-20-50'},
+             'etag': None, 'changes': {}}
+    with patch('src.lambda_functions.processed_lambda._state', state):
+        result = extract_pending_increments(
+            'ingestion_bucket', 'sales_order', '2022-11-06-09-00-00')
+    assert result[['sales_order_id', 'units_sold']].values.tolist() == [
+        [2, 21], [3, 31], [4, 41]]
+
+
+def test_coalesce_keeps_the_latest_last_updated_whatever_the_file_order():
+    first = pd.DataFrame([sales_order(1, 11, '04, 09:00:00')])
+    second = pd.DataFrame([sales_order(1, 10, '03, 14:20:50'),
+                           sales_order(2, 20, '03, 14:20:50')])
+    result = coalesce_increments([first, second], 'sales_order')
+    assert result[['sales_order_id', 'units_sold']].values.tolist() == [
+        [1, 11], [2, 20]]
+
+
+@pytest.fixture
+def ingestion_cache():
+    reset_ingestion_cache()
+    with patch.dict('src.lambda_functions.processed_lambda._snapshots', clear=True):
+        yield
+    reset_ingestion_cache()
+
+
+def test_ingestion_objects_are_fetched_once_per_run(s3, ingestion_bucket, ingestion_cache):
+    obj = s3.list_objects_v2(Bucket='ingestion_bucket')['Contents'][0]
+    with patch('src.lambda_functions.processed_lambda.extract_dataframe_from_ingestion_s3',
+               wraps=extract_dataframe_from_ingestion_s3) as extract:
+        first = read_ingestion_object('ingestion_bucket', obj)
+        first['address_id'] = 0
+        second = read_ingestion_object('ingestion_bucket', obj)
+    extract.assert_called_once()
+    pd.testing.assert_frame_equal(second, pd.DataFrame(test_data['data']))
+
+
+def test_a_changed_etag_is_fetched_again(s3, ingestion_bucket, ingestion_cache):
+    obj = s3.list_objects_v2(Bucket='ingestion_bucket')['Contents'][0]
+    read_ingestion_object('ingestion_bucket', obj)
+    s3.put_object(Body=json.dumps({'data': test_data['data'][:1]}),
+                  Bucket='ingestion_bucket', Key='address.json')
+    obj = s3.list_objects_v2(Bucket='ingestion_bucket')['Contents'][0]
+    assert len(read_ingestion_object('ingestion_bucket', obj)) == 1
+
+
+def test_least_recently_used_objects_are_evicted(s3, ingestion_bucket, ingestion_cache):
+    for stem in ('a', 'b', 'c'):
+        s3.put_object(Body=json.dumps(test_data), Bucket='ingestion_bucket',
+                      Key=f'address/{stem}.json')
+    objs = s3.list_objects_v2(Bucket='ingestion_bucket', Prefix='address/')['Contents']
+    size = int(pd.DataFrame(test_data['data']).memory_usage(deep=True).sum())
+    with patch('src.lambda_functions.processed_lambda.INGESTION_CACHE_BYTES', 2 * size), \
+            patch('src.lambda_functions.processed_lambda.extract_dataframe_from_ingestion_s3',
+                  wraps=extract_dataframe_from_ingestion_s3) as extract:
+        for obj in objs + objs[2:] + objs[:1]:
+            read_ingestion_object('ingestion_bucket', obj)
+    assert [c.kwargs['key'] for c in extract.call_args_list] == [
+        'address/a.json', 'address/b.json', 'address/c.json', 'address/a.json']
+
+
+def test_transforms_share_the_address_file(s3, ingestion_bucket, processed_bucket,
+                                           ingestion_cache):
+    put_increment(s3, 'address', '2022-11-03-14-20-50', test_data['data'])
+    put_increment(s3, 'counterparty', '2022-11-03-14-20-50', [{
+        'counterparty_id': 1, 'counterparty_legal_name': 'Fahey and Sons',
+        'legal_address_id': 15, 'last_updated': '2022-11-03, 14:20:50:000000'}])
+    state = {'data': {}, 'etag': None, 'changes': {}}
+    with patch('src.lambda_functions.processed_lambda._state', state), \
+            patch('src.lambda_functions.processed_lambda.state_bucket', 'processed_bucket'), \
+            patch('src.lambda_functions.processed_lambda.get_latest_file_name',
+                  return_value='2022-11-03-14-20-50'), \
+            patch('src.lambda_functions.processed_lambda.extract_dataframe_from_ingestion_s3',
+                  wraps=extract_dataframe_from_ingestion_s3) as extract:
+        dim_location, _ = create_dim_location('ingestion_bucket')
+        dim_counterparty, _ = create_dim_counterparty('ingestion_bucket')
+    assert [c.kwargs['key'] for c in extract.call_args_list] == [
+        'address/2022-11-03-14-20-50.json', 'counterparty/2022-11-03-14-20-50.json']
+    assert len(dim_location) == len(test_data['data'])
+    assert dim_counterparty['counterparty_legal_city'].tolist() == ['East Bobbie']
+
+
+def test_run_graph_runs_nodes_after_their_dependencies():
+    order = []
+    nodes = {
+        'dim': (lambda: order.append('dim'), ['load:a', 'load:b']),
+        'load:a': (lambda: order.append('load:a'), []),
+        'load:b': (lambda: order.append('load:b') or 'b', []),
+    }
+    results, timings = run_graph(nodes, 1)
+    assert order[-1] == 'dim'
+    assert results['load:b'] == 'b'
+    assert set(timings) == set(nodes)
+
+
+def test_run_graph_runs_independent_nodes_side_by_side():
+    barrier = threading.Barrier(2, timeout=5)
+    nodes = {'a': (barrier.wait, []), 'b': (barrier.wait, [])}
+    results, _ = run_graph(nodes, 2)
+    assert sorted(results.values()) == [0, 1]
+
+
+def test_run_graph_rejects_unmet_dependencies():
+    with pytest.raises(ValueError):
+        run_graph({'a': (lambda: None, ['b']), 'b': (lambda: None, ['a'])}, 2)
+
+
+def test_run_graph_stops_on_a_failed_node():
+    def fail():
+        raise KeyError('address')
+    ran = []
+    nodes = {'load:address': (fail, []),
+             'dim_location': (lambda: ran.append(1), ['load:address'])}
+    with pytest.raises(KeyError):
+        run_graph(nodes, 2)
+    assert ran == []
+
+
+def test_critical_path_follows_the_slowest_chain():
+    nodes = {'load:address': (None, []), 'load:counterparty': (None, []),
+             'dim_location': (None, ['load:address']),
+             'dim_counterparty': (None, ['load:counterparty', 'load:address']),
+             'load:payment': (None, []), 'fact_payment': (None, ['load:payment'])}
+    timings = {'load:address': 2, 'load:counterparty': 1, 'dim_location': 1,
+               'dim_counterparty': 3, 'load:payment': 1, 'fact_payment': 4}
+    assert critical_path(nodes, timings) == (
+        ['load:address', 'dim_counterparty'], 5)
+
+
+def patch_transforms(stack, **transforms):
+    """Patches every create function, with the mocks given or an empty result."""
+    for table in TRANSFORM_SOURCES:
+        stack.enter_context(patch(
+            f'src.lambda_functions.processed_lambda.create_{table}',
+            **transforms.get(table, {'return_value': (
+                pd.DataFrame(), f'{table}/2022-11-03-14-20-50.parquet')})))
+
+
+def test_lambda_handler_uploads_nothing_if_a_transform_fails(s3, processed_bucket):
+    event = {"Records": [{"s3": {"bucket": {"name": "ingestion"},
+                                 "object": {"key": "processed_trigger.txt"}}}]}
+    with ExitStack() as stack, \
+            patch('src.lambda_functions.processed_lambda.load_state'), \
+            patch('src.lambda_functions.processed_lambda.load_source'), \
+            patch('src.lambda_functions.processed_lambda.upload_to_processing_s3') as upload, \
+            patch('src.lambda_functions.processed_lambda.commit_state') as commit, \
+            patch('src.lambda_functions.processed_lambda.trigger_lambda_warehouse') as trigger, \
+            patch.dict(os.environ, {'PROCESSED_WORKERS': '4'}):
+        patch_transforms(stack, fact_payment={'side_effect': RuntimeError('payment')})
+        with pytest.raises(RuntimeError):
+            lambda_handler(event, None)
+    upload.assert_not_called()
+    commit.assert_not_called()
+    trigger.assert_not_called()
+
+
+def test_a_failing_transform_raises_instead_of_returning_none():
+    with patch('src.lambda_functions.processed_lambda.get_latest_file_name',
+               return_value='2022-11-03-14-20-50'), \
+            patch('src.lambda_functions.processed_lambda.processed_update',
+                  return_value=('2022-11-03-14-20-50', False)), \
+            patch('src.lambda_functions.processed_lambda.extract_pending_increments',
+                  side_effect=KeyError('currency')):
+        with pytest.raises(KeyError):
+            create_dim_currency('ingestion_bucket')
+
+
+def test_lambda_handler_saves_nothing_if_a_transform_returns_no_result(s3, processed_bucket):
+    event = {"Records": [{"s3": {"bucket": {"name": "ingestion"},
+                                 "object": {"key": "processed_trigger.txt"}}}]}
+    with ExitStack() as stack, \
+            patch('src.lambda_functions.processed_lambda.load_state'), \
+            patch('src.lambda_functions.processed_lambda.load_source'), \
+            patch('src.lambda_functions.processed_lambda.save_snapshots') as snapshots, \
+            patch('src.lambda_functions.processed_lambda.upload_to_processing_s3') as upload, \
+            patch('src.lambda_functions.processed_lambda.commit_state') as commit:
+        patch_transforms(stack, dim_currency={'return_value': None})
+        with pytest.raises(RuntimeError):
+            lambda_handler(event, None)
+    snapshots.assert_not_called()
+    upload.assert_not_called()
+    commit.assert_not_called()
+
+
+def address(address_id, city, last_updated):
+    return {'address_id': address_id, 'address_line_1': f'{address_id} High Street',
+            'address_line_2': None, 'district': None, 'city': city,
+            'postal_code': '28441', 'country': 'Turkey', 'phone': '1803 637401',
+            'created_at': '2022-11-03, 14:20:49:962000',
+            'last_updated': f'2022-11-{last_updated}:000000'}
+
+
+@pytest.fixture
+def snapshot_run(s3, ingestion_bucket, processed_bucket, ingestion_cache):
+    with patch('src.lambda_functions.processed_lambda.state_bucket', 'processed_bucket'), \
+            patch('src.lambda_functions.processed_lambda._state',
+                  {'data': {}, 'etag': None, 'changes': {}}) as state, \
+            patch('src.lambda_functions.processed_lambda.get_latest_file_name') as latest:
+        yield state, latest
+
+
+def test_missing_snapshot_is_built_from_the_ingestion_history(s3, snapshot_run):
+    state, latest = snapshot_run
+    put_increment(s3, 'address', '2022-11-03-14-20-50',
+                  [address(15, 'East Bobbie', '03, 14:20:50'),
+                   address(28, 'Utica', '03, 14:20:50')])
+    put_increment(s3, 'address', '2022-11-04-09-00-00',
+                  [address(28, 'Leeds', '04, 09:00:00')])
+    state['data']['address'] = '2022-11-03-14-20-50'
+    latest.return_value = '2022-11-04-09-00-00'
+    snapshot = load_snapshot('ingestion_bucket', 'address')
+    assert snapshot[['address_id', 'city']].values.tolist() == [
+        [15, 'East Bobbie'], [28, 'Leeds']]
+    assert save_snapshots() == ['address']
+    stored, _ = read_snapshot('address')
+    pd.testing.assert_frame_equal(stored, snapshot)
+
+
+def test_counterparty_joins_addresses_outside_the_increment(s3, snapshot_run):
+    state, latest = snapshot_run
+    s3.put_object(Body=pd.DataFrame([address(15, 'East Bobbie', '03, 14:20:50'),
+                                     address(28, 'Utica', '03, 14:20:50')]).to_parquet(),
+                  Bucket='processed_bucket', Key='snapshots/address.parquet')
+    state['data'].update(address='2022-11-03-14-20-50',
+                         counterparty='2022-11-03-14-20-50')
+    put_increment(s3, 'address', '2022-11-04-09-00-00',
+                  [address(28, 'Leeds', '04, 09:00:00')])
+    put_increment(s3, 'counterparty', '2022-11-04-09-00-00', [{
+        'counterparty_id': 1, 'counterparty_legal_name': 'Fahey and Sons',
+        'legal_address_id': 15, 'last_updated': '2022-11-04, 09:00:00:000000'}])
+    latest.return_value = '2022-11-04-09-00-00'
+    dim_counterparty, _ = create_dim_counterparty('ingestion_bucket')
+    assert dim_counterparty['counterparty_legal_city'].tolist() == ['East Bobbie']
+    save_snapshots()
+    stored, _ = read_snapshot('address')
+    assert stored['city'].tolist() == ['East Bobbie', 'Leeds']
+
+
+def test_unchanged_snapshots_are_not_written(s3, snapshot_run):
+    _, latest = snapshot_run
+    latest.return_value = None
+    assert load_snapshot('ingestion_bucket', 'address').empty
+    assert save_snapshots() == []
+
+
+def test_snapshot_is_merged_again_after_a_conflict(s3, snapshot_run):
+    state, latest = snapshot_run
+    put_increment(s3, 'address', '2022-11-03-14-20-50',
+                  [address(15, 'East Bobbie', '03, 14:20:50')])
+    latest.return_value = '2022-11-03-14-20-50'
+    load_snapshot('ingestion_bucket', 'address')
+    # Another run writes a snapshot after this one read it.
+    s3.put_object(Body=pd.DataFrame([address(2, 'Aliso Viejo', '04, 09:00:00')]).to_parquet(),
+                  Bucket='processed_bucket', Key='snapshots/address.parquet')
+    client = get_checkpoint_client()
+    put_object = client.put_object
+    conflict = ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+
+    def conflict_once(**kwargs):
+        if put.call_count == 1:
+            raise conflict
+        return put_object(**kwargs)
+    with patch.object(client, 'put_object', side_effect=conflict_once) as put:
+        save_snapshots()
+    assert 'IfNoneMatch' in put.call_args_list[0].kwargs
+    assert 'IfMatch' in put.call_args.kwargs
+    stored, _ = read_snapshot('address')
+    assert sorted(stored['address_id']) == [2, 15]
+
+
+def counterparty(counterparty_id, address_id, last_updated):
+    return {'counterparty_id': counterparty_id,
+            'counterparty_legal_name': f'Counterparty {counterparty_id}',
+            'legal_address_id': address_id,
+            'last_updated': f'2022-11-{last_updated}:000000'}
+
+
+def test_address_change_rebuilds_only_the_counterparties_using_it(s3, snapshot_run):
+    state, latest = snapshot_run
+    put_increment(s3, 'address', '2022-11-03-14-20-50',
+                  [address(15, 'East Bobbie', '03, 14:20:50'),
+                   address(28, 'Utica', '03, 14:20:50')])
+    put_increment(s3, 'counterparty', '2022-11-03-14-20-50',
+                  [counterparty(1, 15, '03, 14:20:50'),
+                   counterparty(2, 28, '03, 14:20:50'),
+                   counterparty(3, 28, '03, 14:20:50')])
+    put_increment(s3, 'address', '2022-11-04-09-00-00',
+                  [address(28, 'Leeds', '04, 09:00:00')])
+    state['data'].update(address='2022-11-03-14-20-50',
+                         counterparty='2022-11-03-14-20-50')
+    latest.side_effect = lambda bucket, table: {
+        'address': '2022-11-04-09-00-00', 'counterparty': '2022-11-03-14-20-50'}[table]
+    dim_counterparty, key = create_dim_counterparty('ingestion_bucket')
+    assert key == 'dim_counterparty/2022-11-04-09-00-00.parquet'
+    assert dim_counterparty[['counterparty_id', 'counterparty_legal_city']].values.tolist() == [
+        [2, 'Leeds'], [3, 'Leeds']]
+
+
+def test_department_change_rebuilds_only_its_staff(s3, snapshot_run):
+    state, latest = snapshot_run
+
+    def department(department_id, location, last_updated):
+        return {'department_id': department_id, 'department_name': f'Dept {department_id}',
+                'location': location, 'manager': 'Manager',
+                'created_at': '2022-11-03, 14:20:49:962000',
+                'last_updated': f'2022-11-{last_updated}:000000'}
+
+    def staff(staff_id, department_id):
+        return {'staff_id': staff_id, 'first_name': 'Jeremie', 'last_name': 'Franey',
+                'department_id': department_id, 'email_address': 'jeremie@terrifictotes.com',
+                'created_at': '2022-11-03, 14:20:51:563000',
+                'last_updated': '2022-11-03, 14:20:51:563000'}
+    put_increment(s3, 'department', '2022-11-03-14-20-50',
+                  [department(1, 'Manchester', '03, 14:20:50'),
+                   department(2, 'Leeds', '03, 14:20:50')])
+    put_increment(s3, 'staff', '2022-11-03-14-20-50',
+                  [staff(1, 1), staff(2, 2), staff(3, 1)])
+    put_increment(s3, 'department', '2022-11-04-09-00-00',
+                  [department(1, 'Sheffield', '04, 09:00:00')])
+    state['data'].update(department='2022-11-03-14-20-50',
+                         staff='2022-11-03-14-20-50')
+    latest.side_effect = lambda bucket, table: {
+        'department': '2022-11-04-09-00-00', 'staff': '2022-11-03-14-20-50'}[table]
+    dim_staff, key = create_dim_staff('ingestion_bucket')
+    assert key == 'dim_staff/2022-11-04-09-00-00.parquet'
+    assert dim_staff[['staff_id', 'location']].values.tolist() == [
+        [1, 'Sheffield'], [3, 'Sheffield']]
+
+
+def fact_sales_order_frame():
+    created = pd.to_datetime(['2022-11-04 10:00:00', '2022-11-03 09:00:00',
+                              '2022-11-03 08:00:00'])
+    return pd.DataFrame({'sales_order_id': [3, 2, 1],
+                         'created_date': created.normalize(),
+                         'created_time': created.floor('s').time,
+                         'units_sold': [30, 20, 10],
+                         'currency_id': [1, 1, 2]})
+
+
+def test_facts_are_written_as_sorted_zstd_partitions(s3, processed_bucket):
+    keys = upsert_fact_partitions('processed_bucket',
+                                  'fact_sales_order/2022-11-04-10-00-00.parquet',
+                                  fact_sales_order_frame(), 'sales_order_id')
+    assert keys == [
+        'fact_sales_order/created_date=2022-11-03/2022-11-04-10-00-00.parquet',
+        'fact_sales_order/created_date=2022-11-04/2022-11-04-10-00-00.parquet']
+    body = s3.get_object(Bucket='processed_bucket', Key=keys[0])['Body'].read()
+    parquet_file = pq.ParquetFile(io.BytesIO(body))
+    assert 'created_date' not in parquet_file.schema_arrow.names
+    column = parquet_file.metadata.row_group(0).column(0)
+    assert column.compression == 'ZSTD'
+    assert (column.statistics.min, column.statistics.max) == (1, 2)
+    assert parquet_file.read().to_pandas()['sales_order_id'].tolist() == [1, 2]
+
+
+def test_lambda_handler_checkpoints_fact_partitions(s3, processed_bucket):
+    for bucket in ('processed-bucket-1158020804995033',
+                   'ingestion-bucket-1158020804995033'):
+        s3.create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'}
+        )
+    s3.put_object(Body='{}', Bucket='processed-bucket-1158020804995033',
+                  Key='processed_update.json')
+    event = {"Records": [{"s3": {"bucket": {"name": "ingestion"},
+                                 "object": {"key": "processed_trigger.txt"}}}]}
+    with ExitStack() as stack:
+        for table in TRANSFORM_SOURCES:
+            stack.enter_context(patch(
+                f'src.lambda_functions.processed_lambda.create_{table}',
+                return_value=(pd.DataFrame(), f'{table}/2022-11-04-10-00-00.parquet')))
+        stack.enter_context(patch(
+            'src.lambda_functions.processed_lambda.create_fact_sales_order',
+            return_value=(fact_sales_order_frame(),
+                          'fact_sales_order/2022-11-04-10-00-00.parquet')))
+        stack.enter_context(patch(
+            'src.lambda_functions.processed_lambda.trigger_lambda_warehouse'))
+        stack.enter_context(patch.dict(os.environ, {'FACT_LAYOUT': 'partitioned'}))
+        lambda_handler(event, None)
+    checkpoint, _ = read_checkpoint('processed-bucket-1158020804995033', 'fact_sales_order')
+    assert checkpoint['latest'] == '2022-11-04-10-00-00'
+    assert len(checkpoint['partitions']) == 2
+
+
+def test_upsert_rewrites_only_the_partitions_it_touches(s3, processed_bucket):
+    first = upsert_fact_partitions('processed_bucket',
+                                   'fact_sales_order/2022-11-04-10-00-00.parquet',
+                                   fact_sales_order_frame(), 'sales_order_id')
+    update = fact_sales_order_frame().iloc[[1]].assign(units_sold=21)
+    second = upsert_fact_partitions('processed_bucket',
+                                    'fact_sales_order/2022-11-05-10-00-00.parquet',
+                                    update, 'sales_order_id')
+    assert second == [
+        'fact_sales_order/created_date=2022-11-03/2022-11-05-10-00-00.parquet']
+    manifest, _ = read_fact_manifest('processed_bucket', 'fact_sales_order')
+    assert manifest['latest'] == '2022-11-05-10-00-00'
+    assert manifest['partitions'] == {'2022-11-03': second[0], '2022-11-04': first[1]}
+    body = s3.get_object(Bucket='processed_bucket', Key=second[0])['Body'].read()
+    merged = pd.read_parquet(io.BytesIO(body))
+    assert merged[['sales_order_id', 'units_sold']].values.tolist() == [[1, 10], [2, 21]]
+
+
+def test_upsert_merges_again_after_a_manifest_conflict(s3, processed_bucket):
+    upsert_fact_partitions('processed_bucket',
+                           'fact_sales_order/2022-11-04-10-00-00.parquet',
+                           fact_sales_order_frame().iloc[[2]], 'sales_order_id')
+    client = get_checkpoint_client()
+    put_object = client.put_object
+    conflict = ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+    manifest_puts = []
+
+    def conflict_on_first_manifest(**kwargs):
+        if kwargs['Key'].startswith('table_manifests/'):
+            manifest_puts.append(kwargs)
+            if len(manifest_puts) == 1:
+                # Another run publishes its own version of the partition first.
+                upsert_fact_partitions('processed_bucket',
+                                       'fact_sales_order/2022-11-04-11-00-00.parquet',
+                                       fact_sales_order_frame().iloc[[1]], 'sales_order_id')
+                raise conflict
+        return put_object(**kwargs)
+    with patch.object(client, 'put_object', side_effect=conflict_on_first_manifest):
+        keys = upsert_fact_partitions('processed_bucket',
+                                      'fact_sales_order/2022-11-05-10-00-00.parquet',
+                                      fact_sales_order_frame().iloc[[2]].assign(units_sold=11),
+                                      'sales_order_id')
+    body = s3.get_object(Bucket='processed_bucket', Key=keys[0])['Body'].read()
+    merged = pd.read_parquet(io.BytesIO(body))
+    assert merged[['sales_order_id', 'units_sold']].values.tolist() == [[1, 11], [2, 20]]
+    manifest, _ = read_fact_manifest('processed_bucket', 'fact_sales_order')
+    assert manifest['partitions']['2022-11-03'] == keys[0]
+
+
+def manifest_entry(stem, previous, rows=1):
+    return {'key': f'sales_order/{stem}.json', 'etag': f'"{stem}"', 'rows': rows,
+            'watermark': None,
+            'previous': previous and f'sales_order/{previous}.json'}
+
+
+def test_run_manifests_replace_the_listing_of_pending_files(s3, sales_order_increments):
+    entries = {'sales_order': [manifest_entry('2022-11-04-09-00-00', '2022-11-03-14-20-50'),
+                               manifest_entry('2022-11-05-09-00-00', '2022-11-04-09-00-00')]}
+    state = {'data': {'sales_order': '2022-11-03-14-20-50'},
+             'etag': None, 'changes': {}}
+    with patch('src.lambda_functions.processed_lambda._run_manifest', entries), \
+            patch('src.lambda_functions.processed_lambda._state', state), \
+            patch('src.lambda_functions.processed_lambda.get_checkpoint_client') as client:
+        assert get_latest_file_name('ingestion_bucket', 'sales_order') == \
+            '2022-11-05-09-00-00'
+        pending = list_pending_objects('ingestion_bucket', 'sales_order',
+                                       '2022-11-03-14-20-50', '2022-11-05-09-00-00')
+    client.assert_not_called()
+    assert pending == [{'Key': 'sales_order/2022-11-04-09-00-00.json',
+                        'ETag': '"2022-11-04-09-00-00"'},
+                       {'Key': 'sales_order/2022-11-05-09-00-00.json',
+                        'ETag': '"2022-11-05-09-00-00"'}]
+
+
+def test_files_missing_from_the_run_manifests_are_listed(s3, sales_order_increments):
+    # The 2022-11-04 file was written by a run that never wrote its manifest.
+    entries = {'sales_order': [manifest_entry('2022-11-05-09-00-00', '2022-11-04-09-00-00')]}
+    with patch('src.lambda_functions.processed_lambda._run_manifest', entries):
+        pending = list_pending_objects('ingestion_bucket', 'sales_order',
+                                       '2022-11-03-14-20-50', '2022-11-05-09-00-00')
+    assert [obj['Key'] for obj in pending] == [
+        'sales_order/2022-11-04-09-00-00.json',
+        'sales_order/2022-11-05-09-00-00.json']
+
+
+def put_run_manifest(s3, run_id, tables):
+    s3.put_object(Body=json.dumps({'stage': 'ingestion', 'run_id': run_id,
+                                   'bucket': 'ingestion_bucket', 'tables': tables}),
+                  Bucket='ingestion_bucket', Key=f'run_manifests/ingestion/{run_id}.json')
+
+
+def test_only_run_manifests_after_the_applied_one_are_read(s3, ingestion_bucket, state_bucket):
+    first = manifest_entry('2022-11-04-09-00-00', '2022-11-03-14-20-50')
+    second = manifest_entry('2022-11-05-09-00-00', '2022-11-04-09-00-00')
+    put_run_manifest(s3, '2022-11-04-09-00-01', {'sales_order': first})
+    put_run_manifest(s3, '2022-11-05-09-00-01', {'sales_order': second})
+    load_state(refresh=True)
+    assert load_run_manifests('ingestion_bucket', 'ingestion') is None
+    assert load_state()['changes'] == {'run_manifest': '2022-11-05-09-00-01'}
+
+    load_state(refresh=True)['data']['run_manifest'] = '2022-11-04-09-00-01'
+    assert load_run_manifests('ingestion_bucket', 'ingestion') == {'sales_order': [second]}
+
+
+def test_a_run_reads_a_bounded_number_of_files_and_carries_the_rest(
+        s3, sales_order_increments):
+    state = {'data': {'sales_order': '2022-11-03-14-20-50'},
+             'etag': None, 'changes': {}}
+    with patch('src.lambda_functions.processed_lambda._state', state), \
+            patch('src.lambda_functions.processed_lambda.PENDING_FILES_PER_RUN', 2), \
+            patch.dict('src.lambda_functions.processed_lambda._run_latest', clear=True), \
+            patch.dict('src.lambda_functions.processed_lambda._carried', clear=True):
+        latest = get_latest_file_name('ingestion_bucket', 'sales_order')
+        assert latest == '2022-11-05-09-00-00'
+        result = extract_pending_increments('ingestion_bucket', 'sales_order', latest)
+        assert result[['sales_order_id', 'units_sold']].values.tolist() == [
+            [2, 21], [3, 31], [4, 40]]
+        key = trigger_carried_run('ingestion_bucket')
+    manifest = json.loads(s3.get_object(Bucket='ingestion_bucket', Key=key)['Body'].read())
+    assert manifest['tables']['sales_order']['key'] == 'sales_order/2022-11-06-09-00-00.json'
+    assert manifest['tables']['sales_order']['previous'] is None
+
+    # The run the manifest starts reads the file carried over.
+    state = {'data': {'sales_order': latest, 'run_manifest': '2022-11-05-09-00-01'},
+             'etag': None, 'changes': {}}
+    with patch('src.lambda_functions.processed_lambda._state', state), \
+            patch('src.lambda_functions.processed_lambda.PENDING_FILES_PER_RUN', 2), \
+            patch.dict('src.lambda_functions.processed_lambda._run_latest', clear=True), \
+            patch.dict('src.lambda_functions.processed_lambda._carried', clear=True), \
+            patch('src.lambda_functions.processed_lambda._run_manifest',
+                  load_run_manifests('ingestion_bucket', 'ingestion')):
+        latest = get_latest_file_name('ingestion_bucket', 'sales_order')
+        assert latest == '2022-11-06-09-00-00'
+        result = extract_pending_increments('ingestion_bucket', 'sales_order', latest)
+        assert result[['sales_order_id', 'units_sold']].values.tolist() == [[4, 41]]
+        assert trigger_carried_run('ingestion_bucket') is None
+
+
+def test_the_warehouse_is_triggered_by_a_run_manifest(s3, processed_bucket):
+    written = {'dim_design': {'table': 'dim_design', 'latest': '2022-11-03-14-20-50',
+                              'key': 'dim_design/2022-11-03-14-20-50.parquet', 'rows': 1}}
+    assert trigger_lambda_warehouse('processed_bucket', {}) is None
+    key = trigger_lambda_warehouse('processed_bucket', written)
+    assert key.startswith('run_manifests/processed/')
+    manifest = json.loads(s3.get_object(Bucket='processed_bucket', Key=key)['Body'].read())
+    assert manifest['stage'] == 'processed'
+    assert manifest['tables'] == written
+    assert [obj['Key'] for obj in s3.list_objects_v2(
+        Bucket='processed_bucket', Prefix='run_manifests/')['Contents']] == [key]
+
+
+def test_runs_in_the_same_second_write_their_own_manifests(s3, processed_bucket):
+    written = {'dim_design': {'table': 'dim_design', 'latest': '2022-11-03-14-20-50',
+                              'key': 'dim_design/2022-11-03-14-20-50.parquet', 'rows': 1}}
+    with patch('src.lambda_functions.processed_lambda.datetime') as clock:
+        clock.utcnow.return_value = datetime(2022, 11, 3, 14, 20, 50, 1000)
+        first = trigger_lambda_warehouse('processed_bucket', written)
+        second = trigger_lambda_warehouse('processed_bucket', written)
+    assert first != second
+    assert first.startswith('run_manifests/processed/2022-11-03-14-20-50-001000-')
+    first_id, second_id = sorted(key.split('/')[-1][:-5] for key in (first, second))
+    assert is_newer(second_id, first_id)
+    assert is_newer(first_id, '2022-11-03-14-20-50')
+    assert not is_newer('2022-11-03-14-20-50', first_id)
@@ -1,5 +1,6 @@
 from unittest.mock import patch
 import json
+import pandas as pd
 from src.lambda_functions.processed_lambda import create_dim_currency
 import pytest
 
@@ -55,3 +56,18 @@ def test_should_have_correct_data_types(extraction_patched, latest_file_name_pat
     data_frame = create_dim_currency()[0]
     for column, data_type in expected_data_types.items():
         assert data_frame[column].dtype == data_type
+
+
+def test_names_follow_the_codes_whatever_the_row_count():
+    increment = pd.DataFrame({'currency_id': [3, 1, 4], 'currency_code': ['EUR', 'GBP', 'CHF'],
+                              'created_at': ['2022-11-03'] * 3,
+                              'last_updated': ['2022-11-03'] * 3})
+    with patch("src.lambda_functions.processed_lambda.get_latest_file_name"), \
+            patch("src.lambda_functions.processed_lambda.processed_update",
+                  return_value=('2022-11-03-14-20-49', False)), \
+            patch("src.lambda_functions.processed_lambda.extract_pending_increments",
+                  return_value=increment):
+        dim_currency, key = create_dim_currency('ingestion_bucket')
+    assert key == 'dim_currency/2022-11-03-14-20-49.parquet'
+    assert dim_currency.values.tolist() == [[3, 'EUR', 'euro'], [1, 'GBP', 'pound'],
+                                            [4, 'CHF', 'CHF']]
@@ -1,6 +1,11 @@
 from unittest.mock import patch
+import io
 import json
+from datetime import datetime
+from decimal import Decimal
+import pandas as pd
 from src.lambda_functions.processed_lambda import create_fact_sales_order
+from src.lambda_functions.ingestion_lambda import rows_to_parquet
 import pytest
 
 test_sales_order_data = {
@@ -105,3 +110,27 @@ def test_should_have_correct_data_types(extraction_patched, latest_file_name_pat
     data_frame = create_fact_sales_order()[0]
     for column, data_type in expected_data_types.items():
         assert data_frame[column].dtype == data_type
+
+
+def test_parquet_and_json_ingestion_give_the_same_fact_table():
+    columns = list(test_sales_order_data['data'][0])
+    rows = []
+    for row in test_sales_order_data['data']:
+        typed = dict(row)
+        for name in ('created_at', 'last_updated'):
+            typed[name] = datetime.strptime(row[name], '%Y-%m-%d, %H:%M:%S:%f')
+        typed['unit_price'] = Decimal(row['unit_price'])
+        rows.append([typed[name] for name in columns])
+    parquet_frame = pd.read_parquet(
+        io.BytesIO(rows_to_parquet(rows, 'sales_order')))
+    json_frame = pd.DataFrame(test_sales_order_data['data'])
+
+    results = []
+    for frame in (json_frame, parquet_frame):
+        with patch("src.lambda_functions.processed_lambda.get_latest_file_name"), \
+             patch("src.lambda_functions.processed_lambda.processed_update",
+                   return_value=('2022-11-03-14-20-53', False)), \
+             patch("src.lambda_functions.processed_lambda.extract_pending_increments",
+                   return_value=frame):
+            results.append(create_fact_sales_order()[0])
+    pd.testing.assert_frame_equal(results[0], results[1])
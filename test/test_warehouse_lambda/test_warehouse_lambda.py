@@ -1,11 +1,20 @@
 import pytest
 import os
+import json
 import boto3
+from io import BytesIO
 from moto import mock_s3
 from src.lambda_functions.warehouse_lambda import extract_data_from_processed_s3
-from src.lambda_functions.warehouse_lambda import counterparty_util, currency_util
-from src.lambda_functions.warehouse_lambda import design_util, staff_util, location_util
-from unittest.mock import patch
+from src.lambda_functions.warehouse_lambda import table_util, bulk_upsert
+from src.lambda_functions.warehouse_lambda import format_for_copy, WAREHOUSE_TABLES
+from src.lambda_functions.warehouse_lambda import get_connection, lambda_handler
+from src.lambda_functions.warehouse_lambda import get_latest_file_name
+from src.lambda_functions.warehouse_lambda import read_checkpoint, save_checkpoint
+from src.lambda_functions.warehouse_lambda import load_state, warehouse_update, commit_state
+from src.lambda_functions.warehouse_lambda import extract_processed_data, get_processed_keys
+from src.lambda_functions.warehouse_lambda import read_fact_partitions
+from src.lambda_functions.processed_lambda import upsert_fact_partitions
+from unittest.mock import patch, MagicMock
 import pandas as pd
 import pg8000
 
@@ -37,6 +46,14 @@ with open("fake_data/processed_bucket/dim_staff.parquet", 'rb') as f:
     df_staff = pd.read_parquet(f)
 
 
+def load_table(table_name):
+    conn = pg8000.connect(user=user, host=host, database=db,
+                          port=port, password=password)
+    table_util(conn, table_name)
+    conn.commit()
+    conn.close()
+
+
 @pytest.fixture(scope="function")
 def aws_credentials():
     """Mocked AWS Credentials for moto."""
@@ -168,7 +185,7 @@ def test_counter_party_util(s3, processed_bucket, mock_extract_data_for_counterp
     expected_names = ['XYZ Corporation', 'ABC Industries',
                       '123 Manufacturing', 'Sample Corporation',
                       'Test Corp']
-    counterparty_util(user, host, db, port, password)
+    load_table('dim_counterparty')
     conn = pg8000.native.Connection(
         user=user, host=host, database=db, port=port, password=password)
     query = '''SELECT * FROM dim_counterparty;'''
@@ -187,7 +204,7 @@ def test_currency_util(s3, processed_bucket, mock_extract_data_for_currency,
         user=user, host=host, database=db, port=port, password=password)
     query = '''DELETE FROM dim_currency;'''
     conn.run(query)
-    currency_util(user, host, db, port, password)
+    load_table('dim_currency')
     query = '''SELECT * FROM dim_currency;'''
     result = conn.run(query)
     print(result)
@@ -205,7 +222,7 @@ def test_design_util(s3, processed_bucket, mock_extract_data_for_design,
         user=user, host=host, database=db, port=port, password=password)
     query = '''DELETE FROM dim_design;'''
     conn.run(query)
-    design_util(user, host, db, port, password)
+    load_table('dim_design')
     query = '''SELECT * FROM dim_design;'''
     result = conn.run(query)
     conn.close()
@@ -221,7 +238,7 @@ def test_location_util(s3, processed_bucket, mock_extract_data_for_location,
         user=user, host=host, database=db, port=port, password=password)
     query = '''DELETE FROM dim_location;'''
     conn.run(query)
-    location_util(user, host, db, port, password)
+    load_table('dim_location')
     query = '''SELECT * FROM dim_location;'''
     result = conn.run(query)
     print(result)
@@ -239,10 +256,303 @@ def test_staff_util(s3, processed_bucket, mock_extract_data_for_staff,
         user=user, host=host, database=db, port=port, password=password)
     query = '''DELETE FROM dim_staff;'''
     conn.run(query)
-    staff_util(user, host, db, port, password)
+    load_table('dim_staff')
     query = '''SELECT * FROM dim_staff;'''
     result = conn.run(query)
     print(result)
     conn.close()
     for item in result:
         assert item[1] in expected_names
+
+
+def test_format_for_copy_renames_orders_and_deduplicates():
+    data = pd.DataFrame({'payment_type_name': ['SALES_RECEIPT', 'REFUND', 'REFUND_2'],
+                         'payment_type_id': [1, 2, 2]})
+    result = format_for_copy(data, WAREHOUSE_TABLES['dim_payment_type'])
+    assert result.read() == '1,SALES_RECEIPT\n2,REFUND_2\n'
+
+
+def test_format_for_copy_writes_whole_floats_as_integers():
+    data = pd.DataFrame({'transaction_id': [1, 2],
+                         'transaction_type': ['SALE', 'PURCHASE'],
+                         'sales_order_id': [3.0, None],
+                         'purchase_order_id': [None, 4.0]})
+    result = format_for_copy(data, WAREHOUSE_TABLES['dim_transaction'])
+    assert result.read() == '1,SALE,3,\n2,PURCHASE,,4\n'
+
+
+def test_bulk_upsert_copies_into_staging_and_merges_once():
+    conn = MagicMock()
+    cursor = conn.cursor.return_value
+    cursor.fetchone.side_effect = [(1,), (4, 1)]
+    result = bulk_upsert(conn, 'dim_currency', df_currency)
+    statements = [c.args[0] for c in cursor.execute.call_args_list]
+    assert result == (4, 1)
+    assert statements[0].startswith('CREATE TEMP TABLE staging_dim_currency')
+    assert statements[1].startswith('COPY staging_dim_currency')
+    assert cursor.execute.call_args_list[1].kwargs['stream'] is not None
+    assert 'ON CONFLICT (currency_id) DO UPDATE' in statements[3]
+    assert statements[4] == 'DROP TABLE staging_dim_currency'
+    assert len(statements) == 5
+
+
+def test_bulk_upsert_merges_without_unique_key():
+    conn = MagicMock()
+    cursor = conn.cursor.return_value
+    cursor.fetchone.side_effect = [None, (2, 3)]
+    data = pd.DataFrame({'staff_id': [1], 'first_name': ['John'],
+                         'last_name': ['Doe'], 'email_address': ['j@d.com'],
+                         'department_name': ['Sales'], 'location': ['Leeds']})
+    with patch.dict("src.lambda_functions.warehouse_lambda._unique_keys", clear=True):
+        result = bulk_upsert(conn, 'dim_staff', data)
+    merge = cursor.execute.call_args_list[3].args[0]
+    assert result == (2, 3)
+    assert 'ON CONFLICT' not in merge
+    assert 'UPDATE dim_staff t SET' in merge
+    assert 'WHERE NOT EXISTS' in merge
+
+
+@pytest.fixture
+def mock_connect():
+    with patch("src.lambda_functions.warehouse_lambda.pg8000.connect") as mock, \
+            patch("src.lambda_functions.warehouse_lambda.get_secret",
+                  return_value='''{"User": "u", "Host": "h", "Schema": "s",
+                                  "Port": 5432, "Password": "p"}''') as secret, \
+            patch("src.lambda_functions.warehouse_lambda._connection", None), \
+            patch("src.lambda_functions.warehouse_lambda._credentials", None):
+        mock.secret = secret
+        yield mock
+
+
+def test_get_connection_is_reused_across_invocations(mock_connect):
+    first = get_connection()
+    second = get_connection()
+    assert first is second
+    assert mock_connect.call_count == 1
+    assert mock_connect.secret.call_count == 1
+    first.cursor.return_value.execute.assert_called_with('SELECT 1')
+
+
+def test_get_connection_replaces_a_dead_connection(mock_connect):
+    dead = get_connection()
+    dead.cursor.return_value.execute.side_effect = Exception('server closed')
+    mock_connect.return_value = MagicMock()
+    fresh = get_connection()
+    assert fresh is not dead
+    assert dead.close.called
+    assert mock_connect.secret.call_count == 1
+
+
+@pytest.fixture
+def mock_state():
+    with patch("src.lambda_functions.warehouse_lambda.load_state") as load, \
+            patch("src.lambda_functions.warehouse_lambda.commit_state") as commit:
+        load.commit = commit
+        yield load
+
+
+def test_lambda_handler_commits_once_for_all_tables(mock_connect, mock_state):
+    event = {"Records": [{"s3": {"bucket": {"name": "processed"},
+                                 "object": {"key": "warehouse_trigger.txt"}}}]}
+    with patch("src.lambda_functions.warehouse_lambda.table_util",
+               return_value=False) as mock_table_util:
+        lambda_handler(event, None)
+    conn = mock_connect.return_value
+    assert mock_table_util.call_count == len(WAREHOUSE_TABLES)
+    assert conn.commit.call_count == 1
+    assert not conn.rollback.called
+    mock_state.assert_called_once_with(refresh=True)
+    mock_state.commit.assert_called_once()
+
+
+def test_lambda_handler_rolls_back_everything_on_failure(mock_connect, mock_state):
+    event = {"Records": [{"s3": {"bucket": {"name": "processed"},
+                                 "object": {"key": "warehouse_trigger.txt"}}}]}
+    with patch("src.lambda_functions.warehouse_lambda.table_util",
+               side_effect=[False, Exception('bad row')]):
+        lambda_handler(event, None)
+    conn = mock_connect.return_value
+    assert not conn.commit.called
+    assert conn.rollback.called
+    mock_state.commit.assert_not_called()
+
+
+def test_get_latest_file_name_reads_the_checkpoint(s3, processed_bucket):
+    with patch("src.lambda_functions.warehouse_lambda.processed_bucket",
+               "processed_bucket"):
+        save_checkpoint("processed_bucket", "dim_staff",
+                        "dim_staff/2022-11-03-14-20-50.parquet")
+        with patch("src.lambda_functions.warehouse_lambda.find_latest_file") as scan:
+            assert get_latest_file_name("dim_staff") == "2022-11-03-14-20-50"
+        scan.assert_not_called()
+
+
+def test_get_latest_file_name_rebuilds_a_missing_checkpoint(s3, processed_bucket):
+    for stamp in ("2022-11-03-14-20-50", "2022-11-04-09-00-00"):
+        s3.put_object(Body=b"", Bucket="processed_bucket",
+                      Key=f"dim_staff/{stamp}.parquet")
+    with patch("src.lambda_functions.warehouse_lambda.processed_bucket",
+               "processed_bucket"):
+        assert get_latest_file_name("dim_staff") == "2022-11-04-09-00-00"
+    checkpoint, _ = read_checkpoint("processed_bucket", "dim_staff")
+    assert checkpoint["key"] == "dim_staff/2022-11-04-09-00-00.parquet"
+
+
+def test_warehouse_state_is_staged_until_commit(s3, processed_bucket):
+    s3.put_object(Body=json.dumps({'dim_staff': '2022-11-03-14-20-50'}),
+                  Bucket="processed_bucket", Key="warehouse_update.json")
+    with patch("src.lambda_functions.warehouse_lambda.state_bucket", "processed_bucket"), \
+            patch("src.lambda_functions.warehouse_lambda._checkpoint_client", None), \
+            patch("src.lambda_functions.warehouse_lambda._state", None):
+        load_state(refresh=True)
+        assert warehouse_update('dim_staff', '2022-11-03-14-20-50') == \
+            ('2022-11-03-14-20-50', True)
+        assert warehouse_update('dim_design', '2022-11-04-09-00-00') == \
+            ('2022-11-04-09-00-00', False)
+        res = s3.get_object(Bucket="processed_bucket", Key="warehouse_update.json")
+        assert 'dim_design' not in json.loads(res['Body'].read())
+        commit_state()
+    res = s3.get_object(Bucket="processed_bucket", Key="warehouse_update.json")
+    assert json.loads(res['Body'].read()) == {'dim_staff': '2022-11-03-14-20-50',
+                                              'dim_design': '2022-11-04-09-00-00'}
+
+
+def fact_sales_order_frame(ids, created_at, units_sold):
+    created = pd.to_datetime(created_at)
+    return pd.DataFrame({'sales_order_id': ids,
+                         'created_date': created.normalize(),
+                         'created_time': created.floor('s').time,
+                         'units_sold': units_sold})
+
+
+@pytest.fixture
+def partitioned_sales(s3, processed_bucket):
+    with patch("src.lambda_functions.warehouse_lambda.processed_bucket", "processed_bucket"), \
+            patch("src.lambda_functions.warehouse_lambda._checkpoint_client", None):
+        first = fact_sales_order_frame(
+            [1, 2, 3], ['2022-11-03 08:00', '2022-11-03 09:00', '2022-11-04 10:00'],
+            [10, 20, 30])
+        keys = upsert_fact_partitions('processed_bucket',
+                                      'fact_sales_order/2022-11-04-10-00-00.parquet',
+                                      first, 'sales_order_id')
+        save_checkpoint('processed_bucket', 'fact_sales_order', keys[0], keys)
+        second = fact_sales_order_frame(
+            [3, 4], ['2022-11-04 10:00', '2022-11-05 11:00'], [31, 40])
+        keys = upsert_fact_partitions('processed_bucket',
+                                      'fact_sales_order/2022-11-05-11-00-00.parquet',
+                                      second, 'sales_order_id')
+        save_checkpoint('processed_bucket', 'fact_sales_order', keys[0], keys)
+        yield first, second
+
+
+def test_warehouse_reads_every_partition_of_the_latest_file(partitioned_sales):
+    _, second = partitioned_sales
+    keys = get_processed_keys('fact_sales_order', '2022-11-05-11-00-00')
+    assert keys == [
+        'fact_sales_order/created_date=2022-11-04/2022-11-05-11-00-00.parquet',
+        'fact_sales_order/created_date=2022-11-05/2022-11-05-11-00-00.parquet']
+    data = extract_processed_data('processed_bucket', keys)
+    pd.testing.assert_frame_equal(data[second.columns], second)
+
+
+def test_unpartitioned_tables_read_a_single_key(s3, processed_bucket):
+    with patch("src.lambda_functions.warehouse_lambda.processed_bucket", "processed_bucket"):
+        assert get_processed_keys('dim_staff', '2022-11-05-11-00-00') == [
+            'dim_staff/2022-11-05-11-00-00.parquet']
+
+
+def test_rebuilt_checkpoint_lists_the_partitions(partitioned_sales):
+    s3 = boto3.client("s3", region_name="eu-west-2")
+    s3.delete_object(Bucket="processed_bucket", Key="checkpoints/fact_sales_order.json")
+    assert len(get_processed_keys('fact_sales_order', '2022-11-05-11-00-00')) == 1
+    assert get_latest_file_name('fact_sales_order') == '2022-11-05-11-00-00'
+    assert len(get_processed_keys('fact_sales_order', '2022-11-05-11-00-00')) == 2
+
+
+def test_read_fact_partitions_reads_one_file_per_partition(partitioned_sales):
+    with patch("src.lambda_functions.warehouse_lambda.extract_data_from_processed_s3") \
+            as extract, \
+            patch("src.lambda_functions.warehouse_lambda.list_fact_partitions") as listing:
+        data = read_fact_partitions('fact_sales_order', since='2022-11-04')
+    extract.assert_not_called()
+    listing.assert_not_called()
+    assert data[['sales_order_id', 'units_sold']].values.tolist() == [[3, 31], [4, 40]]
+
+
+def test_read_fact_partitions_prunes_dates_and_keeps_the_newest_row(partitioned_sales):
+    data = read_fact_partitions('fact_sales_order', since='2022-11-04', until='2022-11-04')
+    assert data[['sales_order_id', 'units_sold']].values.tolist() == [[3, 31]]
+    assert (data['created_date'] == pd.Timestamp('2022-11-04')).all()
+    data = read_fact_partitions('fact_sales_order', filters=[('sales_order_id', '>=', 2)],
+                                columns=['units_sold'])
+    assert data['sales_order_id'].tolist() == [2, 3, 4]
+    assert list(data.columns) == ['sales_order_id', 'units_sold', 'created_date']
+
+
+def test_read_fact_partitions_lists_tables_without_a_manifest(partitioned_sales):
+    s3 = boto3.client("s3", region_name="eu-west-2")
+    s3.delete_object(Bucket="processed_bucket", Key="table_manifests/fact_sales_order.json")
+    data = read_fact_partitions('fact_sales_order', since='2022-11-04')
+    assert data[['sales_order_id', 'units_sold']].values.tolist() == [[3, 31], [4, 40]]
+
+
+def test_a_manifest_run_loads_the_keys_it_lists():
+    keys = ['fact_sales_order/created_date=2022-11-03/2022-11-04-10-00-00.parquet']
+    entries = {'fact_sales_order': [{'table': 'fact_sales_order', 'key': keys[0],
+                                     'latest': '2022-11-04-10-00-00',
+                                     'partitions': keys, 'rows': 2}]}
+    with patch("src.lambda_functions.warehouse_lambda._run_manifest", entries), \
+            patch("src.lambda_functions.warehouse_lambda.get_latest_file_name") as latest, \
+            patch("src.lambda_functions.warehouse_lambda.warehouse_update",
+                  return_value=('2022-11-04-10-00-00', False)) as update, \
+            patch("src.lambda_functions.warehouse_lambda.extract_processed_data") as extract, \
+            patch("src.lambda_functions.warehouse_lambda.bulk_upsert",
+                  return_value=(2, 0)):
+        assert table_util(MagicMock(), 'dim_staff') is True
+        assert table_util(MagicMock(), 'fact_sales_order') is False
+    latest.assert_not_called()
+    update.assert_called_once_with('fact_sales_order', '2022-11-04-10-00-00')
+    assert extract.call_args.args[1] == keys
+
+
+def test_a_manifest_run_loads_every_run_not_yet_applied():
+    entries = {'dim_staff': [
+        {'table': 'dim_staff', 'key': 'dim_staff/2022-11-04-10-00-00.parquet',
+         'latest': '2022-11-04-10-00-00'},
+        {'table': 'dim_staff', 'key': 'dim_staff/2022-11-04-10-01-00.parquet',
+         'latest': '2022-11-04-10-01-00'},
+        {'table': 'dim_staff', 'key': 'dim_staff/2022-11-04-10-02-00.parquet',
+         'latest': '2022-11-04-10-02-00'}]}
+    applied = {'2022-11-04-10-00-00': True}
+    with patch("src.lambda_functions.warehouse_lambda._run_manifest", entries), \
+            patch("src.lambda_functions.warehouse_lambda.warehouse_update",
+                  side_effect=lambda table_name, latest: (
+                      latest, applied.get(latest, False))) as update, \
+            patch("src.lambda_functions.warehouse_lambda.extract_processed_data") as extract, \
+            patch("src.lambda_functions.warehouse_lambda.bulk_upsert",
+                  return_value=(2, 0)):
+        assert table_util(MagicMock(), 'dim_staff') is False
+    assert update.call_count == 3
+    assert extract.call_args.args[1] == ['dim_staff/2022-11-04-10-01-00.parquet',
+                                         'dim_staff/2022-11-04-10-02-00.parquet']
+
+
+def test_a_run_without_a_manifest_loads_every_file_not_yet_applied(s3, processed_bucket):
+    for stem, name in [('2022-11-04-09-00-00', 'Ann'), ('2022-11-04-10-00-00', 'Bob'),
+                       ('2022-11-04-10-01-00', 'Cat')]:
+        body = BytesIO()
+        pd.DataFrame({'staff_id': [1], 'first_name': [name]}).to_parquet(body, index=False)
+        s3.put_object(Bucket="processed_bucket", Key=f'dim_staff/{stem}.parquet',
+                      Body=body.getvalue())
+    s3.put_object(Bucket="processed_bucket", Key="warehouse_update.json",
+                  Body=json.dumps({'dim_staff': '2022-11-04-09-00-00'}))
+    with patch("src.lambda_functions.warehouse_lambda.processed_bucket", "processed_bucket"), \
+            patch("src.lambda_functions.warehouse_lambda.state_bucket", "processed_bucket"), \
+            patch("src.lambda_functions.warehouse_lambda._checkpoint_client", None), \
+            patch("src.lambda_functions.warehouse_lambda._state", None), \
+            patch("src.lambda_functions.warehouse_lambda._run_manifest", None), \
+            patch("src.lambda_functions.warehouse_lambda.bulk_upsert",
+                  return_value=(0, 1)) as upsert:
+        load_state(refresh=True)
+        assert table_util(MagicMock(), 'dim_staff') is False
+    assert upsert.call_args.args[2]['first_name'].tolist() == ['Bob', 'Cat']